@@ -22,7 +22,7 @@ a = Analysis(['malstroem/scripts/cli.py'],
              pathex=[],
              binaries=[],
              datas=datas,
-             hiddenimports=["malstroem.algorithms.speedups._fill","malstroem.algorithms.speedups._flow","malstroem.algorithms.speedups._label", "cyarray.carray"],
+             hiddenimports=["malstroem.algorithms.speedups._fill","malstroem.algorithms.speedups._flow","malstroem.algorithms.speedups._label","malstroem.algorithms.speedups._flats","malstroem.algorithms.speedups._net"],
              hookspath=[],
              runtime_hooks=runtime_hooks,
              excludes=[],
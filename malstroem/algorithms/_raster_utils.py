@@ -14,6 +14,9 @@
 from __future__ import (absolute_import, division, print_function) #, unicode_literals)
 from builtins import *
 
+# Default tile shape (rows, cols) of the tiled functions
+DEFAULT_TILE_SHAPE = (1024, 1024)
+
 
 def cell_in_raster(shape, cell):
     """Check if specified cell is within raster.
@@ -58,3 +61,45 @@ def edge_cell_indexes(shape):
     for r in range(1, maxr):
         yield (r, 0)
         yield (r, maxc)
+
+
+def tile_grid_shape(shape, tile_shape):
+    """Return the number of tiles needed to cover a raster.
+
+    Parameters
+    ----------
+    shape : pair of ints
+        Shape of raster (num_rows, num_cols)
+    tile_shape : pair of ints
+        Shape of tiles (num_rows, num_cols)
+
+    Returns
+    -------
+    Number of tiles (num_tile_rows, num_tile_cols)
+
+    """
+    return (-(-shape[0] // tile_shape[0]), -(-shape[1] // tile_shape[1]))
+
+
+def tile_window(shape, tile_shape, tile):
+    """Return the raster window covered by a tile.
+
+    Tiles in the last tile row and column are truncated at the raster edge.
+
+    Parameters
+    ----------
+    shape : pair of ints
+        Shape of raster (num_rows, num_cols)
+    tile_shape : pair of ints
+        Shape of tiles (num_rows, num_cols)
+    tile : pair of ints
+        Tile indices (tile_row, tile_col)
+
+    Returns
+    -------
+    Window (row, col, num_rows, num_cols)
+
+    """
+    row = tile[0] * tile_shape[0]
+    col = tile[1] * tile_shape[1]
+    return row, col, min(tile_shape[0], shape[0] - row), min(tile_shape[1], shape[1] - col)
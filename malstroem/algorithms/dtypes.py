@@ -29,3 +29,6 @@ DTYPE_FLOWDIR = np.uint8
 
 # Datatype for accumulated flow
 DTYPE_ACCUM = np.float64
+
+# Bits needed per flow direction. AGNPS codes 0-8 fit in 4 bits
+NBITS_FLOWDIR = 4
@@ -13,22 +13,116 @@
 # -------------------------------------------------------------------------------------------------
 from __future__ import (absolute_import, division, print_function) #, unicode_literals)
 from builtins import *
+import heapq
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
 import numpy as np
-from .dtypes import DTYPE_FILL, DTYPE_FILLNOFLAT
+from .dtypes import DTYPE_DTM, DTYPE_FILL, DTYPE_FILLNOFLAT, DTYPE_FLOWDIR
+from ._raster_utils import cell_in_raster, edge_cell_indexes, tile_grid_shape, tile_window, DEFAULT_TILE_SHAPE
+from .flow import SQRT2, FLOWDIR_NODIR, set_edges_flow_outward, set_window_edges_flow, terrain_flowdirection
 
+# Fill methods
+FILL_METHOD_PRIORITY_FLOOD = 'priorityflood'
+FILL_METHOD_SWEEP = 'sweep'
 
-def _fill_terrain(dtm, filled, fromrow, torow, fromcol, tocol):
-    rowstep = 1 if torow > fromrow else -1
-    colstep = 1 if tocol > fromcol else -1
+# Minimum tile size (rows and cols) when filling with several workers
+PARALLEL_MIN_TILE_SIZE = 64
 
-    # print 'Row: %d, %d, %d, Col: %d, %d, %d' % (fromrow, torow, rowstep, fromcol, tocol, colstep)
+# Block size (rows and cols) of the dirty block worklist of the sweep fill
+SWEEP_BLOCK_SIZE = 64
 
-    changed_something = False
-    for r in range(fromrow, torow + rowstep, rowstep):
-        for c in range(fromcol, tocol + colstep, colstep):
-            if _fill_cell(dtm, filled, r, c):
-                changed_something = True
-    return changed_something
+# Row and column steps of the sweep directions UL, LR, UR, LL
+_SWEEP_DIRECTIONS = ((1, 1), (-1, -1), (1, -1), (-1, 1))
+
+# Row and column deltas of the 8 neighbor cells
+_NEIGHBOR_DELTAS = ((-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1))
+
+# For each neighbor tile: the frame cells of a padded tile and the neighbor border cells they are copied from.
+# Tile borders are stored as (top row, bottom row, left column, right column).
+_TILE_HALO = (
+    ((-1, 0), (0, slice(1, -1)), 1, slice(None)),
+    ((-1, 1), (0, -1), 1, 0),
+    ((0, 1), (slice(1, -1), -1), 2, slice(None)),
+    ((1, 1), (-1, -1), 0, 0),
+    ((1, 0), (-1, slice(1, -1)), 0, slice(None)),
+    ((1, -1), (-1, 0), 0, -1),
+    ((0, -1), (slice(1, -1), 0), 3, slice(None)),
+    ((-1, -1), (0, 0), 1, -1),
+)
+
+
+class FillStats(object):
+    """Convergence and throughput of a fill.
+
+    Pass an instance to a fill function to record each pass of the fill over the raster. A priority flood is one pass,
+    the sweep fill records a pass for each sweep direction and the parallel fill records a pass for each round over the
+    tiles which need to be flooded (again). The tiled fill records the tile floods, the flood of the tile border graph
+    and the final tile floods as three passes.
+
+    Parameters
+    ----------
+    callback : callable, optional
+        Called as `callback(stats)` after each pass. Use it to report progress of long running fills
+
+    Attributes
+    ----------
+    method : str
+        Fill method
+    cells : int
+        Number of cells in the raster
+    passes : list of (int, float)
+        Number of cell updates and wall time in seconds of each pass
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.method = None
+        self.cells = 0
+        self.passes = []
+
+    def start(self, method, shape):
+        """Reset the stats before a fill of a raster of shape `shape`"""
+        self.method = method
+        self.cells = shape[0] * shape[1]
+        self.passes = []
+
+    def add_pass(self, changed, seconds):
+        """Record a pass which updated `changed` cells in `seconds`"""
+        self.passes.append((int(changed), seconds))
+        if self.callback:
+            self.callback(self)
+
+    @property
+    def pass_count(self):
+        return len(self.passes)
+
+    @property
+    def cells_changed(self):
+        return sum(changed for changed, _ in self.passes)
+
+    @property
+    def seconds(self):
+        return sum(seconds for _, seconds in self.passes)
+
+    @property
+    def cells_per_second(self):
+        """Raster cells filled per second"""
+        seconds = self.seconds
+        return self.cells / seconds if seconds > 0 else float('inf')
+
+    def __str__(self):
+        return "{} fill of {} cells: {} passes, {} cell updates, {:.2f}s, {:.0f} cells/s".format(
+            self.method, self.cells, self.pass_count, self.cells_changed, self.seconds, self.cells_per_second)
+
+
+def _timed_pass(stats, func, *args):
+    # Run one pass of a fill and record it in stats. Returns the number of cell updates
+    start = time.perf_counter()
+    changed = func(*args)
+    if stats is not None:
+        stats.add_pass(changed, time.perf_counter() - start)
+    return changed
 
 
 def _fill_cell(dtm, filled, row, col):
@@ -62,18 +156,6 @@ def _fill_cell(dtm, filled, row, col):
         return False
 
 
-def _fill_terrain_no_flats(dtm, filled, fromrow, torow, fromcol, tocol, short, diag):
-    rowstep = 1 if torow > fromrow else -1
-    colstep = 1 if tocol > fromcol else -1
-
-    changed_something = False
-    for r in range(fromrow, torow + rowstep, rowstep):
-        for c in range(fromcol, tocol + colstep, colstep):
-            if _fill_cell_no_flats(dtm, filled, r, c, short, diag):
-                changed_something = True
-    return changed_something
-
-
 def _fill_cell_no_flats(dtm, filled, row, col, short, diag):
     filled_value = filled[row, col]
     dtm_value = filled.dtype.type(dtm[row, col])
@@ -99,6 +181,454 @@ def _fill_cell_no_flats(dtm, filled, row, col, short, diag):
         return False
 
 
+def _block_order(num_blocks, step):
+    return range(num_blocks) if step > 0 else range(num_blocks - 1, -1, -1)
+
+
+def _block_cells(block, block_size, size, step):
+    # Interior cells of a block in sweep order
+    first = 1 + block * block_size
+    last = min(first + block_size, size - 1) - 1
+    return range(first, last + 1) if step > 0 else range(last, first - 1, -1)
+
+
+def _mark_dirty_block(dirty, bi, bj):
+    # Changes in a block may allow changes in the block itself and in its neighbor blocks
+    dirty[max(bi - 1, 0):bi + 2, max(bj - 1, 0):bj + 2] = 1
+
+
+def _fill_blocks(dtm, filled, dirty, block_size, rowstep, colstep):
+    """Sweep the dirty blocks of the raster interior in one direction.
+
+    `dirty` holds a flag for each block of block_size x block_size interior cells. The flag of a block is cleared when
+    the block is swept. Blocks where a cell changed are flagged again along with their neighbor blocks.
+
+    Returns the number of changed cells.
+    """
+    rows, cols = dtm.shape
+    brows, bcols = dirty.shape
+    total = 0
+    for bi in _block_order(brows, rowstep):
+        for bj in _block_order(bcols, colstep):
+            if not dirty[bi, bj]:
+                continue
+            dirty[bi, bj] = 0
+            changes = 0
+            for r in _block_cells(bi, block_size, rows, rowstep):
+                for c in _block_cells(bj, block_size, cols, colstep):
+                    if _fill_cell(dtm, filled, r, c):
+                        changes += 1
+            if changes:
+                total += changes
+                _mark_dirty_block(dirty, bi, bj)
+    return total
+
+
+def _fill_blocks_no_flats(dtm, filled, dirty, block_size, rowstep, colstep, short, diag):
+    """Like `_fill_blocks` but without flats."""
+    rows, cols = dtm.shape
+    brows, bcols = dirty.shape
+    total = 0
+    for bi in _block_order(brows, rowstep):
+        for bj in _block_order(bcols, colstep):
+            if not dirty[bi, bj]:
+                continue
+            dirty[bi, bj] = 0
+            changes = 0
+            for r in _block_cells(bi, block_size, rows, rowstep):
+                for c in _block_cells(bj, block_size, cols, colstep):
+                    if _fill_cell_no_flats(dtm, filled, r, c, short, diag):
+                        changes += 1
+            if changes:
+                total += changes
+                _mark_dirty_block(dirty, bi, bj)
+    return total
+
+
+def _priority_flood(dtm, filled):
+    """Fill depressions by flooding inwards from the raster edge.
+
+    Edge cells are seeded in a min-heap. Each cell is finalized the first time it is reached, in order of increasing
+    filled elevation, so every cell is visited exactly once.
+
+    Returns the number of cell updates.
+    """
+    rows, cols = dtm.shape
+    updates = 0
+    closed = np.zeros(dtm.shape, dtype=bool)
+    heap = []
+    for r, c in edge_cell_indexes(dtm.shape):
+        if not closed[r, c]:
+            closed[r, c] = True
+            heap.append((filled[r, c], r, c))
+    heapq.heapify(heap)
+
+    while heap:
+        value, r, c = heapq.heappop(heap)
+        for dr, dc in _NEIGHBOR_DELTAS:
+            nr = r + dr
+            nc = c + dc
+            if not (0 <= nr < rows and 0 <= nc < cols) or closed[nr, nc]:
+                continue
+            closed[nr, nc] = True
+            filled[nr, nc] = max(value, dtm[nr, nc])
+            heapq.heappush(heap, (filled[nr, nc], nr, nc))
+            updates += 1
+    return updates
+
+
+def _priority_flood_no_flats(dtm, filled, short, diag):
+    """Fill depressions and flats by flooding inwards from the raster edge.
+
+    Like `_priority_flood` but a cell must be at least `short` (edge neighbor) or `diag` (corner neighbor) higher than
+    the cell it drains to. As the minimum gradient differs between edge and corner neighbors a cell may be lowered
+    after it is first reached. Outdated heap entries are skipped when popped.
+
+    Cells are only ever lowered. Interior cells may therefore hold the result of an earlier flood instead of inf, in
+    which case only the cells affected by lowered edge cells are visited. With short and diag 0 this is the plain fill.
+
+    Returns the number of cell updates.
+    """
+    rows, cols = dtm.shape
+    updates = 0
+    heap = [(filled[r, c], r, c) for r, c in edge_cell_indexes(dtm.shape)]
+    heapq.heapify(heap)
+
+    while heap:
+        value, r, c = heapq.heappop(heap)
+        if value > filled[r, c]:
+            # Cell has been lowered since this entry was pushed
+            continue
+        for dr, dc in _NEIGHBOR_DELTAS:
+            nr = r + dr
+            nc = c + dc
+            # Edge cells keep their terrain value
+            if not (1 <= nr < rows - 1 and 1 <= nc < cols - 1):
+                continue
+            increment = diag if dr and dc else short
+            new_value = max(value + increment, filled.dtype.type(dtm[nr, nc]))
+            if new_value < filled[nr, nc]:
+                filled[nr, nc] = new_value
+                heapq.heappush(heap, (filled[nr, nc], nr, nc))
+                updates += 1
+    return updates
+
+
+def _priority_flood_fused(dtm, filled, filled_no_flats, flowdir, short, diag):
+    """Calculate filled, filled_no_flats and flow directions in one traversal.
+
+    Cells are finalized in the order of `_priority_flood_no_flats`. When a cell is finalized its flow direction is
+    calculated from the no flats surface and its filled value is taken from the lowest finalized neighbor. Filled
+    values found this way are never too low. If a neighbor finalized later shows that a value is too high it is
+    lowered afterwards in a (usually empty) correction flood.
+
+    Returns the number of cell updates.
+    """
+    rows, cols = dtm.shape
+    updates = 0
+    inf = filled.dtype.type(float('inf'))
+    heap = [(filled_no_flats[r, c], r, c) for r, c in edge_cell_indexes(dtm.shape)]
+    heapq.heapify(heap)
+    corrections = []
+
+    def is_interior(r, c):
+        return 1 <= r < rows - 1 and 1 <= c < cols - 1
+
+    while heap:
+        value, r, c = heapq.heappop(heap)
+        if value > filled_no_flats[r, c]:
+            # Cell has been lowered since this entry was pushed
+            continue
+        if is_interior(r, c):
+            # Finalize interior cell. Unfinalized neighbors are still at +inf
+            flowdir[r, c] = _steepest_direction(filled_no_flats, r, c)
+            fvalue = max(min(filled[r + dr, c + dc] for dr, dc in _NEIGHBOR_DELTAS), dtm[r, c])
+            filled[r, c] = fvalue
+            # Finalized interior neighbors which should drain through this cell
+            for dr, dc in _NEIGHBOR_DELTAS:
+                nr = r + dr
+                nc = c + dc
+                if not is_interior(nr, nc) or filled[nr, nc] == inf:
+                    continue
+                fnew_value = max(filled[r, c], dtm[nr, nc])
+                if fnew_value < filled[nr, nc]:
+                    filled[nr, nc] = fnew_value
+                    heapq.heappush(corrections, (filled[nr, nc], nr, nc))
+                    updates += 1
+        for dr, dc in _NEIGHBOR_DELTAS:
+            nr = r + dr
+            nc = c + dc
+            # Edge cells keep their terrain value
+            if not is_interior(nr, nc):
+                continue
+            increment = diag if dr and dc else short
+            new_value = max(value + increment, filled_no_flats.dtype.type(dtm[nr, nc]))
+            if new_value < filled_no_flats[nr, nc]:
+                filled_no_flats[nr, nc] = new_value
+                heapq.heappush(heap, (filled_no_flats[nr, nc], nr, nc))
+                updates += 1
+
+    # Correct filled values which were too high
+    while corrections:
+        fvalue, r, c = heapq.heappop(corrections)
+        if fvalue > filled[r, c]:
+            continue
+        for dr, dc in _NEIGHBOR_DELTAS:
+            nr = r + dr
+            nc = c + dc
+            if not is_interior(nr, nc):
+                continue
+            fnew_value = max(fvalue, dtm[nr, nc])
+            if fnew_value < filled[nr, nc]:
+                filled[nr, nc] = fnew_value
+                heapq.heappush(corrections, (filled[nr, nc], nr, nc))
+                updates += 1
+    return updates
+
+
+def _reconstruction_fill(dtm, filled, short=0, diag=0):
+    """Fill depressions by grey-scale morphological reconstruction by erosion.
+
+    Vectorized alternative to `_priority_flood` and `_priority_flood_no_flats` with the same output. Interior cells are
+    eroded by a 3x3 structuring element holding the minimum elevation differences and raised to the DEM until nothing
+    changes. Erosion is done in line scans down, up, right and left over the raster, where each line is eroded by the
+    line before it as a whole. Changes are carried across the raster in a single scan instead of one cell per
+    iteration. A line is only eroded again when the line before it changed since its last erosion in the same scan
+    direction.
+
+    Like `_priority_flood_no_flats` cells are only ever lowered, and edge cells keep their value.
+
+    Returns the number of cell updates.
+    """
+    rows, cols = dtm.shape
+    if rows < 3 or cols < 3:
+        return 0
+    # Minimum elevation differences are added in double precision like the flood
+    dtype = np.float64 if short or diag else filled.dtype
+    updates = 0
+    # Erosion counter. Holds the last change of each row and column and the last erosion of each line in each scan
+    count = 1
+    last_change = (np.ones(rows, dtype=np.int64), np.ones(cols, dtype=np.int64))
+    last_erosion = dict(((axis, step), np.zeros(n, dtype=np.int64))
+                        for axis, n in ((0, rows), (1, cols)) for step in (1, -1))
+    # Columns are scanned in contiguous transposed copies
+    transposed_dtm = np.ascontiguousarray(dtm.T)
+    changed = True
+    while changed:
+        changed = False
+        for axis in (0, 1):
+            lines, floor = (filled, dtm) if axis == 0 else (np.ascontiguousarray(filled.T), transposed_dtm)
+            line_change, cross_change = last_change[axis], last_change[1 - axis]
+            n = lines.shape[0]
+            for step in (1, -1):
+                eroded = last_erosion[axis, step]
+                for i in (range(1, n - 1) if step > 0 else range(n - 2, 0, -1)):
+                    if line_change[i - step] <= eroded[i]:
+                        continue
+                    count += 1
+                    eroded[i] = count
+                    before = lines[i - step].astype(dtype, copy=False)
+                    new_values = np.minimum(before[:-2], before[2:])
+                    new_values += diag
+                    np.minimum(new_values, before[1:-1] + short, out=new_values)
+                    np.maximum(new_values, floor[i, 1:-1], out=new_values)
+                    new_values = new_values.astype(filled.dtype, copy=False)
+                    line = lines[i, 1:-1]
+                    lower = (new_values < line).nonzero()[0]
+                    if len(lower):
+                        line[lower] = new_values[lower]
+                        updates += len(lower)
+                        line_change[i] = count
+                        cross_change[lower + 1] = count
+                        changed = True
+            if axis == 1:
+                filled[:, :] = lines.T
+    return updates
+
+
+def _reconstruction_fill_fused(dtm, filled, filled_no_flats, flowdir, short, diag):
+    """Vectorized alternative to `_priority_flood_fused` with the same output. Returns the number of cell updates."""
+    updates = _reconstruction_fill(dtm, filled)
+    updates += _reconstruction_fill(dtm, filled_no_flats, short, diag)
+    flowdir[:, :] = terrain_flowdirection(filled_no_flats, edges_flow_outward=False)
+    return updates
+
+
+def _steepest_direction(terrain, row, col):
+    """D8 flow direction from interior cell. Same as `flow._terrain_flow` for a single cell."""
+    z = terrain[row, col]
+    direction = FLOWDIR_NODIR
+    dzmax = 0.0
+    for i, (dr, dc) in enumerate(_NEIGHBOR_DELTAS):
+        if dr and dc:
+            dz = (z - terrain[row + dr, col + dc]) / SQRT2
+        else:
+            dz = (z - terrain[row + dr, col + dc])
+        if dz > dzmax:
+            dzmax = dz
+            direction = i
+    return direction
+
+
+def _invalidate_supported(filled, window, short, diag):
+    """Find the cells whose filled value may depend on the cells in a window.
+
+    A cell m supports its neighbor n if `filled[m] + increment <= filled[n]`. A cell is invalid when all the cells
+    supporting it are invalid. Neighbors supporting each other (equal values when the increment is 0) are grouped, and
+    a group is invalid when it has no valid support from outside the group. Cells in the window are invalid. Other raster
+    edge cells keep their terrain value and are always valid.
+
+    Returns
+    -------
+    invalid : dict
+        Invalid cells (row, col)
+    """
+    rows, cols = filled.shape
+    row, col, nrows, ncols = window
+    # Invalid cells and the order in which they became invalid
+    invalid = {}
+    queue = deque()
+    group_of = {}
+    groups = []
+    valid_supports = []
+    # Number of invalid cells when each group was created. Supports are counted when the group is created, so only
+    # cells which become invalid later are subtracted
+    group_created = []
+
+    def is_interior(r, c):
+        return 0 < r < rows - 1 and 0 < c < cols - 1
+
+    def invalidate(cell):
+        invalid[cell] = len(invalid)
+        queue.append(cell)
+
+    def create_group(cell):
+        gid = len(groups)
+        group_of[cell] = gid
+        members = [cell]
+        stack = [cell]
+        while stack:
+            r, c = stack.pop()
+            for dr, dc in _NEIGHBOR_DELTAS:
+                q = (r + dr, c + dc)
+                if not is_interior(*q) or q in invalid or q in group_of:
+                    continue
+                increment = diag if dr and dc else short
+                if filled[q] + increment <= filled[r, c] and filled[r, c] + increment <= filled[q]:
+                    group_of[q] = gid
+                    members.append(q)
+                    stack.append(q)
+        count = 0
+        for r, c in members:
+            for dr, dc in _NEIGHBOR_DELTAS:
+                m = (r + dr, c + dc)
+                if not cell_in_raster(filled.shape, m) or m in invalid or group_of.get(m) == gid:
+                    continue
+                increment = diag if dr and dc else short
+                if filled[m] + increment <= filled[r, c]:
+                    count += 1
+        groups.append(members)
+        valid_supports.append(count)
+        group_created.append(len(invalid))
+        return gid
+
+    for r in range(row, row + nrows):
+        for c in range(col, col + ncols):
+            invalidate((r, c))
+
+    while queue:
+        r, c = queue.popleft()
+        for dr, dc in _NEIGHBOR_DELTAS:
+            n = (r + dr, c + dc)
+            if not is_interior(*n) or n in invalid:
+                continue
+            increment = diag if dr and dc else short
+            if not filled[r, c] + increment <= filled[n]:
+                continue
+            gid = group_of.get(n)
+            if gid is None:
+                gid = create_group(n)
+            elif invalid[(r, c)] >= group_created[gid]:
+                valid_supports[gid] -= 1
+            if valid_supports[gid] == 0:
+                for q in groups[gid]:
+                    invalidate(q)
+    return invalid
+
+
+def _lower_from(dtm, filled, seeds, short, diag):
+    """Lower cells by flooding from seed cells.
+
+    Like `_priority_flood_no_flats` but the flood starts from the cells with the flat indexes in `seeds`. Cells are only
+    lowered.
+
+    Returns
+    -------
+    window : (int, int, int, int)
+        (min row, min col, max row, max col) of the lowered cells. None if no cell was lowered
+    """
+    rows, cols = dtm.shape
+    heap = [(filled[i // cols, i % cols], i // cols, i % cols) for i in seeds]
+    heapq.heapify(heap)
+    bounds = None
+    while heap:
+        value, r, c = heapq.heappop(heap)
+        if value > filled[r, c]:
+            # Cell has been lowered since this entry was pushed
+            continue
+        for dr, dc in _NEIGHBOR_DELTAS:
+            nr = r + dr
+            nc = c + dc
+            # Edge cells keep their terrain value
+            if not (1 <= nr < rows - 1 and 1 <= nc < cols - 1):
+                continue
+            increment = diag if dr and dc else short
+            new_value = max(value + increment, filled.dtype.type(dtm[nr, nc]))
+            if new_value < filled[nr, nc]:
+                filled[nr, nc] = new_value
+                heapq.heappush(heap, (filled[nr, nc], nr, nc))
+                if bounds is None:
+                    bounds = [nr, nc, nr, nc]
+                else:
+                    bounds = [min(bounds[0], nr), min(bounds[1], nc), max(bounds[2], nr), max(bounds[3], nc)]
+    return tuple(bounds) if bounds else None
+
+
+def _refill(dtm, filled, window, short, diag):
+    """Update filled values after the DEM was changed inside a window.
+
+    Cells which may depend on the window are reset and flooded again from the valid cells around them. The flood also
+    lowers valid cells which drain through the window after the change.
+
+    Returns
+    -------
+    window : (int, int, int, int)
+        (min row, min col, max row, max col) of the recalculated cells
+    """
+    rows, cols = dtm.shape
+    invalid = _invalidate_supported(filled, window, short, diag)
+    seeds = set()
+    for r, c in invalid:
+        if 0 < r < rows - 1 and 0 < c < cols - 1:
+            filled[r, c] = float('inf')
+        else:
+            filled[r, c] = dtm[r, c]
+            seeds.add(r * cols + c)
+    for r, c in invalid:
+        for dr, dc in _NEIGHBOR_DELTAS:
+            m = (r + dr, c + dc)
+            if cell_in_raster(dtm.shape, m) and m not in invalid:
+                seeds.add(m[0] * cols + m[1])
+    lowered = _lower_from(dtm, filled, sorted(seeds), short, diag)
+    invalid_rows = [r for r, c in invalid]
+    invalid_cols = [c for r, c in invalid]
+    bounds = [min(invalid_rows), min(invalid_cols), max(invalid_rows), max(invalid_cols)]
+    if lowered:
+        bounds = [min(bounds[0], lowered[0]), min(bounds[1], lowered[1]),
+                  max(bounds[2], lowered[2]), max(bounds[3], lowered[3])]
+    return tuple(bounds)
+
+
 def _initialize_filled(dtm, dtype):
     filled = np.empty_like(dtm, dtype=dtype)  # Create np array of same dimension and right type
     filled.fill(float('inf'))  # Initialize to inf
@@ -109,7 +639,28 @@ def _initialize_filled(dtm, dtype):
     return filled
 
 
-def fill_terrain(dtm):
+def _dirty_blocks(shape, block_size):
+    grid = tile_grid_shape((max(shape[0] - 2, 0), max(shape[1] - 2, 0)), (block_size, block_size))
+    return np.ones(grid, dtype=np.uint8)
+
+
+def _sweep_fill_terrain(dtm, filled, block_size=SWEEP_BLOCK_SIZE, stats=None):
+    # Sweep in alternating directions until no block is dirty. Only blocks which changed, or which are next to a block
+    # which changed, are swept again.
+    dirty = _dirty_blocks(dtm.shape, block_size)
+    while dirty.any():
+        for rowstep, colstep in _SWEEP_DIRECTIONS:
+            _timed_pass(stats, _fill_blocks, dtm, filled, dirty, block_size, rowstep, colstep)
+
+
+def _check_workers(method, workers):
+    if workers < 1:
+        raise ValueError("Number of workers must be at least 1: {}".format(workers))
+    if workers > 1 and method != FILL_METHOD_PRIORITY_FLOOD:
+        raise ValueError("Fill method {} does not support more than one worker".format(method))
+
+
+def fill_terrain(dtm, method=FILL_METHOD_PRIORITY_FLOOD, workers=1, stats=None):
     """Fill terrain model
 
     Creates a depressionless terrain model. In a depressionless terrain model each cell will have at least one
@@ -124,6 +675,14 @@ def fill_terrain(dtm):
     Parameters
     ----------
     dtm : 2D numpy array
+    method : str
+        Fill algorithm. Either FILL_METHOD_PRIORITY_FLOOD (default) which visits each cell once, or FILL_METHOD_SWEEP
+        which sweeps the changing parts of the raster repeatedly until nothing changes. Both methods give identical output.
+    workers : int
+        Number of threads. With more than one worker the DEM is split into tiles which are filled in parallel. The
+        output is the same for any number of workers. Only supported by FILL_METHOD_PRIORITY_FLOOD.
+    stats : FillStats, optional
+        Records passes, cell updates and timing of the fill
 
     Returns
     -------
@@ -131,47 +690,29 @@ def fill_terrain(dtm):
         Depressionless DEM
 
     """
+    _check_workers(method, workers)
+    if method not in (FILL_METHOD_PRIORITY_FLOOD, FILL_METHOD_SWEEP):
+        raise ValueError("Unknown fill method: {}".format(method))
+    if stats is not None:
+        stats.start(method, dtm.shape)
+    if workers > 1:
+        return _fill_parallel(dtm, DTYPE_FILL, 0, 0, workers, stats)
     filled = _initialize_filled(dtm, DTYPE_FILL)
+    if method == FILL_METHOD_PRIORITY_FLOOD:
+        _timed_pass(stats, _priority_flood, dtm, filled)
+    else:
+        _sweep_fill_terrain(dtm, filled, stats=stats)
+    return filled
 
-    keep_going = True
-    iteration = 1
-
-    while keep_going:
-        keep_going = True
-        iteration = iteration + 1
-
-        # Exclude edges
-        maxrow = dtm.shape[0] - 2
-        maxcol = dtm.shape[1] - 2
-
-        # UL
-        if keep_going and _fill_terrain(dtm, filled, 1, maxrow, 1, maxcol):
-            keep_going = True
-        else:
-            keep_going = False
-
-        # LR
-        if keep_going and _fill_terrain(dtm, filled, maxrow, 1, maxcol, 1):
-            keep_going = True
-        else:
-            keep_going = False
-
-        # UR
-        if keep_going and _fill_terrain(dtm, filled, 1, maxrow, maxcol, 1):
-            keep_going = True
-        else:
-            keep_going = False
-
-        # LL
-        if keep_going and _fill_terrain(dtm, filled, maxrow, 1, 1, maxcol):
-            keep_going = True
-        else:
-            keep_going = False
 
-    return filled
+def _sweep_fill_terrain_no_flats(dtm, filled, short, diag, block_size=SWEEP_BLOCK_SIZE, stats=None):
+    dirty = _dirty_blocks(dtm.shape, block_size)
+    while dirty.any():
+        for rowstep, colstep in _SWEEP_DIRECTIONS:
+            _timed_pass(stats, _fill_blocks_no_flats, dtm, filled, dirty, block_size, rowstep, colstep, short, diag)
 
 
-def fill_terrain_no_flats(dtm, short=0, diag=0):
+def fill_terrain_no_flats(dtm, short=0, diag=0, method=FILL_METHOD_PRIORITY_FLOOD, workers=1, stats=None):
     """Fill terrain and do not allow flat areas in output
 
     Creates a depressionless terrain model with the additional property that each cell must have at least one
@@ -187,49 +728,563 @@ def fill_terrain_no_flats(dtm, short=0, diag=0):
         Minimum output elevation difference between cells sharing an edge. Unit [m]
     diag : float
         Minimum output elevation difference between cells sharing a corner. Unit [m]
+    method : str
+        Fill algorithm. Either FILL_METHOD_PRIORITY_FLOOD (default) which applies the minimum elevation differences
+        while flooding in one heap ordered pass, or FILL_METHOD_SWEEP which sweeps the changing parts of the raster
+        repeatedly until nothing changes. Both methods give identical output.
+    workers : int
+        Number of threads. With more than one worker the DEM is split into tiles which are filled in parallel. The
+        output is the same for any number of workers. Only supported by FILL_METHOD_PRIORITY_FLOOD.
+    stats : FillStats, optional
+        Records passes, cell updates and timing of the fill
 
     Returns
     -------
+    filled : 2D numpy array
+        Depressionless DEM without flats
 
     """
+    _check_workers(method, workers)
+    if method not in (FILL_METHOD_PRIORITY_FLOOD, FILL_METHOD_SWEEP):
+        raise ValueError("Unknown fill method: {}".format(method))
+    if stats is not None:
+        stats.start(method, dtm.shape)
+    if workers > 1:
+        return _fill_parallel(dtm, DTYPE_FILLNOFLAT, short, diag, workers, stats)
     filled = _initialize_filled(dtm, DTYPE_FILLNOFLAT)
+    if method == FILL_METHOD_PRIORITY_FLOOD:
+        _timed_pass(stats, _priority_flood_no_flats, dtm, filled, short, diag)
+    else:
+        _sweep_fill_terrain_no_flats(dtm, filled, short, diag, stats=stats)
+    return filled
 
-    keep_going = True
-    iteration = 1
 
-    while keep_going:
-        keep_going = True
-        iteration = iteration + 1
+def fill_terrain_fused(dtm, short=0, diag=0, edges_flow_outward=True, write_filled_no_flats=None, stats=None):
+    """Fill terrain, calculate bluespot depths and flow directions in one traversal
 
-        # Exclude edges
-        maxrow = dtm.shape[0] - 2
-        maxcol = dtm.shape[1] - 2
+    Gives the same result as `fill_terrain`, `filled - dtm` and `flow.terrain_flowdirection` on the output of
+    `fill_terrain_no_flats`, but floods the DEM only once. Flow directions are calculated as cells are finalized, so
+    the no flats surface is released before returning. Pass `write_filled_no_flats` to get it without flooding the DEM
+    again with `fill_terrain_no_flats`.
 
-        # UL
-        if keep_going and _fill_terrain_no_flats(dtm, filled, 1, maxrow, 1, maxcol, short, diag):
-            keep_going = True
-        else:
-            keep_going = False
+    While flooding the float64 no flats surface is held next to the filled DEM and the flow directions. Together with
+    the DEM this peaks at about 17 bytes per cell. Running `fill_terrain`, `fill_terrain_no_flats` and
+    `flow.terrain_flowdirection` one after the other and releasing each output once used peaks at about 13 bytes per
+    cell but floods the DEM twice.
+
+    Parameters
+    ----------
+    dtm : 2D numpy array
+        DEM
+    short : float
+        Minimum elevation difference between cells sharing an edge used for flow directions. Unit [m]
+    diag : float
+        Minimum elevation difference between cells sharing a corner used for flow directions. Unit [m]
+    edges_flow_outward : bool
+        If True edge cells are forced to run directly off the raster. If False edge cells will
+        be assigned 'NO DIRECTION'
+    write_filled_no_flats : callable, optional
+        Called as `write_filled_no_flats(filled_no_flats)` with the output of `fill_terrain_no_flats` before it is
+        released
+    stats : FillStats, optional
+        Records passes, cell updates and timing of the fill
+
+    Returns
+    -------
+    filled : 2D numpy array
+        Depressionless DEM
+    depths : 2D numpy array
+        Bluespot depths (filled - dtm)
+    flowdir : 2D numpy array
+        Flow directions calculated on the depressionless DEM without flats
+
+    """
+    filled = _initialize_filled(dtm, DTYPE_FILL)
+    filled_no_flats = _initialize_filled(dtm, DTYPE_FILLNOFLAT)
+    flowdir = np.empty(dtm.shape, dtype=DTYPE_FLOWDIR)
+    flowdir.fill(FLOWDIR_NODIR)
+    if stats is not None:
+        stats.start(FILL_METHOD_PRIORITY_FLOOD, dtm.shape)
+    _timed_pass(stats, _priority_flood_fused, dtm, filled, filled_no_flats, flowdir, short, diag)
+    if write_filled_no_flats is not None:
+        write_filled_no_flats(filled_no_flats)
+    del filled_no_flats
+    if edges_flow_outward:
+        set_edges_flow_outward(flowdir)
+    depths = filled - dtm
+    return filled, depths, flowdir
+
+
+def _check_window(shape, window):
+    row, col, nrows, ncols = window
+    if nrows < 1 or ncols < 1 or not (cell_in_raster(shape, (row, col)) and
+                                      cell_in_raster(shape, (row + nrows - 1, col + ncols - 1))):
+        raise ValueError("Window {} is not inside raster of shape {}".format(window, shape))
+
+
+def _bounds_to_window(bounds):
+    return bounds[0], bounds[1], bounds[2] - bounds[0] + 1, bounds[3] - bounds[1] + 1
+
+
+def refill_terrain(dtm, filled, window):
+    """Update a filled terrain model after the DEM was edited inside a window
+
+    Only the cells whose filled value may depend on the edited cells are recalculated together with the cells which
+    drain through the window after the edit. The result is the same as `fill_terrain` on the edited DEM.
+
+    Parameters
+    ----------
+    dtm : 2D numpy array
+        Edited DEM. Must only differ from the DEM used for `filled` inside the window
+    filled : 2D numpy array
+        Output of `fill_terrain` on the DEM before the edit. Updated in place
+    window : (int, int, int, int)
+        Edited cells (row, col, nrows, ncols)
+
+    Returns
+    -------
+    window : (int, int, int, int)
+        Window (row, col, nrows, ncols) containing all recalculated cells
+
+    """
+    _check_window(dtm.shape, window)
+    return _bounds_to_window(_refill(dtm, filled, window, 0, 0))
+
+
+def refill_terrain_no_flats(dtm, filled, window, short=0, diag=0):
+    """Update a terrain model filled without flats after the DEM was edited inside a window
+
+    Like `refill_terrain` but updates the output of `fill_terrain_no_flats`. The result is the same as
+    `fill_terrain_no_flats` on the edited DEM.
+
+    Parameters
+    ----------
+    dtm : 2D numpy array
+        Edited DEM. Must only differ from the DEM used for `filled` inside the window
+    filled : 2D numpy array
+        Output of `fill_terrain_no_flats` on the DEM before the edit. Updated in place
+    window : (int, int, int, int)
+        Edited cells (row, col, nrows, ncols)
+    short : float
+        Minimum output elevation difference between cells sharing an edge. Must be the value used for `filled`
+    diag : float
+        Minimum output elevation difference between cells sharing a corner. Must be the value used for `filled`
+
+    Returns
+    -------
+    window : (int, int, int, int)
+        Window (row, col, nrows, ncols) containing all recalculated cells
+
+    """
+    _check_window(dtm.shape, window)
+    return _bounds_to_window(_refill(dtm, filled, window, short, diag))
 
-        # LR
-        if keep_going and _fill_terrain_no_flats(dtm, filled, maxrow, 1, maxcol, 1, short, diag):
-            keep_going = True
-        else:
-            keep_going = False
 
-        # UR
-        if keep_going and _fill_terrain_no_flats(dtm, filled, 1, maxrow, maxcol, 1, short, diag):
-            keep_going = True
+def _padded_tile(borders, grid, tile, window, dtype):
+    """Tile padded with a one cell frame holding the border values of the neighbor tiles.
+
+    Tile cells are initialized to inf. Frame cells outside the raster are -inf, which makes the raster edge cells keep
+    their terrain value.
+    """
+    padded = np.empty((window[2] + 2, window[3] + 2), dtype=dtype)
+    padded.fill(float('inf'))
+    for (dr, dc), frame, border, cells in _TILE_HALO:
+        neighbor = (tile[0] + dr, tile[1] + dc)
+        if not cell_in_raster(grid, neighbor):
+            padded[frame] = float('-inf')
         else:
-            keep_going = False
+            padded[frame] = borders[neighbor][border][cells]
+    return padded
+
+
+def _tile_borders(padded):
+    tile = padded[1:-1, 1:-1]
+    return tile[0, :].copy(), tile[-1, :].copy(), tile[:, 0].copy(), tile[:, -1].copy()
+
+
+def _tile_ring(nrows, ncols):
+    # Index of each border cell of a tile among the border cells in row major order. Interior cells are -1
+    ring = np.ones((nrows, ncols), dtype=bool)
+    ring[1:-1, 1:-1] = False
+    index = np.full((nrows, ncols), -1, dtype=np.intp)
+    index[ring] = np.arange(np.count_nonzero(ring))
+    return index
+
+
+def _priority_flood_labels(dtm, filled, labels, depths):
+    """Flood a tile inwards from its edge cells and label each cell with the edge cell it is flooded from.
+
+    Like `_priority_flood` but edge cells must be labelled by the caller and interior cells must be labelled -1. An
+    interior cell gets the label of the cell it is reached from, and `depths` gets its number of steps from the edge
+    cell of its label.
+
+    Returns the number of cell updates.
+    """
+    rows, cols = dtm.shape
+    updates = 0
+    heap = []
+    for r, c in edge_cell_indexes(dtm.shape):
+        filled[r, c] = dtm[r, c]
+        depths[r, c] = 0
+        heap.append((filled[r, c], r, c))
+    heapq.heapify(heap)
+
+    while heap:
+        value, r, c = heapq.heappop(heap)
+        for dr, dc in _NEIGHBOR_DELTAS:
+            nr = r + dr
+            nc = c + dc
+            if not (0 <= nr < rows and 0 <= nc < cols) or labels[nr, nc] >= 0:
+                continue
+            labels[nr, nc] = labels[r, c]
+            depths[nr, nc] = depths[r, c] + 1
+            filled[nr, nc] = max(value, dtm[nr, nc])
+            heapq.heappush(heap, (filled[nr, nc], nr, nc))
+            updates += 1
+    return updates
+
+
+def _spill_edges(source, target, level, increment):
+    # Edges in both directions, keeping the lowest level and then the lowest increment between two labels
+    source, target = np.concatenate((source, target)), np.concatenate((target, source))
+    level = np.concatenate((level, level))
+    increment = np.concatenate((increment, increment))
+    order = np.lexsort((increment, level, target, source))
+    source, target, level, increment = source[order], target[order], level[order], increment[order]
+    first = np.ones(len(source), dtype=bool)
+    first[1:] = (source[1:] != source[:-1]) | (target[1:] != target[:-1])
+    return source[first], target[first], level[first], increment[first]
+
+
+def _tile_spill_edges(labels, filled, depths, short, diag):
+    """Spill graph edges between the labels of a tile flooded by `_priority_flood_labels`.
+
+    Where two labels meet their edge cells are connected by a path which is nowhere higher than the higher filled value
+    of the two meeting cells. This is the level of the edge. Edge cells next to each other are connected directly and
+    the increment of the edge is `short` or `diag`. Otherwise the minimum elevation differences along the path are
+    bounded by its length times `diag`.
+
+    Returns
+    -------
+    edges : tuple of 1D numpy arrays
+        Source label, target label, level and increment of each edge
+    """
+    rows, cols = labels.shape
+    parts = []
+    for dr, dc in _NEIGHBOR_DELTAS[2:6]:
+        cells = (slice(0, rows - dr), slice(max(-dc, 0), cols - max(dc, 0)))
+        neighbors = (slice(dr, rows), slice(max(dc, 0), cols + min(dc, 0)))
+        meet = labels[cells] != labels[neighbors]
+        level = np.maximum(filled[cells][meet], filled[neighbors][meet]).astype(np.float64)
+        steps = depths[cells][meet] + depths[neighbors][meet] + 1
+        increment = steps * diag
+        adjacent = steps == 1
+        level[adjacent] = float('-inf')
+        increment[adjacent] = diag if dr and dc else short
+        parts.append((labels[cells][meet], labels[neighbors][meet], level, increment.astype(np.float64)))
+    return _spill_edges(*(np.concatenate(part) for part in zip(*parts)))
+
+
+def _seam_spill_edges(label_borders, grid, short, diag):
+    """Spill graph edges between the edge cells of neighbor tiles. Returns a list of edge arrays like
+    `_tile_spill_edges`"""
+    edges = []
+    for (i, j), (top, bottom, left, right) in label_borders.items():
+        pairs = []
+        if j + 1 < grid[1]:
+            neighbor = label_borders[i, j + 1][2]
+            pairs += [(right, neighbor, short), (right[:-1], neighbor[1:], diag), (right[1:], neighbor[:-1], diag)]
+        if i + 1 < grid[0]:
+            neighbor = label_borders[i + 1, j][0]
+            pairs += [(bottom, neighbor, short), (bottom[:-1], neighbor[1:], diag), (bottom[1:], neighbor[:-1], diag)]
+            if j + 1 < grid[1]:
+                pairs.append((bottom[-1:], label_borders[i + 1, j + 1][0][:1], diag))
+            if j > 0:
+                pairs.append((bottom[:1], label_borders[i + 1, j - 1][0][-1:], diag))
+        for source, target, increment in pairs:
+            level = np.full(len(source), float('-inf'))
+            edges.append(_spill_edges(source, target, level, np.full(len(source), increment, dtype=np.float64)))
+    return edges
+
+
+def _flood_spill_graph(offsets, targets, levels, increments, terrain, values):
+    """Flood the spill graph from the labels which hold a value.
+
+    The edges of label `i` are `offsets[i]` to `offsets[i + 1]`. A label reached over an edge gets the higher of the
+    edge level and the value of the label it is reached from plus the increment of the edge, and at least its terrain
+    value. Like `_priority_flood_no_flats` labels are only ever lowered and outdated heap entries are skipped.
+
+    Returns the number of label updates.
+    """
+    updates = 0
+    heap = [(values[i], i) for i in np.flatnonzero(values < float('inf')).tolist()]
+    heapq.heapify(heap)
+
+    while heap:
+        value, i = heapq.heappop(heap)
+        if value > values[i]:
+            # Label has been lowered since this entry was pushed
+            continue
+        for edge in range(offsets[i], offsets[i + 1]):
+            j = targets[edge]
+            new_value = max(max(levels[edge], value) + increments[edge], terrain[j])
+            if new_value < values[j]:
+                values[j] = new_value
+                heapq.heappush(heap, (new_value, j))
+                updates += 1
+    return updates
+
+
+def _fill_tiles(read_window, shape, tile_shape, no_flats, short, diag, stats=None):
+    """Find the final values of the cells on the borders of the tiles.
 
-        # LL
-        if keep_going and _fill_terrain_no_flats(dtm, filled, maxrow, 1, 1, maxcol, short, diag):
-            keep_going = True
+    Each tile is flooded once from its edge cells, labelling each cell with the edge cell it is flooded from. Labels
+    which meet in a tile and edge cells of neighbor tiles are connected in a spill graph, which has a node for each tile
+    edge cell only. A priority flood over the graph from the raster edge gives the final value of the tile edge cells.
+    This is the parallel priority-flood of Barnes (2016).
+
+    With short and diag 0 the values are those of `fill_terrain`. Otherwise the bound on the minimum elevation
+    differences through the interior of a tile makes sure that each tile edge cell has a lower neighbor when the tiles
+    are flooded from these values. The values are never lower than `fill_terrain` and only differ from
+    `fill_terrain_no_flats` by minimum elevation differences.
+
+    The tile floods and the graph flood are passes in `stats`. Only the graph is kept in memory.
+
+    Returns
+    -------
+    borders : dict
+        Final values (top row, bottom row, left column, right column) of the edge cells of each tile
+    """
+    grid = tile_grid_shape(shape, tile_shape)
+    rings = {}
+    label_borders = {}
+    terrain = []
+    on_raster_edge = []
+    edges = []
+    count = 0
+    start = time.perf_counter()
+    updates = 0
+    for tile in ((i, j) for i in range(grid[0]) for j in range(grid[1])):
+        row, col, nrows, ncols = window = tile_window(shape, tile_shape, tile)
+        if (nrows, ncols) not in rings:
+            rings[nrows, ncols] = _tile_ring(nrows, ncols)
+        ring = rings[nrows, ncols]
+        dtm_tile = np.asarray(read_window(*window), dtype=DTYPE_DTM)
+        labels = ring.copy()
+        filled = np.empty(dtm_tile.shape, dtype=DTYPE_FILL)
+        depths = np.zeros(dtm_tile.shape, dtype=np.intp)
+        updates += _priority_flood_labels(dtm_tile, filled, labels, depths)
+        source, target, level, increment = _tile_spill_edges(labels, filled, depths, short, diag)
+        edges.append((source + count, target + count, level, increment))
+
+        rows, cols = np.nonzero(ring >= 0)
+        terrain.append(dtm_tile[rows, cols])
+        on_raster_edge.append((rows + row == 0) | (rows + row == shape[0] - 1) |
+                              (cols + col == 0) | (cols + col == shape[1] - 1))
+        label_borders[tile] = (ring[0, :] + count, ring[-1, :] + count, ring[:, 0] + count, ring[:, -1] + count)
+        count += len(rows)
+    if stats is not None:
+        stats.add_pass(updates, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    edges += _seam_spill_edges(label_borders, grid, short, diag)
+    source, target, level, increment = (np.concatenate(part) for part in zip(*edges))
+    order = np.argsort(source, kind='stable')
+    offsets = np.zeros(count + 1, dtype=np.intp)
+    np.cumsum(np.bincount(source, minlength=count), out=offsets[1:])
+    terrain = np.concatenate(terrain).astype(np.float64)
+    on_raster_edge = np.concatenate(on_raster_edge)
+    values = np.full(count, float('inf'))
+    # Raster edge cells keep their terrain value
+    values[on_raster_edge] = terrain[on_raster_edge]
+    updates = _flood_spill_graph(offsets, target[order], level[order], increment[order], terrain, values)
+    if stats is not None:
+        stats.add_pass(updates, time.perf_counter() - start)
+
+    dtype = DTYPE_FILLNOFLAT if no_flats else DTYPE_FILL
+    values = values.astype(dtype)
+    return dict((tile, tuple(values[labels] for labels in borders)) for tile, borders in label_borders.items())
+
+
+def _finalized_tiles(read_window, shape, tile_shape, borders, no_flats, short, diag, stats=None):
+    """Flood each tile from the final values of its edge cells.
+
+    Yields the window and the padded tile of each tile in turn. The frame of the padded tile holds the edge cells of
+    the neighbor tiles. The tile floods are a pass in `stats`.
+    """
+    grid = tile_grid_shape(shape, tile_shape)
+    dtype = DTYPE_FILLNOFLAT if no_flats else DTYPE_FILL
+    seconds = 0
+    updates = 0
+    for tile in sorted(borders):
+        window = tile_window(shape, tile_shape, tile)
+        dtm_tile = np.asarray(read_window(*window), dtype=DTYPE_DTM)
+        start = time.perf_counter()
+        padded = _padded_tile(borders, grid, tile, window, dtype)
+        filled = padded[1:-1, 1:-1]
+        filled[0, :], filled[-1, :], filled[:, 0], filled[:, -1] = borders[tile]
+        if no_flats:
+            updates += _priority_flood_no_flats(dtm_tile, filled, short, diag)
         else:
-            keep_going = False
+            updates += _priority_flood(dtm_tile, filled)
+        seconds += time.perf_counter() - start
+        yield window, padded
+    if stats is not None:
+        stats.add_pass(updates, seconds)
 
-    return filled
+
+def _parallel_tile_shape(shape, workers):
+    # Aim for several tiles of each checkerboard color per worker
+    side = int(np.ceil(np.sqrt(shape[0] * shape[1] / (16.0 * workers))))
+    side = max(side, PARALLEL_MIN_TILE_SIZE)
+    return (side, side)
+
+
+def _fill_parallel(dtm, dtype, short, diag, workers, stats=None):
+    """Fill tiles of the DEM in parallel.
+
+    Tiles are flooded in place in a copy of the raster padded with a -inf frame, which makes the raster edge cells keep
+    their terrain value. A tile is flooded from the current values of the cells around it and only lowers cells, so
+    flooding a tile again only visits the cells which change. When the border of a tile is lowered its neighbors are
+    flooded again. This stops when nothing changes.
+
+    Tiles are flooded in four alternating checkerboard colors. Tiles of the same color are not neighbors, so their
+    floods do not share any cells and are run by `workers` threads at a time. Each round over the four colors is a
+    pass in `stats`.
+    """
+    rows, cols = dtm.shape
+    work = np.empty((rows + 2, cols + 2), dtype=dtype)
+    work.fill(float('inf'))
+    work[0, :] = work[rows + 1, :] = work[:, 0] = work[:, cols + 1] = float('-inf')
+
+    tile_shape = _parallel_tile_shape(dtm.shape, workers)
+    grid = tile_grid_shape(dtm.shape, tile_shape)
+    tiles = [(i, j) for i in range(grid[0]) for j in range(grid[1])]
+    colors = [[tile for tile in tiles if (tile[0] % 2, tile[1] % 2) == color]
+              for color in ((0, 0), (0, 1), (1, 1), (1, 0))]
+    dirty = set(tiles)
+
+    def flood(tile):
+        row, col, nrows, ncols = tile_window(dtm.shape, tile_shape, tile)
+        padded = work[row:row + nrows + 2, col:col + ncols + 2]
+        padded_dtm = np.zeros(padded.shape, dtype=DTYPE_DTM)
+        padded_dtm[1:-1, 1:-1] = dtm[row:row + nrows, col:col + ncols]
+        old_borders = _tile_borders(padded)
+        updates = _priority_flood_no_flats(padded_dtm, padded, short, diag)
+        changed = not all(np.array_equal(old, new, equal_nan=True)
+                          for old, new in zip(old_borders, _tile_borders(padded)))
+        return tile, changed, updates
+
+    pool = ThreadPool(workers)
+    try:
+        while dirty:
+            start = time.perf_counter()
+            updates = 0
+            for color in colors:
+                batch = [tile for tile in color if tile in dirty]
+                dirty.difference_update(batch)
+                for tile, changed, tile_updates in pool.map(flood, batch):
+                    updates += tile_updates
+                    if not changed:
+                        continue
+                    for dr, dc in _NEIGHBOR_DELTAS:
+                        neighbor = (tile[0] + dr, tile[1] + dc)
+                        if cell_in_raster(grid, neighbor):
+                            dirty.add(neighbor)
+            if stats is not None:
+                stats.add_pass(updates, time.perf_counter() - start)
+            # Alternate sweep direction to carry changes across the raster in both directions
+            colors.reverse()
+            for color in colors:
+                color.reverse()
+    finally:
+        pool.close()
+        pool.join()
+    return work[1:rows + 1, 1:cols + 1].copy()
+
+
+def fill_terrain_tiled(read_window, write_window, shape, tile_shape=DEFAULT_TILE_SHAPE, stats=None):
+    """Fill terrain model one tile at a time
+
+    Gives the same result as `fill_terrain` but only holds one tile and a graph of the tile borders in memory. This
+    makes it possible to fill rasters which are larger than the available memory. Each tile is read and flooded twice:
+    Once to find the final values of the tile borders and once to fill the tile from them.
+
+    Parameters
+    ----------
+    read_window : callable
+        Called as `read_window(row, col, nrows, ncols)`. Must return the DEM values of the window as 2D numpy array
+    write_window : callable
+        Called as `write_window(data, row, col)` once for each tile with the filled values of the tile
+    shape : (int, int)
+        Shape of the DEM (rows, cols)
+    tile_shape : (int, int)
+        Shape of the tiles (rows, cols)
+    stats : FillStats, optional
+        Records passes, cell updates and timing of the fill
+
+    Returns
+    -------
+    None
+
+    """
+    if stats is not None:
+        stats.start(FILL_METHOD_PRIORITY_FLOOD, shape)
+    borders = _fill_tiles(read_window, shape, tile_shape, False, 0, 0, stats)
+    for window, padded in _finalized_tiles(read_window, shape, tile_shape, borders, False, 0, 0, stats):
+        write_window(np.ascontiguousarray(padded[1:-1, 1:-1]), window[0], window[1])
+
+
+def fill_terrain_no_flats_tiled(read_window, write_window, shape, short=0, diag=0, tile_shape=DEFAULT_TILE_SHAPE,
+                                write_flowdir_window=None, edges_flow_outward=True, stats=None):
+    """Fill terrain without flats one tile at a time
+
+    Like `fill_terrain_no_flats` and optionally `flow.terrain_flowdirection` on the output but only holds one tile and a
+    graph of the tile borders in memory. This makes it possible to process rasters which are larger than the available
+    memory. Each tile is read and flooded twice.
+
+    The output has no flats and fills the same depressions as `fill_terrain_no_flats`. Where a filled depression or flat
+    spans several tiles the minimum elevation differences may differ, which may route the flow over it differently.
+
+    Parameters
+    ----------
+    read_window : callable
+        Called as `read_window(row, col, nrows, ncols)`. Must return the DEM values of the window as 2D numpy array
+    write_window : callable
+        Called as `write_window(data, row, col)` once for each tile with the filled values of the tile. May be None
+    shape : (int, int)
+        Shape of the DEM (rows, cols)
+    short : float
+        Minimum output elevation difference between cells sharing an edge. Unit [m]
+    diag : float
+        Minimum output elevation difference between cells sharing a corner. Unit [m]
+    tile_shape : (int, int)
+        Shape of the tiles (rows, cols)
+    write_flowdir_window : callable
+        Optional. Called as `write_flowdir_window(data, row, col)` once for each tile with the flow directions of the
+        tile
+    edges_flow_outward : bool
+        If True edge cells are forced to run directly off the raster. If False edge cells will
+        be assigned 'NO DIRECTION'
+    stats : FillStats, optional
+        Records passes, cell updates and timing of the fill
+
+    Returns
+    -------
+    None
+
+    """
+    if stats is not None:
+        stats.start(FILL_METHOD_PRIORITY_FLOOD, shape)
+    borders = _fill_tiles(read_window, shape, tile_shape, True, short, diag, stats)
+    for window, padded in _finalized_tiles(read_window, shape, tile_shape, borders, True, short, diag, stats):
+        if write_window is not None:
+            write_window(np.ascontiguousarray(padded[1:-1, 1:-1]), window[0], window[1])
+        if write_flowdir_window is not None:
+            flowdir = np.ascontiguousarray(terrain_flowdirection(padded, edges_flow_outward=False)[1:-1, 1:-1])
+            # Raster edge cells are next to the -inf frame
+            set_window_edges_flow(flowdir, shape, window, edges_flow_outward)
+            write_flowdir_window(flowdir, window[0], window[1])
 
 
 def minimum_safe_short_and_diag(dem):
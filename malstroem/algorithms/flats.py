@@ -0,0 +1,204 @@
+# coding=utf-8
+# -------------------------------------------------------------------------------------------------
+# Copyright (c) 2016
+# Developed by Septima.dk and Thomas Balstrøm (University of Copenhagen) for the Danish Agency for
+# Data Supply and Efficiency. This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free Software Foundation,
+# either version 2 of the License, or (at you option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PORPOSE. See the GNU Gene-
+# ral Public License for more details.
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see http://www.gnu.org/licenses/.
+# -------------------------------------------------------------------------------------------------
+"""Flow directions over flats without a float64 surface.
+
+Flats of a filled DEM are resolved by an integer gradient as described in
+Barnes, R., Lehman, C., Mulla, D., 2014. An efficient assignment of drainage direction over flat surfaces in raster
+digital elevation models. Computers & Geosciences 62, 128–135.
+
+Within each flat water flows towards lower terrain and away from higher terrain. Flats are resolved one at a time
+using integer distances which are only allocated for the bounding box of the flat. This avoids the float64 DEM filled
+without flats (see `fill.fill_terrain_no_flats`).
+"""
+from __future__ import (absolute_import, division, print_function) #, unicode_literals)
+from builtins import *
+import numpy as np
+from collections import deque
+from .flow import SQRT2, FLOWDIR_NODIR, terrain_flowdirection
+
+# Flats are resolved either by filling them with a minimum gradient or by an integer gradient
+FLATS_METHOD_EPSILON = 'epsilon'
+FLATS_METHOD_GRADIENT = 'gradient'
+FLATS_METHODS = (FLATS_METHOD_EPSILON, FLATS_METHOD_GRADIENT)
+
+# Temporary flow direction of cells on the flat being resolved
+_FLAT_PENDING = FLOWDIR_NODIR + 1
+
+# Neighbor deltas in AGNPS order
+_NEIGHBOR_DELTAS = ((-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1))
+
+
+def _resolve_flat(filled, flowdir, row, col):
+    """Assign flow directions to the flat containing interior cell (row, col).
+
+    Cells on the flat are marked as pending. If the flat has no outlet they are left pending.
+    """
+    rows, cols = filled.shape
+    z = filled[row, col]
+
+    # Collect the flat
+    flowdir[row, col] = _FLAT_PENDING
+    cells = [(row, col)]
+    minr, minc, maxr, maxc = row, col, row, col
+    i = 0
+    while i < len(cells):
+        r, c = cells[i]
+        i += 1
+        for dr, dc in _NEIGHBOR_DELTAS:
+            nr = r + dr
+            nc = c + dc
+            if 0 < nr < rows - 1 and 0 < nc < cols - 1 and flowdir[nr, nc] == FLOWDIR_NODIR and filled[nr, nc] == z:
+                flowdir[nr, nc] = _FLAT_PENDING
+                cells.append((nr, nc))
+                minr, minc = min(minr, nr), min(minc, nc)
+                maxr, maxc = max(maxr, nr), max(maxc, nc)
+
+    # Distances are stored for the bounding box of the flat and its outlets
+    minr, minc = minr - 1, minc - 1
+    shape = (maxr - minr + 2, maxc - minc + 2)
+    towards = np.full(shape, -1, dtype=np.int32)
+    away = np.full(shape, -1, dtype=np.int32)
+
+    # Outlets are cells at the level of the flat which have a flow direction or are raster edge cells.
+    # Cells next to higher terrain are the high edges of the flat.
+    low_edges = deque()
+    high_edges = deque()
+    for r, c in cells:
+        is_high_edge = False
+        for dr, dc in _NEIGHBOR_DELTAS:
+            nr = r + dr
+            nc = c + dc
+            if filled[nr, nc] > z:
+                is_high_edge = True
+            elif filled[nr, nc] == z and flowdir[nr, nc] != _FLAT_PENDING and towards[nr - minr, nc - minc] < 0:
+                towards[nr - minr, nc - minc] = 0
+                low_edges.append((nr, nc))
+        if is_high_edge:
+            away[r - minr, c - minc] = 1
+            high_edges.append((r, c))
+
+    if not low_edges:
+        return
+
+    def is_on_flat(r, c):
+        return flowdir[r, c] == _FLAT_PENDING and filled[r, c] == z
+
+    # Gradient towards lower terrain
+    while low_edges:
+        r, c = low_edges.popleft()
+        d = towards[r - minr, c - minc] + 1
+        for dr, dc in _NEIGHBOR_DELTAS:
+            nr = r + dr
+            nc = c + dc
+            if 0 <= nr - minr < shape[0] and 0 <= nc - minc < shape[1] and towards[nr - minr, nc - minc] < 0 \
+                    and is_on_flat(nr, nc):
+                towards[nr - minr, nc - minc] = d
+                low_edges.append((nr, nc))
+
+    # Gradient away from higher terrain
+    flat_height = 0
+    while high_edges:
+        r, c = high_edges.popleft()
+        d = away[r - minr, c - minc]
+        flat_height = d
+        for dr, dc in _NEIGHBOR_DELTAS:
+            nr = r + dr
+            nc = c + dc
+            if 0 <= nr - minr < shape[0] and 0 <= nc - minc < shape[1] and away[nr - minr, nc - minc] < 0 \
+                    and is_on_flat(nr, nc):
+                away[nr - minr, nc - minc] = d + 1
+                high_edges.append((nr, nc))
+
+    # Combined gradient. Outlets are 0 and cells not on the flat are -1
+    mask = towards
+    for r, c in cells:
+        lr, lc = r - minr, c - minc
+        mask[lr, lc] = 2 * towards[lr, lc]
+        if flat_height:
+            mask[lr, lc] += flat_height - away[lr, lc]
+
+    # Steepest descent on the combined gradient
+    for r, c in cells:
+        m = mask[r - minr, c - minc]
+        direction = FLOWDIR_NODIR
+        dmax = 0.0
+        for k, (dr, dc) in enumerate(_NEIGHBOR_DELTAS):
+            n = mask[r + dr - minr, c + dc - minc]
+            if n < 0:
+                continue
+            d = (m - n) / SQRT2 if k % 2 else m - n
+            if d > dmax:
+                dmax = d
+                direction = k
+        flowdir[r, c] = direction
+
+
+def _resolve_flats(filled, flowdir):
+    """Assign flow directions to the interior cells without a direction in place"""
+    rows, cols = filled.shape
+    for r in range(1, rows - 1):
+        for c in range(1, cols - 1):
+            if flowdir[r, c] == FLOWDIR_NODIR:
+                _resolve_flat(filled, flowdir, r, c)
+    # Flats without an outlet
+    flowdir[flowdir == _FLAT_PENDING] = FLOWDIR_NODIR
+
+
+def resolve_flats(filled, flowdir):
+    """Assign flow directions over flats of a filled DEM.
+
+    Within each flat water flows towards the outlets of the flat and away from higher terrain surrounding the flat.
+    Cells on flats without an outlet keep 'NO DIRECTION'.
+
+    Parameters
+    ----------
+    filled : 2D array
+        Filled DEM. See `fill.fill_terrain`
+    flowdir : 2D array
+        D8 flow directions of `filled`. Updated in place
+
+    Returns
+    -------
+    None
+
+    """
+    if filled.shape != flowdir.shape:
+        raise ValueError("Filled DEM and flow directions must have the same shape")
+    _resolve_flats(filled, flowdir)
+
+
+def flats_flowdirection(filled, edges_flow_outward=True, workers=1):
+    """Calculate flow directions of a filled DEM with flats.
+
+    Flow directions are D8 flow directions (see `flow.terrain_flowdirection`). Flats are resolved by `resolve_flats`
+    instead of requiring a minimum slope between cells. This works on the float32 filled DEM.
+
+    Parameters
+    ----------
+    filled : 2D array
+        Filled DEM. See `fill.fill_terrain`
+    edges_flow_outward : bool
+        If True edge cells are forced to run directly off the raster. If False edge cells will
+        be assigned 'NO DIRECTION'
+    workers : int
+        Number of threads used for the D8 flow directions. See `flow.terrain_flowdirection`
+
+    Returns
+    -------
+    2D array where each cell holds the flow direction from that cell
+
+    """
+    flowdir = terrain_flowdirection(filled, edges_flow_outward=edges_flow_outward, workers=workers)
+    resolve_flats(filled, flowdir)
+    return flowdir
@@ -16,8 +16,9 @@ from builtins import *
 import numpy as np
 import math
 from .dtypes import (DTYPE_FLOWDIR, DTYPE_ACCUM)
-from ._raster_utils import cell_in_raster, edge_cell_indexes
+from ._raster_utils import cell_in_raster, tile_grid_shape, tile_window, DEFAULT_TILE_SHAPE
 from collections import deque
+from multiprocessing.pool import ThreadPool
 
 SQRT2 = math.sqrt(2)
 
@@ -55,11 +56,17 @@ def _terrain_flow(terrain):
     -------
 
     """
-    rows, cols = terrain.shape
+    rows = terrain.shape[0]
     flow = np.empty_like(terrain, dtype=DTYPE_FLOWDIR)
     flow.fill(FLOWDIR_NODIR)
-    maxrow, maxcol = (rows - 2, cols - 2)
-    for r in range(1, maxrow + 1):
+    _terrain_flow_rows(terrain, flow, 1, rows - 1)
+    return flow
+
+
+def _terrain_flow_rows(terrain, flow, first, last):
+    """Calculate flow directions of the interior cells in rows `first` to `last` (exclusive) in place"""
+    maxcol = terrain.shape[1] - 2
+    for r in range(first, last):
         up = r - 1
         down = r + 1
         for c in range(1, maxcol + 1):
@@ -112,6 +119,90 @@ def _terrain_flow(terrain):
                 i = FLOWDIR_UP_LEFT
 
             flow[r, c] = i
+
+
+# Number of cells processed at a time by the vectorized flow directions. Bounds the temporary memory.
+_FLOW_STRIP_CELLS = 2**20
+
+# Neighbor deltas in AGNPS order
+_NEIGHBOR_DELTAS = ((-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1))
+
+# Row and column deltas indexed by flow direction. 'NO DIRECTION' stays in the cell
+_DIRECTION_DELTA_ROW = np.array([dr for dr, dc in _NEIGHBOR_DELTAS] + [0])
+_DIRECTION_DELTA_COL = np.array([dc for dr, dc in _NEIGHBOR_DELTAS] + [0])
+
+
+def _terrain_flow_vectorized(terrain, strip_cells=_FLOW_STRIP_CELLS):
+    """Calculate flow directions for the specified terrain using whole array operations.
+
+    Same output as the compiled `_terrain_flow`. The slope towards each neighbor is calculated for a strip of rows at a
+    time using shifted views of the terrain. Like the cell by cell version the steepest slope is kept by a strict
+    comparison in AGNPS order, so ties go to the first direction and cells without a downslope neighbor get
+    'NO DIRECTION'.
+
+    Slopes are calculated in the dtype of the terrain if it is a float type and as float64 otherwise.
+
+    Parameters
+    ----------
+    terrain : 2D array
+    strip_cells : int
+        Approximate number of cells in each strip
+
+    Returns
+    -------
+    2D array of flow directions
+
+    """
+    flow = np.empty(terrain.shape, dtype=DTYPE_FLOWDIR)
+    flow.fill(FLOWDIR_NODIR)
+    _terrain_flow_rows_vectorized(terrain, flow, 1, terrain.shape[0] - 1, strip_cells)
+    return flow
+
+
+def _terrain_flow_rows_vectorized(terrain, flow, first, last, strip_cells=_FLOW_STRIP_CELLS):
+    """Vectorized `_terrain_flow_rows`. See `_terrain_flow_vectorized`"""
+    cols = terrain.shape[1]
+    if cols < 3:
+        return
+    dtype = terrain.dtype if np.issubdtype(terrain.dtype, np.floating) else np.float64
+    inv_sqrt2 = 1 / SQRT2
+    strip_rows = max(1, strip_cells // cols)
+    for r0 in range(first, last, strip_rows):
+        r1 = min(r0 + strip_rows, last)
+        shape = (r1 - r0, cols - 2)
+        z = terrain[r0:r1, 1:-1]
+        dz = np.empty(shape, dtype=dtype)
+        dzmax = np.zeros(shape, dtype=dtype)
+        steeper = np.empty(shape, dtype=bool)
+        direction = flow[r0:r1, 1:-1]
+        for i, (dr, dc) in enumerate(_NEIGHBOR_DELTAS):
+            np.subtract(z, terrain[r0 + dr:r1 + dr, 1 + dc:cols - 1 + dc], out=dz, dtype=dtype)
+            if i % 2:
+                # Diagonal slopes are scaled in double precision like the compiled version
+                np.multiply(dz, inv_sqrt2, out=dz, dtype=np.float64, casting='unsafe')
+            np.greater(dz, dzmax, out=steeper)
+            np.copyto(dzmax, dz, where=steeper)
+            np.copyto(direction, i, where=steeper)
+
+
+def _terrain_flow_parallel(terrain, workers):
+    """Calculate flow directions using `workers` threads.
+
+    Each thread calculates strips of rows using `_terrain_flow_rows`. The output is the same as `_terrain_flow`. The
+    compiled row kernel releases the GIL, which lets the threads run at the same time.
+    """
+    rows = terrain.shape[0]
+    flow = np.empty(terrain.shape, dtype=DTYPE_FLOWDIR)
+    flow.fill(FLOWDIR_NODIR)
+    # A few strips per worker evens out the load
+    step = max(1, -(-(rows - 2) // (4 * workers)))
+    strips = [(first, min(first + step, rows - 1)) for first in range(1, rows - 1, step)]
+    pool = ThreadPool(workers)
+    try:
+        pool.map(lambda strip: _terrain_flow_rows(terrain, flow, strip[0], strip[1]), strips)
+    finally:
+        pool.close()
+        pool.join()
     return flow
 
 
@@ -139,7 +230,44 @@ def set_edges_flow_outward(flowdir):
     flowdir[maxr, maxc] = FLOWDIR_DOWN_RIGHT
 
 
-def terrain_flowdirection(terrain, edges_flow_outward=True):
+def set_window_edges_flow(flowdir, shape, window, edges_flow_outward=True):
+    """Set flow directions of the raster edge cells within a window of a raster
+
+    Parameters
+    ----------
+    flowdir : 2D array
+        Flow directions of the window
+    shape : (int, int)
+        Shape of the raster (rows, cols)
+    window : (int, int, int, int)
+        Window of the raster (row, col, nrows, ncols)
+    edges_flow_outward : bool
+        If True edge cells are set to flow directly off the raster. If False edge cells are set to 'NO DIRECTION'
+
+    Returns
+    -------
+    None
+
+    """
+    row, col, nrows, ncols = window
+    top = row == 0
+    bottom = row + nrows == shape[0]
+    left = col == 0
+    right = col + ncols == shape[1]
+    edges = ((top, (0, slice(None)), FLOWDIR_UP),
+             (bottom, (-1, slice(None)), FLOWDIR_DOWN),
+             (left, (slice(None), 0), FLOWDIR_LEFT),
+             (right, (slice(None), -1), FLOWDIR_RIGHT),
+             (top and left, (0, 0), FLOWDIR_UP_LEFT),
+             (top and right, (0, -1), FLOWDIR_UP_RIGHT),
+             (bottom and left, (-1, 0), FLOWDIR_DOWN_LEFT),
+             (bottom and right, (-1, -1), FLOWDIR_DOWN_RIGHT))
+    for is_edge, cells, direction in edges:
+        if is_edge:
+            flowdir[cells] = direction if edges_flow_outward else FLOWDIR_NODIR
+
+
+def terrain_flowdirection(terrain, edges_flow_outward=True, workers=1):
     """Calculate flow directions based on terrain model.
 
         Assumes water will always flow via the steepest path from cell to cell. This is sometimes called D8 flow.
@@ -155,18 +283,61 @@ def terrain_flowdirection(terrain, edges_flow_outward=True):
         edges_flow_outward : bool
             If True edge cells are forced to run directly off the raster. If False edge cells will
             be assigned 'NO DIRECTION'
+        workers : int
+            Number of threads. The output is the same for any number of workers
 
         Returns
         -------
         2D array where each cell holds the flow direction from that cell
 
         """
-    f = _terrain_flow(terrain)
+    if workers < 1:
+        raise ValueError("Number of workers must be at least 1: {}".format(workers))
+    f = _terrain_flow_parallel(terrain, workers) if workers > 1 else _terrain_flow(terrain)
     if edges_flow_outward:
         set_edges_flow_outward(f)
     return f
 
 
+def update_flowdirection(terrain, flowdir, window, edges_flow_outward=True):
+    """Update flow directions after the terrain changed inside a window.
+
+    Flow directions of the cells in the window and of the cells next to it are recalculated in place.
+
+    Parameters
+    ----------
+    terrain : 2D array
+        Terrain model after the change
+    flowdir : 2D array
+        Flow directions of the terrain model before the change. Updated in place
+    window : (int, int, int, int)
+        Changed cells (row, col, nrows, ncols)
+    edges_flow_outward : bool
+        If True edge cells are forced to run directly off the raster. If False edge cells will
+        be assigned 'NO DIRECTION'
+
+    Returns
+    -------
+    window : (int, int, int, int)
+        Window (row, col, nrows, ncols) of the recalculated flow directions
+
+    """
+    rows, cols = terrain.shape
+    row, col, nrows, ncols = window
+    # Cells next to the window may have a new steepest direction
+    r0, c0 = max(row - 1, 0), max(col - 1, 0)
+    r1, c1 = min(row + nrows + 1, rows), min(col + ncols + 1, cols)
+    # Include the neighbors of the updated cells
+    t0, s0 = max(r0 - 1, 0), max(c0 - 1, 0)
+    t1, s1 = min(r1 + 1, rows), min(c1 + 1, cols)
+    f = _terrain_flow(terrain[t0:t1, s0:s1])
+    updated = flowdir[r0:r1, c0:c1]
+    updated[:, :] = f[r0 - t0:r1 - t0, c0 - s0:c1 - s0]
+    updated_window = (r0, c0, r1 - r0, c1 - c0)
+    set_window_edges_flow(updated, terrain.shape, updated_window, edges_flow_outward)
+    return updated_window
+
+
 def direction_to_delta(direction):
     """Calculate cell delta coordinate from flow direction.
 
@@ -259,7 +430,7 @@ def upstream_cells(flowdir, cell):
 
     Parameters
     ----------
-    flowdir : 2D array of flowdirections
+    flowdir : 2D array of flowdirections, PackedFlowdir or FlowGraph
     cell : pair of ints
         A (row, col) pair indicating the specified cell.
 
@@ -268,6 +439,8 @@ def upstream_cells(flowdir, cell):
     List of (row, col) pairs
 
     """
+    if isinstance(flowdir, FlowGraph):
+        return flowdir.upstream_cells(cell)
     upstream = []
     for direction in range(8):
         if is_upstream_cell(flowdir, cell, direction):
@@ -281,7 +454,7 @@ def trace_downstream(flowdir, cell):
 
     Parameters
     ----------
-    flowdir : 2D array of flowdirections
+    flowdir : 2D array of flowdirections, PackedFlowdir or FlowGraph
     cell : pair of ints
         A (row, col) pair indicating the specified cell.
 
@@ -290,6 +463,12 @@ def trace_downstream(flowdir, cell):
     Iterable, yielding cell coordinates (row, col) of the downstream cells.
 
     """
+    if isinstance(flowdir, FlowGraph):
+        return flowdir.trace_downstream(cell)
+    return _trace_downstream(flowdir, cell)
+
+
+def _trace_downstream(flowdir, cell):
     cell = tuple(cell)
     while cell and cell_in_raster(flowdir.shape, cell):
         yield cell
@@ -301,6 +480,41 @@ def trace_downstream(flowdir, cell):
             cell = None
 
 
+def downstream_path(flowdir, cell, end=None):
+    """Cells from specified cell and downstream as an array.
+
+    Like `trace_downstream`, but the path is returned as one array instead of a tuple per cell. A path running into a
+    flow direction cycle ends after rows * cols cells.
+
+    Parameters
+    ----------
+    flowdir : 2D array of flowdirections, PackedFlowdir or FlowGraph
+    cell : pair of ints
+        A (row, col) pair indicating the specified cell.
+    end : pair of ints, optional
+        Last cell (row, col) of the path. Defaults to following the flow as far as it goes
+
+    Returns
+    -------
+    (n, 2) array of cell coordinates (row, col). Empty if cell is outside the raster
+
+    """
+    return _downstream_path(flowdir, cell, end)
+
+
+def _downstream_path(flowdir, cell, end):
+    rows, cols = flowdir.shape
+    end = tuple(end) if end is not None else None
+    path = []
+    for c in trace_downstream(flowdir, cell):
+        if len(path) == rows * cols:
+            break
+        path.append(c)
+        if c == end:
+            break
+    return np.array(path, dtype=np.intp).reshape(-1, 2)
+
+
 def trace_accumulated_flow(flowdir, accum, cell):
     """Trace accumulated flow downstream from cell.
 
@@ -341,27 +555,457 @@ def trace_accumulated_flow(flowdir, accum, cell):
         cell = cell_in_direction(cell, direction)
 
 
-def accumulated_flow(flowdir):
+class PackedFlowdir(object):
+    """D8 flow directions packed two cells per byte.
+
+    AGNPS codes fit in 4 bits. The flow direction of an even column is stored in the low 4 bits of a byte and the flow
+    direction of the next column in the high 4 bits. This halves the memory of a flow direction raster.
+
+    `upstream_cells`, `trace_downstream`, `downstream_path`, `receivers_from_flowdir`, `accumulated_flow` and
+    `watersheds_from_labels` read packed flow directions directly.
+
+    Parameters
+    ----------
+    flowdir : 2D array of flow directions
+
+    Attributes
+    ----------
+    shape : (int, int)
+        Raster shape (rows, cols)
+    data : 2D uint8 array
+        Packed flow directions with (cols + 1) // 2 columns
+
+    """
+
+    def __init__(self, flowdir):
+        flowdir = np.asarray(flowdir)
+        if flowdir.size and (flowdir.min() < 0 or flowdir.max() > 15):
+            raise ValueError("Flow directions must fit in 4 bits")
+        rows, cols = flowdir.shape
+        self.shape = flowdir.shape
+        self.data = np.zeros((rows, (cols + 1) // 2), dtype=DTYPE_FLOWDIR)
+        self.data[:] = flowdir[:, 0::2]
+        self.data[:, :cols // 2] |= flowdir[:, 1::2].astype(DTYPE_FLOWDIR) << 4
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __getitem__(self, cell):
+        """Flow direction of cell (row, col)"""
+        row, col = cell
+        if col < 0:
+            col += self.shape[1]
+        packed = self.data[row, col >> 1]
+        return packed >> 4 if col & 1 else packed & 15
+
+    def read_window(self, row, col, nrows, ncols):
+        """Unpacked flow directions of a window. Same signature as `io.RasterReader.read_window`"""
+        first = col - col % 2
+        data = self.data[row:row + nrows, first // 2:(col + ncols + 1) // 2]
+        flowdir = np.empty((data.shape[0], 2 * data.shape[1]), dtype=DTYPE_FLOWDIR)
+        flowdir[:, 0::2] = data & 15
+        flowdir[:, 1::2] = data >> 4
+        return flowdir[:, col - first:col - first + ncols]
+
+    def unpack(self):
+        """Flow directions as a 2D array"""
+        return self.read_window(0, 0, *self.shape)
+
+
+def _receivers_rows(flowdir, first, last, dtype):
+    """Receivers of the cells in rows `first` to `last` (exclusive). See `receivers_from_flowdir`"""
+    rows, cols = flowdir.shape
+    if isinstance(flowdir, PackedFlowdir):
+        direction = flowdir.read_window(first, 0, last - first, cols)
+    else:
+        direction = flowdir[first:last]
+    direction = np.minimum(direction, FLOWDIR_NODIR)
+    downstream_row = np.arange(first, last).reshape(-1, 1) + _DIRECTION_DELTA_ROW[direction]
+    downstream_col = np.arange(cols).reshape(1, -1) + _DIRECTION_DELTA_COL[direction]
+    receivers = downstream_row * cols + downstream_col
+    receivers[(direction == FLOWDIR_NODIR) | (downstream_row < 0) | (downstream_row >= rows) |
+              (downstream_col < 0) | (downstream_col >= cols)] = -1
+    return receivers.astype(dtype, copy=False).ravel()
+
+
+def receivers_from_flowdir(flowdir, dtype=None):
+    """Linear index of the downstream cell of each cell.
+
+    This is the receiver representation of the flow directions. Following the flow from a cell is a matter of looking
+    up the next linear index instead of decoding a direction code. The linear index of cell (row, col) is
+    `row * cols + col`.
+
+    Cells with 'NO DIRECTION' or flowing off the raster have no downstream cell and get -1.
+
+    Parameters
+    ----------
+    flowdir : 2D array of flow directions or PackedFlowdir
+    dtype : data type, optional
+        Integer type of the output. Defaults to int32 if all linear indexes fit and int64 otherwise
+
+    Returns
+    -------
+    1D array with an item for each cell in row major order
+
+    """
+    rows, cols = flowdir.shape
+    if dtype is None:
+        dtype = np.int32 if rows * cols <= np.iinfo(np.int32).max else np.int64
+    receivers = np.empty(rows * cols, dtype=dtype)
+    # Calculated in strips to limit the temporary arrays
+    strip_rows = max(1, _FLOW_STRIP_CELLS // max(cols, 1))
+    for first in range(0, rows, strip_rows):
+        last = min(first + strip_rows, rows)
+        receivers[first * cols:last * cols] = _receivers_rows(flowdir, first, last, dtype)
+    return receivers
+
+
+def donors_from_receivers(receivers):
+    """Upstream cells of each cell in compressed sparse row (CSR) form.
+
+    The cells flowing directly into the cell with linear index `i` are `donors[offsets[i]:offsets[i + 1]]` in
+    increasing order.
+
+    Parameters
+    ----------
+    receivers : 1D array
+        Linear index of the downstream cell of each cell. See `receivers_from_flowdir`
+
+    Returns
+    -------
+    offsets : 1D array
+        Start of the donors of each cell. Has an extra item at the end
+    donors : 1D array
+        Linear indexes of the donor cells
+
+    """
+    has_receiver = receivers >= 0
+    counts = np.bincount(receivers[has_receiver], minlength=receivers.size)
+    offsets = np.zeros(receivers.size + 1, dtype=receivers.dtype)
+    np.cumsum(counts, out=offsets[1:])
+    cells = np.flatnonzero(has_receiver).astype(receivers.dtype, copy=False)
+    donors = cells[np.argsort(receivers[has_receiver], kind='stable')]
+    return offsets, donors
+
+
+class FlowGraph(object):
+    """Receiver and donor representation of D8 flow directions.
+
+    Built once from a flow direction raster. Functions taking flow directions in `flow` and `net` also accept a
+    FlowGraph, which makes tracing simple index lookups.
+
+    Parameters
+    ----------
+    flowdir : 2D array of flow directions or PackedFlowdir
+    dtype : data type, optional
+        Integer type of the linear indexes. See `receivers_from_flowdir`
+
+    Attributes
+    ----------
+    shape : (int, int)
+        Raster shape (rows, cols)
+    flowdir : 2D array or PackedFlowdir
+        The flow directions
+    receivers : 1D array
+        Linear index of the downstream cell of each cell or -1. See `receivers_from_flowdir`
+    donor_offsets, donors : 1D arrays
+        Upstream cells of each cell in CSR form. See `donors_from_receivers`. Calculated when first used
+
+    """
+
+    def __init__(self, flowdir, dtype=None):
+        self.shape = flowdir.shape
+        self.flowdir = flowdir
+        self.receivers = receivers_from_flowdir(flowdir, dtype)
+        self._donors = None
+
+    @property
+    def donor_offsets(self):
+        return self._donor_csr()[0]
+
+    @property
+    def donors(self):
+        return self._donor_csr()[1]
+
+    def _donor_csr(self):
+        if self._donors is None:
+            self._donors = donors_from_receivers(self.receivers)
+        return self._donors
+
+    def upstream_cells(self, cell):
+        """Return cells (row, col) which flow directly into cell (row, col)"""
+        cols = self.shape[1]
+        index = cell[0] * cols + cell[1]
+        offsets, donors = self._donor_csr()
+        return [divmod(int(i), cols) for i in donors[offsets[index]:offsets[index + 1]]]
+
+    def trace_downstream(self, cell):
+        """Yield cell (row, col) and the cells downstream of it"""
+        if not cell_in_raster(self.shape, cell):
+            return
+        cols = self.shape[1]
+        receivers = self.receivers
+        index = int(cell[0] * cols + cell[1])
+        while index >= 0:
+            yield divmod(index, cols)
+            index = int(receivers[index])
+
+
+def _accumulate_receivers(receivers, accum):
+    """Accumulate 1D `accum` in place along `receivers` in topological order. See `accumulated_flow`.
+
+    Items on a cycle get 0. Returns a boolean array which is True for the resolved items.
+    """
+    unresolved = np.bincount(receivers[receivers >= 0], minlength=receivers.size).tolist()
+    receivers = receivers.tolist()
+    flat = accum.tolist()
+    for start, count in enumerate(unresolved):
+        if count != 0:
+            continue
+        cell = start
+        while True:
+            # Resolved. Never start from this cell again
+            unresolved[cell] = -1
+            downstream = receivers[cell]
+            if downstream < 0:
+                break
+            flat[downstream] += flat[cell]
+            unresolved[downstream] -= 1
+            if unresolved[downstream] != 0:
+                break
+            cell = downstream
+    accum[:] = flat
+    resolved = np.array(unresolved) < 0
+    accum[~resolved] = 0
+    return resolved
+
+
+def _accumulate(flowdir, accum):
+    """Accumulate flow in place. `accum` holds the weight of each cell on input."""
+    _accumulate_receivers(receivers_from_flowdir(flowdir), accum.reshape(-1))
+
+
+def accumulated_flow(flowdir, weights=None, dtype=DTYPE_ACCUM):
     """Calculate accumulated flow raster from flow direction raster.
 
+    The accumulated flow of a cell is the number of cells upstream of the cell including the cell itself. If `weights`
+    are given it is the sum of the weights of these cells instead.
+
+    Cells are processed in topological order. The number of unresolved upstream cells is counted once for each cell.
+    Starting from each cell without unresolved upstream cells the flow is followed downstream, adding the accumulated
+    flow to the downstream cell, until a cell which still has unresolved upstream cells is met. This visits each cell
+    and each flow direction once.
+
+    Cells on a flow direction cycle never have all upstream cells resolved and get 0.
+
     Parameters
     ----------
-    flowdir
+    flowdir : 2D array of flow directions or PackedFlowdir
+    weights : 2D array, optional
+        Weight of each cell. For instance precipitation or a runoff coefficient. Must have the same shape as `flowdir`
+    dtype : data type
+        Data type of the output. Flow is accumulated as float64 and converted to this type
+
+    Returns
+    -------
+    2D array of accumulated flow
+
+    """
+    if weights is None:
+        accum = np.ones(flowdir.shape, dtype=DTYPE_ACCUM)
+    elif weights.shape != flowdir.shape:
+        raise ValueError("Weights and flow directions must have the same shape")
+    else:
+        accum = np.array(weights, dtype=DTYPE_ACCUM)
+    _accumulate(flowdir, accum)
+    return accum.astype(dtype, copy=False)
+
+
+def _tile_weights(read_weights_window, window):
+    if read_weights_window is None:
+        return np.ones(window[2:], dtype=DTYPE_ACCUM)
+    return np.array(read_weights_window(*window), dtype=DTYPE_ACCUM)
+
+
+def _tile_exits(flowdir, shape, window):
+    """Find where flow from each cell of a tile leaves the tile.
+
+    Parameters
+    ----------
+    flowdir : 2D array
+        Flow directions of the tile
+    shape : (int, int)
+        Shape of the raster (rows, cols)
+    window : (int, int, int, int)
+        Window of the tile (row, col, nrows, ncols)
+
+    Returns
+    -------
+    exits : 1D array
+        Linear tile index of the cell where flow from each cell leaves the tile to another tile. -1 if the flow ends
+        within the tile or runs off the raster
+    downstream : 1D array
+        Linear raster index of the downstream cell of each cell. Only valid for the exit cells
+
+    """
+    row, col, nrows, ncols = window
+    local = receivers_from_flowdir(flowdir)
+    direction = np.minimum(flowdir, FLOWDIR_NODIR)
+    downstream_row = np.arange(row, row + nrows).reshape(-1, 1) + _DIRECTION_DELTA_ROW[direction]
+    downstream_col = np.arange(col, col + ncols).reshape(1, -1) + _DIRECTION_DELTA_COL[direction]
+    leaves = ((local.reshape(flowdir.shape) < 0) & (direction != FLOWDIR_NODIR) & (downstream_row >= 0) &
+              (downstream_row < shape[0]) & (downstream_col >= 0) & (downstream_col < shape[1])).ravel()
+    downstream = (downstream_row * shape[1] + downstream_col).ravel()
+
+    # Pointer jumping. Each round doubles the length of the followed paths. Cells on a cycle are never resolved.
+    exits = np.where(leaves, np.arange(local.size), -1)
+    pending = local >= 0
+    jump = local
+    for _ in range(local.size.bit_length() + 1):
+        cells = np.flatnonzero(pending)
+        if not cells.size:
+            break
+        target = jump[cells]
+        done = ~pending[target]
+        exits[cells[done]] = exits[target[done]]
+        pending[cells[done]] = False
+        jump[cells[~done]] = jump[target[~done]]
+    exits[pending] = -1
+    return exits, downstream
+
+
+def _tile_border(shape):
+    """Linear indexes of the border cells of a tile"""
+    border = np.zeros(shape, dtype=bool)
+    border[0, :] = border[-1, :] = border[:, 0] = border[:, -1] = True
+    return np.flatnonzero(border)
+
+
+def _tile_inflows(read_window, read_weights_window, shape, tile_shape):
+    """Accumulated flow from each tile into its neighbor tiles.
+
+    Flow is first accumulated within each tile. Flow from an exit cell of a tile enters a border cell of a neighbor tile
+    and follows a path within that tile to one of its exit cells. These exit to exit links form a graph which is small
+    compared to the raster, and flow is accumulated over it in topological order.
 
     Returns
     -------
+    inflow_cells : 1D array
+        Linear raster indexes of cells receiving flow from another tile. May contain duplicates
+    inflows : 1D array
+        Accumulated flow received by each of the inflow_cells
+    cycle_cells : 1D array
+        Linear raster indexes of cells receiving flow from another tile on a flow direction cycle spanning tiles
 
     """
-    accum = np.zeros(flowdir.shape, dtype=DTYPE_ACCUM)
-    for r in range(0, flowdir.shape[0]):
-        for c in range(0, flowdir.shape[1]):
-            cell = (r, c)
-            up_cells = upstream_cells(flowdir, cell)
-            if not up_cells:
-                # This is a leaf in the flow dir tree
-                # Trace down
-                trace_accumulated_flow(flowdir, accum, cell)
-    return accum
+    rows, cols = shape
+    grid = tile_grid_shape(shape, tile_shape)
+    entries, entry_exits = [], []
+    exits, exit_accums, exit_downstream = [], [], []
+    for tile in ((i, j) for i in range(grid[0]) for j in range(grid[1])):
+        window = tile_window(shape, tile_shape, tile)
+        row, col, nrows, ncols = window
+        flowdir = read_window(*window)
+        accum = _tile_weights(read_weights_window, window)
+        _accumulate(flowdir, accum)
+        tile_exits, downstream = _tile_exits(flowdir, shape, window)
+
+        def to_raster(cells):
+            return (row + cells // ncols) * cols + col + cells % ncols
+
+        border = _tile_border((nrows, ncols))
+        entries.append(to_raster(border))
+        entry_exits.append(np.where(tile_exits[border] >= 0, to_raster(tile_exits[border]), -1))
+        exit_cells = np.flatnonzero(tile_exits == np.arange(tile_exits.size))
+        exits.append(to_raster(exit_cells))
+        exit_accums.append(accum.ravel()[exit_cells])
+        exit_downstream.append(downstream[exit_cells])
+
+    entries = np.concatenate(entries)
+    order = np.argsort(entries)
+    entries, entry_exits = entries[order], np.concatenate(entry_exits)[order]
+    exits = np.concatenate(exits)
+    order = np.argsort(exits)
+    exits = exits[order]
+    exit_accums = np.concatenate(exit_accums)[order]
+    exit_downstream = np.concatenate(exit_downstream)[order]
+
+    # The downstream cell of an exit is a border cell of a neighbor tile
+    next_exit = entry_exits[np.searchsorted(entries, exit_downstream)]
+    receivers = np.where(next_exit >= 0, np.searchsorted(exits, next_exit), -1)
+    resolved = _accumulate_receivers(receivers, exit_accums)
+    return exit_downstream[resolved], exit_accums[resolved], exit_downstream[~resolved]
+
+
+def accumulated_flow_tiled(read_window, write_window, shape, read_weights_window=None, tile_shape=DEFAULT_TILE_SHAPE,
+                           dtype=DTYPE_ACCUM):
+    """Calculate accumulated flow one tile at a time
+
+    Gives the same result as `accumulated_flow` but only holds a tile and a graph of the flow between the tile borders in
+    memory. This makes it possible to process rasters which are larger than the available memory.
+
+    Flow is first accumulated within each tile and propagated between tiles through the tile border graph. Then each
+    tile is accumulated again with the flow from its neighbor tiles added and written.
+
+    Parameters
+    ----------
+    read_window : callable
+        Called as `read_window(row, col, nrows, ncols)`. Must return the flow directions of the window as 2D numpy array
+    write_window : callable
+        Called as `write_window(data, row, col)` once for each tile with the accumulated flow of the tile
+    shape : (int, int)
+        Shape of the raster (rows, cols)
+    read_weights_window : callable, optional
+        Called as `read_weights_window(row, col, nrows, ncols)`. Must return the weights of the window as 2D numpy
+        array. See `accumulated_flow`
+    tile_shape : (int, int)
+        Shape of the tiles (rows, cols)
+    dtype : data type
+        Data type of the output
+
+    Returns
+    -------
+    None
+
+    """
+    rows, cols = shape
+    grid = tile_grid_shape(shape, tile_shape)
+    inflow_cells, inflows, cycle_cells = _tile_inflows(read_window, read_weights_window, shape, tile_shape)
+
+    def by_tile(cells):
+        # Cells sorted by tile and the start of each tile in the sorted cells
+        tiles = (cells // cols // tile_shape[0]) * grid[1] + cells % cols // tile_shape[1]
+        order = np.argsort(tiles, kind='stable')
+        return order, np.searchsorted(tiles[order], np.arange(grid[0] * grid[1] + 1))
+
+    inflow_order, inflow_bounds = by_tile(inflow_cells)
+    cycle_order, cycle_bounds = by_tile(cycle_cells)
+    for tile in ((i, j) for i in range(grid[0]) for j in range(grid[1])):
+        window = tile_window(shape, tile_shape, tile)
+        row, col, nrows, ncols = window
+        index = tile[0] * grid[1] + tile[1]
+
+        def to_tile(cells):
+            return (cells // cols - row) * ncols + cells % cols - col
+
+        flowdir = read_window(*window)
+        accum = _tile_weights(read_weights_window, window)
+        flat = accum.reshape(-1)
+        selected = inflow_order[inflow_bounds[index]:inflow_bounds[index + 1]]
+        np.add.at(flat, to_tile(inflow_cells[selected]), inflows[selected])
+        _accumulate(flowdir, accum)
+
+        # Cells on a flow direction cycle spanning tiles get 0 like in `accumulated_flow`
+        selected = cycle_order[cycle_bounds[index]:cycle_bounds[index + 1]]
+        if selected.size:
+            downstream = receivers_from_flowdir(flowdir)
+            for cell in to_tile(cycle_cells[selected]).tolist():
+                # Follow the cycle until it leaves the tile
+                while cell >= 0:
+                    flat[cell] = 0
+                    cell = downstream[cell]
+        write_window(accum.astype(dtype, copy=False), row, col)
 
 
 def assign_watersheds_upstream(flowdir, labelled, cell, unassigned):
@@ -395,18 +1039,53 @@ def assign_watersheds_upstream(flowdir, labelled, cell, unassigned):
         stack.extend(upstream)
 
 
+def _watersheds_from_labels(flowdir, labelled, unassigned):
+    """Assign unassigned cells the label of their downstream cell in place. See `watersheds_from_labels`"""
+    rows, cols = flowdir.shape
+    receivers = receivers_from_flowdir(flowdir)
+    offsets, donors = donors_from_receivers(receivers)
+    labels = labelled.reshape(-1)
+
+    # Edge cells without a downstream cell are the outlets
+    edge = np.ones(flowdir.shape, dtype=bool)
+    edge[1:-1, 1:-1] = False
+    cells = np.flatnonzero(edge.reshape(-1) & (receivers < 0))
+
+    # Label one upstream level at a time so downstream cells are labelled before their upstream cells
+    while cells.size:
+        starts = offsets[cells]
+        counts = offsets[cells + 1] - starts
+        total = counts.sum()
+        if total == 0:
+            break
+        first = np.cumsum(counts) - counts
+        upstream = donors[np.repeat(starts - first, counts) + np.arange(total)]
+        downstream_labels = np.repeat(labels[cells], counts)
+        is_unassigned = labels[upstream] == unassigned
+        labels[upstream[is_unassigned]] = downstream_labels[is_unassigned]
+        cells = upstream
+
+    if not np.shares_memory(labels, labelled):
+        labelled[...] = labels.reshape(labelled.shape)
+
+
 def watersheds_from_labels(flowdir, labelled, unassigned):
     """Calculate local watersheds for labelled cells.
 
+    Unassigned cells get the label of the nearest labelled cell downstream. Cells are labelled from the raster edge
+    cells without a downstream cell and upstream, so each cell is visited once. Cells which do not drain to such an edge
+    cell are left as they are.
+
     Parameters
     ----------
-    flowdir : 2D array of flowdirections
-    labelled : 2D array of cell labels
+    flowdir : 2D array of flowdirections or PackedFlowdir
+    labelled : 2D array of cell labels. Updated in place
     unassigned : int value which indicates unassigned cells in labelled
 
     Returns
     -------
 
     """
-    for cell in edge_cell_indexes(flowdir.shape):
-        assign_watersheds_upstream(flowdir, labelled, cell, unassigned)
+    if flowdir.shape != labelled.shape:
+        raise ValueError("Labels and flow directions must have the same shape")
+    _watersheds_from_labels(flowdir, labelled, unassigned)
@@ -14,9 +14,16 @@
 from __future__ import (absolute_import, division, print_function) #, unicode_literals)  # See issue #3
 from builtins import *
 import numpy as np
+from multiprocessing.pool import ThreadPool
+from ._raster_utils import tile_grid_shape, tile_window, DEFAULT_TILE_SHAPE
 
+# 8-connectivity of connected components
+_CONNECTIVITY = [[1, 1, 1],
+                 [1, 1, 1],
+                 [1, 1, 1]]
 
-def connected_components(data):
+
+def connected_components(data, workers=1):
     """Label connected components in data.
 
     Parameters
@@ -24,6 +31,9 @@ def connected_components(data):
     data : array_like
         An array-like object to be labeled. Any non-zero values in input are counted as features and zero values are
         considered the background.
+    workers : int
+        Number of threads. Strips of rows are labelled in parallel and merged as in `connected_components_tiled`. The
+        output is the same for any number of workers
 
     Returns
     -------
@@ -32,14 +42,302 @@ def connected_components(data):
     nlabels : int
         How many objects were found. Features are numbered in the range [1;nlabels]. The background is labelled 0.
     """
-    import scipy.ndimage
-    connectivity = [[1, 1, 1],
-                    [1, 1, 1],
-                    [1, 1, 1]]
-    labelled, nlabels = scipy.ndimage.label(data, structure=connectivity)
+    if workers < 1:
+        raise ValueError("Number of workers must be at least 1: {}".format(workers))
+    if workers == 1:
+        return _label_tile(data)
+
+    # Strips of full rows. A few strips per worker evens out the load
+    data = np.asarray(data)
+    rows, cols = data.shape
+    tile_shape = (max(1, -(-rows // (4 * workers))), max(cols, 1))
+    windows = _tile_windows(data.shape, tile_shape)
+    labelled = np.empty(data.shape, dtype=np.int32)
+
+    def label_tile(window):
+        row, col, nrows, ncols = window
+        tile = labelled[row:row + nrows, col:col + ncols]
+        _, nlabels = _label_tile(data[row:row + nrows, col:col + ncols], output=tile)
+        return _TileLabels(tile, nlabels, window, cols)
+
+    def relabel_tile(window_lookup):
+        row, col, nrows, ncols = window_lookup[0]
+        tile = labelled[row:row + nrows, col:col + ncols]
+        tile[...] = window_lookup[1][tile]
+
+    pool = ThreadPool(workers)
+    try:
+        tiles = pool.map(label_tile, windows)
+        lookups, nlabels = _merge_tile_labels(tiles, data.shape, tile_shape)
+        pool.map(relabel_tile, list(zip(windows, lookups)))
+    finally:
+        pool.close()
+        pool.join()
     return labelled, nlabels
 
 
+def _label_tile(data, output=None):
+    """Label connected components of a tile. Labels are numbered in raster scan order of the first cell of each label"""
+    import scipy.ndimage
+    if output is not None:
+        # scipy returns only the number of labels when given an output array
+        return output, scipy.ndimage.label(data, structure=_CONNECTIVITY, output=output)
+    return scipy.ndimage.label(data, structure=_CONNECTIVITY)
+
+
+def _tile_windows(shape, tile_shape):
+    """Windows of the tiles covering a raster in raster scan order of the tiles"""
+    grid = tile_grid_shape(shape, tile_shape)
+    return [tile_window(shape, tile_shape, (i, j)) for i in range(grid[0]) for j in range(grid[1])]
+
+
+class _TileLabels(object):
+    """Local labels of a tile labelled by `_label_tile`
+
+    Only the edge rows and columns of the labels are kept. If data is given the `_zonal_reduce` stats of data are kept.
+    """
+    def __init__(self, labelled, nlabels, window, cols, data=None):
+        self.window = window
+        self.nlabels = nlabels
+        self.top = labelled[0].copy()
+        self.bottom = labelled[-1].copy()
+        self.left = labelled[:, 0].copy()
+        self.right = labelled[:, -1].copy()
+        # Labels are numbered in order of their first cell. A first cell has a higher label than all cells before it
+        flat = labelled.ravel()
+        first = np.flatnonzero(flat[1:] > np.maximum.accumulate(flat)[:-1]) + 1
+        if flat.size and flat[0] > 0:
+            first = np.concatenate(([0], first))
+        row, col = np.divmod(first, labelled.shape[1])
+        # Linear index in the raster of the first cell of each local label
+        self.first = (row + window[0]) * cols + col + window[1]
+        self.stats = None
+        if data is not None:
+            self.stats = _zonal_reduce(labelled, nlabels, [(data, _ZONAL_DEFAULT_REDUCTIONS, None)])
+
+
+def _seam_pairs(a, b):
+    """Pairs of labels of cells in the adjacent lines a and b which are 8-connected"""
+    pairs = []
+    for shift in (-1, 0, 1):
+        if shift < 0:
+            pa, pb = a[-shift:], b[:shift]
+        elif shift > 0:
+            pa, pb = a[:-shift], b[shift:]
+        else:
+            pa, pb = a, b
+        both = (pa > 0) & (pb > 0)
+        pairs.append(np.stack((pa[both], pb[both]), axis=1))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def _union_find_roots(nlabels, pairs):
+    """Union pairs of labels in the range [0;nlabels]. Returns the root of each label"""
+    parent = list(range(nlabels + 1))
+
+    def find(x):
+        while parent[x] != x:
+            # Path halving
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in pairs.tolist():
+        ra = find(a)
+        rb = find(b)
+        if ra != rb:
+            # Smallest label is root
+            if ra < rb:
+                parent[rb] = ra
+            else:
+                parent[ra] = rb
+    roots = np.array(parent, dtype=np.int64)
+    # Pointer jumping until every label points to its root
+    while True:
+        next_roots = roots[roots]
+        if np.array_equal(next_roots, roots):
+            return roots
+        roots = next_roots
+
+
+def _merge_tile_labels(tiles, shape, tile_shape, keep_function=None):
+    """Merge the local labels of tiles across the tile seams.
+
+    Local labels are given unique provisional labels which are merged using union-find. Merged labels are numbered in
+    raster scan order of their first cell. Returns the final label of each local label of each tile and the number of
+    final labels. See `connected_components_tiled`
+    """
+    rows, cols = shape
+    grid = tile_grid_shape(shape, tile_shape)
+
+    # Provisional label of local label n of a tile is offset + n
+    offsets = np.cumsum([0] + [t.nlabels for t in tiles])
+    nprovisional = int(offsets[-1])
+
+    def provisional(k, local):
+        return np.where(local > 0, local + offsets[k], 0)
+
+    def tile_index(i, j):
+        return i * grid[1] + j
+
+    # Merge labels across seams
+    pairs = [np.empty((0, 2), dtype=np.int64)]
+    for i in range(1, grid[0]):
+        above = [provisional(tile_index(i - 1, j), tiles[tile_index(i - 1, j)].bottom) for j in range(grid[1])]
+        below = [provisional(tile_index(i, j), tiles[tile_index(i, j)].top) for j in range(grid[1])]
+        pairs.append(_seam_pairs(np.concatenate(above), np.concatenate(below)))
+    for j in range(1, grid[1]):
+        left = [provisional(tile_index(i, j - 1), tiles[tile_index(i, j - 1)].right) for i in range(grid[0])]
+        right = [provisional(tile_index(i, j), tiles[tile_index(i, j)].left) for i in range(grid[0])]
+        pairs.append(_seam_pairs(np.concatenate(left), np.concatenate(right)))
+    roots = _union_find_roots(nprovisional, np.concatenate(pairs))
+
+    # Renumber roots in raster scan order of their first cell
+    first = np.full(nprovisional + 1, rows * cols, dtype=np.int64)
+    for k, tile in enumerate(tiles):
+        np.minimum.at(first, roots[offsets[k] + 1:offsets[k + 1] + 1], tile.first)
+    ordered_roots = np.flatnonzero(roots == np.arange(nprovisional + 1))[1:]
+    ordered_roots = ordered_roots[np.argsort(first[ordered_roots], kind='stable')]
+    final = np.zeros(nprovisional + 1, dtype=np.int32)
+    final[ordered_roots] = np.arange(1, len(ordered_roots) + 1)
+    nlabels = len(ordered_roots)
+
+    # Final label of each local label. Background stays 0
+    lookups = []
+    for k, tile in enumerate(tiles):
+        lookup = final[roots[offsets[k]:offsets[k + 1] + 1]]
+        lookup[0] = 0
+        lookups.append(lookup)
+
+    if keep_function is not None:
+        dtype = [('min', np.float64), ('max', np.float64), ('sum', np.float64), ('count', np.int64)]
+        stats = np.zeros((nlabels + 1,), dtype=dtype)
+        stats['min'] = float('inf')
+        stats['max'] = float('-inf')
+        for tile, lookup in zip(tiles, lookups):
+            count, (tile_stats,) = tile.stats
+            np.minimum.at(stats['min'], lookup, tile_stats['min'])
+            np.maximum.at(stats['max'], lookup, tile_stats['max'])
+            np.add.at(stats['sum'], lookup, tile_stats['sum'])
+            np.add.at(stats['count'], lookup, count)
+        # Like `compact_labels`
+        keep_array = np.array(keep_function(stats)).astype(bool)
+        keep_array[0] = False
+        kept = np.flatnonzero(keep_array)
+        compacted = np.zeros(len(keep_array), dtype=np.int32)
+        compacted[kept] = np.arange(1, len(kept) + 1)
+        lookups = [compacted[lookup] for lookup in lookups]
+        nlabels = len(kept)
+    return lookups, nlabels
+
+
+def connected_components_tiled(read_window, write_window, shape, tile_shape=DEFAULT_TILE_SHAPE, workers=1,
+                               keep_function=None):
+    """Label connected components one tile at a time.
+
+    Gives the same labels as `connected_components`. Tiles are labelled by `workers` threads and labels touching
+    across the tile seams (8-connectivity) are merged using union-find. Labels are then renumbered in raster scan
+    order of their first cell. Only the edges of the tiles are kept in memory, so each tile is read and labelled again
+    before it is written. This makes it possible to label rasters which are larger than the available memory.
+
+    Parameters
+    ----------
+    read_window : callable
+        Called as `read_window(row, col, nrows, ncols)`. Must return the data of the window as 2D numpy array. Non-zero
+        values are features. Always called from the calling thread
+    write_window : callable
+        Called as `write_window(data, row, col)` once for each tile with the int32 labels of the tile. Always called
+        from the calling thread
+    shape : (int, int)
+        Shape of the raster (rows, cols)
+    tile_shape : (int, int)
+        Shape of the tiles (rows, cols)
+    workers : int
+        Number of threads
+    keep_function : callable, optional
+        Called as `keep_function(stats)` with the `label_stats` of the data for each label. Must return a list-like
+        object of bools where label n is kept if item n is True. Kept labels are renumbered as in `compact_labels`
+
+    Returns
+    -------
+    nlabels : int
+        Number of labels. Labels are numbered in the range [1;nlabels]. The background is labelled 0.
+
+    """
+    if workers < 1:
+        raise ValueError("Number of workers must be at least 1: {}".format(workers))
+    windows = _tile_windows(shape, tile_shape)
+
+    def label_tile(window_data):
+        window, data = window_data
+        labelled, nlabels = _label_tile(data)
+        return _TileLabels(labelled, nlabels, window, shape[1], data if keep_function is not None else None)
+
+    def relabel_tile(window_data_lookup):
+        window, data, lookup = window_data_lookup
+        labelled, _ = _label_tile(data)
+        return lookup[labelled], window
+
+    def batches(items):
+        # Only a batch of tiles is held in memory at a time
+        for first in range(0, len(items), workers):
+            yield items[first:first + workers]
+
+    # Raster readers like GDAL datasets must not be shared between threads. Tiles are read in the calling thread and
+    # only labelled in the pool
+    pool = ThreadPool(workers)
+    try:
+        tiles = []
+        for batch in batches(windows):
+            tiles.extend(pool.map(label_tile, [(window, read_window(*window)) for window in batch]))
+        lookups, nlabels = _merge_tile_labels(tiles, shape, tile_shape, keep_function)
+        del tiles
+        for batch in batches(list(zip(windows, lookups))):
+            batch = [(window, read_window(*window), lookup) for window, lookup in batch]
+            for labelled, window in pool.map(relabel_tile, batch):
+                write_window(labelled, window[0], window[1])
+    finally:
+        pool.close()
+        pool.join()
+    return nlabels
+
+
+def compact_labels(labelled, keep_label, background=0):
+    """Remove labels and renumber the kept labels densely.
+
+    Gives the same labels as `connected_components` of the `keep_labels` mask when `labelled` is output from
+    `connected_components`, as the kept components are unchanged and the order of the labels is kept. Stats of the
+    kept labels may be subset by `old_labels`.
+
+    Parameters
+    ----------
+    labelled : 2D array
+        Labels in the range [0;nlabels]
+    keep_label : list-like
+        List-like object of same length as number of labels. label n is kept if keep_label[n] == True
+    background : int
+        Label of background. Removed labels are set to background
+
+    Returns
+    -------
+    labelled : ndarray
+        Kept labels numbered in the range [1;nlabels] in the order of the old labels. Background is labelled 0
+    nlabels : int
+        Number of kept labels
+    old_labels : 1D array
+        old_labels[n] is the old label of new label n. old_labels[0] is the background
+
+    """
+    keep_array = np.array(keep_label).astype(bool)
+    # Make sure background label is NOT kept
+    keep_array[background] = False
+    kept = np.flatnonzero(keep_array)
+    lookup = np.zeros(len(keep_array), dtype=labelled.dtype)
+    lookup[kept] = np.arange(1, len(kept) + 1)
+    old_labels = np.concatenate(([background], kept))
+    return lookup[labelled], len(kept), old_labels
+
+
 def label_stats(data, labelled, nlabels=None):
     """Calculate data stats for each label.
 
@@ -180,16 +478,155 @@ def label_count(labelled):
     return np.bincount(labelled.ravel())
 
 
+# Reductions supported by `zonal_stats`
+ZONAL_REDUCTIONS = ('min', 'max', 'sum', 'count', 'argmin', 'argmax', 'histogram')
+_ZONAL_DEFAULT_REDUCTIONS = ('min', 'max', 'sum')
+
+
+def _zonal_reduce(labelled, nlabels, rasters):
+    """Reduce each raster for each label. See `zonal_stats`
+
+    Parameters
+    ----------
+    labelled : 2D array of labels in the range [0;nlabels]
+    nlabels : int
+    rasters : list of (data, reductions, edges) triples. edges are the histogram bin edges or None
+
+    Returns
+    -------
+    count : 1D array
+        Number of cells of each label
+    results : list of dicts
+        Maps each reduction of each raster to a 1D array with an item per label. argmin and argmax are linear indexes
+        or -1. histogram is a 2D array with a row per label
+
+    """
+    labels = labelled.ravel()
+    if labels.size and (labels.min() < 0 or labels.max() > nlabels):
+        raise ValueError("Labels must be in the range [0;nlabels]")
+    count = np.bincount(labels, minlength=nlabels + 1)
+    results = []
+    for data, reductions, edges in rasters:
+        values = data.ravel().astype(np.float64, copy=False)
+        result = {}
+        if 'sum' in reductions:
+            result['sum'] = np.bincount(labels, weights=values, minlength=nlabels + 1)
+        if 'count' in reductions:
+            result['count'] = np.bincount(labels[~np.isnan(values)], minlength=nlabels + 1)
+        # NaN values are ignored. Ties go to the first cell in row major order
+        for name, arg, ufunc, initial in (('min', 'argmin', np.fmin, np.inf), ('max', 'argmax', np.fmax, -np.inf)):
+            if name not in reductions and arg not in reductions:
+                continue
+            extreme = np.full(nlabels + 1, initial)
+            ufunc.at(extreme, labels, values)
+            if name in reductions:
+                result[name] = extreme
+            if arg in reductions:
+                index = np.full(nlabels + 1, labels.size, dtype=np.int64)
+                hits = np.flatnonzero((values == extreme[labels]) & (values != initial))
+                np.minimum.at(index, labels[hits], hits)
+                index[index == labels.size] = -1
+                result[arg] = index
+        if 'histogram' in reductions:
+            nbins = len(edges) - 1
+            bin_index = np.searchsorted(edges, values, side='right') - 1
+            # Like numpy.histogram the last bin includes its right edge
+            bin_index[values == edges[-1]] = nbins - 1
+            inside = (bin_index >= 0) & (bin_index < nbins)
+            histogram = np.bincount(labels[inside] * nbins + bin_index[inside], minlength=(nlabels + 1) * nbins)
+            result['histogram'] = histogram.reshape(nlabels + 1, nbins)
+        results.append(result)
+    return count, results
+
+
+def zonal_stats(labelled, values, reductions=None, nlabels=None, bins=None):
+    """Calculate reductions of several data rasters for each label in one pass.
+
+    Parameters
+    ----------
+    labelled : 2D array
+        Labels in the range [0;nlabels]
+    values : dict
+        Maps a name to a 2D data array of the same shape as `labelled`
+    reductions : dict, optional
+        Maps a name in `values` to a sequence of reductions. See `ZONAL_REDUCTIONS`. Defaults to min, max and sum.
+        'count' is the number of cells with a value which is not NaN. NaN values are ignored by min, max, argmin, argmax
+        and histogram
+    nlabels : int, optional
+        Number of labels (np.max(labelled))
+    bins : dict, optional
+        Maps a name to the bin edges of its 'histogram' reduction. Like `numpy.histogram` the last bin includes its
+        right edge
+
+    Returns
+    -------
+    Structured array with a record for each label 0..nlabels. Field 'count' holds the number of cells with the label.
+    Field '<name>_<reduction>' holds a reduction of the named data. 'argmin' and 'argmax' are given as the fields
+    '<name>_argmin_row' and '<name>_argmin_col' which are -1 if the label has no cell with a value. The first cell in
+    row major order is used in case of ties. 'histogram' is a field of bin counts
+
+    """
+    reductions = reductions or {}
+    bins = bins or {}
+    if nlabels is None:
+        nlabels = int(np.max(labelled)) if labelled.size else 0
+    cols = labelled.shape[1]
+
+    rasters = []
+    dtype = [('count', np.int64)]
+    for name, data in values.items():
+        if data.shape != labelled.shape:
+            raise ValueError("Data '{}' and labels must have the same shape".format(name))
+        requested = tuple(reductions.get(name, _ZONAL_DEFAULT_REDUCTIONS))
+        unknown = set(requested) - set(ZONAL_REDUCTIONS)
+        if unknown:
+            raise ValueError("Unknown reductions: {}".format(', '.join(sorted(unknown))))
+        edges = None
+        if 'histogram' in requested:
+            if name not in bins:
+                raise ValueError("Bin edges are required for the histogram of '{}'".format(name))
+            edges = np.asarray(bins[name], dtype=np.float64)
+            if edges.ndim != 1 or len(edges) < 2 or np.any(np.diff(edges) <= 0):
+                raise ValueError("Bin edges must increase monotonically")
+        rasters.append((data, requested, edges))
+        for reduction in requested:
+            field = '{}_{}'.format(name, reduction)
+            if reduction in ('argmin', 'argmax'):
+                dtype += [(field + '_row', np.int64), (field + '_col', np.int64)]
+            elif reduction == 'histogram':
+                dtype.append((field, np.int64, (len(edges) - 1,)))
+            elif reduction == 'count':
+                dtype.append((field, np.int64))
+            else:
+                dtype.append((field, np.float64))
+
+    count, results = _zonal_reduce(labelled, nlabels, rasters)
+    table = np.zeros((nlabels + 1,), dtype=dtype)
+    table['count'] = count
+    for (name, _), result in zip(values.items(), results):
+        for reduction, reduced in result.items():
+            field = '{}_{}'.format(name, reduction)
+            if reduction in ('argmin', 'argmax'):
+                row, col = np.divmod(reduced, cols)
+                table[field + '_row'] = np.where(reduced < 0, -1, row)
+                table[field + '_col'] = np.where(reduced < 0, -1, col)
+            else:
+                table[field] = reduced
+    return table
+
 
 def label_data(data, labelled, nlabels=None, background=0):
     """Gathers all cell values for each label.
 
+    Values are sorted by label using a counting sort and returned in compressed sparse row (CSR) form. Values of each
+    label are kept in row major order.
+
     Parameters
     ----------
     data : ndarray
         Data array of same dimensions as labelled
     labelled: ndarray
-        An integer ndarray where each value indicates a unique feature.
+        An integer ndarray where each value indicates a unique feature in the range [0;nlabels]
     nlabels: int
         Number of labels (np.max(labelled))
     background: int
@@ -197,25 +634,28 @@ def label_data(data, labelled, nlabels=None, background=0):
 
     Returns
     -------
-        data_per_label: list of lists
-            A list (length = nlabels) of lists which holds the data values. The data for label n are found at data_per_label[n]
+        values : 1D array
+            Data values sorted by label
+        offsets : 1D array
+            Array of length nlabels + 2. The data for label n are found at values[offsets[n]:offsets[n + 1]]
     """
     if not nlabels:
         nlabels = np.max(labelled)
-    
-    # Init list of lists
-    l = [[] for x in range(nlabels + 1)]
-    
-    # Collect data per label
-    ravelled_labelled = labelled.ravel()
-    ravelled_data = data.ravel()
-    for ix in range(len(ravelled_labelled)):
-        label_id = ravelled_labelled[ix]
-        data_value = ravelled_data[ix]
-        if label_id == background:
-            continue
-        l[label_id].append(data_value)
-    return l
+
+    labels = labelled.ravel()
+    if labels.size and (labels.min() < 0 or labels.max() > nlabels):
+        raise ValueError("Labels must be in the range [0;nlabels]")
+    counts = np.bincount(labels, minlength=nlabels + 1)
+    if 0 <= background <= nlabels:
+        counts[background] = 0
+    offsets = np.zeros(nlabels + 2, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    # Stable sort of the cells by label keeps the row major order within each label
+    cells = np.flatnonzero(labels != background)
+    cells = cells[np.argsort(labels[cells], kind='stable')]
+    values = data.ravel()[cells]
+    return values, offsets
 
 
 def set_label_to_value(labelled, bluespot_values):
@@ -15,7 +15,12 @@ from __future__ import (absolute_import, division, print_function) #, unicode_li
 from builtins import *
 import numpy as np
 from collections import defaultdict
-from .flow import trace_downstream
+from .flow import trace_downstream, downstream_path, FlowGraph, cell_in_raster
+
+# Memo states of `_next_downstream_cells`. Resolved cells hold a linear index or _NO_CELL
+_NO_CELL = -1
+_UNVISITED = -2
+_ON_PATH = -3
 
 
 def _pourpoint_enumerator(pour_points):
@@ -139,12 +144,27 @@ def _untangle(nodes, next_available_label):
             yield group[0], next_available_label
 
 
+def _next_downstream_cell(flowdir, labeled, cell, background_label=None):
+    """Linear index of the first cell downstream of cell with another label than cell. -1 if there is none"""
+    rows, cols = flowdir.shape
+    src_label = labeled[cell[0], cell[1]]
+    for steps, c in enumerate(trace_downstream(flowdir, cell)):
+        if steps == rows * cols:
+            # Flow direction cycle
+            break
+        lbl = labeled[c[0], c[1]]
+        if not lbl == src_label:
+            if background_label is None or not lbl == background_label:
+                return c[0] * cols + c[1]
+    return -1
+
+
 def next_downstream_label(flowdir, labeled, cell, background_label=None, geometry=False):
     """Find next label downstream from cell
 
     Parameters
     ----------
-    flowdir
+    flowdir : 2D array of flow directions or flow.FlowGraph
     labeled : 2D array
         Either labeled blue spots or labeled local watersheds of bluespots
     cell
@@ -155,18 +175,108 @@ def next_downstream_label(flowdir, labeled, cell, background_label=None, geometr
 
     Returns
     -------
+    label : int or None
+    geom : (n, 2) array
+        Cells (row, col) from cell to the next label. See `flow.downstream_path`. Empty unless `geometry` is True
 
     """
-    src_label = labeled[cell[0], cell[1]]
-    geom = []
-    for c in trace_downstream(flowdir, cell):
-        lbl = labeled[c[0], c[1]]
-        if geometry:
-            geom.append(c)
-        if not lbl == src_label:
-            if background_label is None or not lbl == background_label:
-                return int(lbl), geom
-    return None, geom
+    if not cell_in_raster(flowdir.shape, cell):
+        return None, np.empty((0, 2), dtype=np.intp)
+    found = _next_downstream_cell(flowdir, labeled, cell, background_label)
+    cols = flowdir.shape[1]
+    end = divmod(found, cols) if found >= 0 else None
+    geom = downstream_path(flowdir, cell, end) if geometry else np.empty((0, 2), dtype=np.intp)
+    if end is None:
+        return None, geom
+    return int(labeled[end[0], end[1]]), geom
+
+
+def _resolve_first(receivers, labels, first, cell, background_label):
+    """First cell downstream of `cell` with another label, given the memoized first cell of its downstream cell"""
+    downstream = receivers[cell]
+    if downstream < 0:
+        return _NO_CELL
+    lbl = labels[cell]
+    downstream_lbl = labels[downstream]
+    if downstream_lbl == lbl:
+        return first[downstream]
+    if background_label is None or downstream_lbl != background_label:
+        return downstream
+    # Downstream cell is background. Its first cell is the next labelled cell
+    found = first[downstream]
+    if found >= 0 and labels[found] == lbl:
+        found = first[found]
+    return found
+
+
+def _next_downstream_cells(receivers, labels, starts, background_label=None):
+    """Linear index of the first cell downstream of each start cell with another label than the start cell.
+
+    `receivers` and `labels` are 1D. The first cell downstream of every cell visited is memoized, so each cell is
+    traversed at most once in total (cells in a flow direction cycle twice). Returns a 1D int64 array holding -1 where
+    no such cell exists.
+    """
+    receivers = receivers.tolist()
+    labels = labels.tolist()
+    first = [_UNVISITED] * len(receivers)
+    path = []
+    for start in starts.tolist():
+        # Walk downstream until a resolved cell
+        cell = start
+        while cell >= 0 and first[cell] == _UNVISITED:
+            first[cell] = _ON_PATH
+            path.append(cell)
+            cell = receivers[cell]
+        if cell >= 0 and first[cell] == _ON_PATH:
+            # The path ends in a flow direction cycle. Going around it twice from its last cell lets every cell in the
+            # cycle see all other cells of the cycle downstream
+            cycle = path[path.index(cell):]
+            del path[-len(cycle):]
+            for c in cycle:
+                first[c] = _NO_CELL
+            for c in reversed(cycle * 2):
+                first[c] = _resolve_first(receivers, labels, first, c, background_label)
+        # Resolve the walked cells from downstream and up
+        while path:
+            cell = path.pop()
+            first[cell] = _resolve_first(receivers, labels, first, cell, background_label)
+    return np.array([first[start] for start in starts.tolist()], dtype=np.int64)
+
+
+def next_downstream_labels(flowdir, labeled, cells, background_label=None):
+    """Find next label downstream from each of several cells.
+
+    Gives the same labels as calling `next_downstream_label` for each cell. Downstream paths shared by several cells are
+    only traversed once.
+
+    Parameters
+    ----------
+    flowdir : 2D array of flow directions or flow.FlowGraph
+    labeled : 2D array
+        Either labeled blue spots or labeled local watersheds of bluespots
+    cells : iterable of pairs of ints (row, col)
+    background_label : int
+        Value of background (non-labeled) cells
+
+    Returns
+    -------
+    labels : list
+        Next label downstream from each cell or None
+    found : 1D array
+        Linear index of the cell where the next label was found or -1
+
+    """
+    if not isinstance(flowdir, FlowGraph):
+        flowdir = FlowGraph(flowdir)
+    cols = flowdir.shape[1]
+    cells = [tuple(c) for c in cells]
+    inside = np.array([cell_in_raster(flowdir.shape, c) for c in cells], dtype=bool)
+    starts = np.array([r * cols + c for r, c in cells], dtype=np.int64).reshape(-1)
+    found = np.full(len(cells), -1, dtype=np.int64)
+    found[inside] = _next_downstream_cells(flowdir.receivers, labeled.reshape(-1), starts[inside], background_label)
+    flat = labeled.reshape(-1)
+    labels = [int(flat[i]) if i >= 0 else None for i in found.tolist()]
+    return labels, found
 
 
 def pourpoint_network(flowdir, labeled, pour_points, background_label=None):
@@ -174,7 +284,7 @@ def pourpoint_network(flowdir, labeled, pour_points, background_label=None):
 
     Parameters
     ----------
-    flowdir
+    flowdir : 2D array of flow directions or flow.FlowGraph
     labeled
     pour_points : list-like
         List-like structure where pour_point[n] is the pour_point of blue spot with label n
@@ -184,9 +294,12 @@ def pourpoint_network(flowdir, labeled, pour_points, background_label=None):
     -------
 
     """
+    if not isinstance(flowdir, FlowGraph):
+        flowdir = FlowGraph(flowdir)
+    pour_points = list(_pourpoint_enumerator(pour_points))
+    down_lbls, _ = next_downstream_labels(flowdir, labeled, [pp for _, pp in pour_points], background_label)
     net = []
-    for id, pp in _pourpoint_enumerator(pour_points):
-        down_lbl, _ = next_downstream_label(flowdir, labeled, pp, background_label, geometry=False)
+    for (id, pp), down_lbl in zip(pour_points, down_lbls):
         node = dict(id=id, downstream_id=down_lbl, nodetype='pourpoint', pix=tuple(pp))
         net.append(node)
     return net
@@ -197,7 +310,7 @@ def geometric_pourpoint_network(flowdir, labeled_bluespots, pour_points, backgro
 
     Parameters
     ----------
-    flowdir
+    flowdir : 2D array of flow directions or flow.FlowGraph
     labeled_bluespots : 2D array
         2D array of labeled bluespots
     pour_points : list-like
@@ -208,9 +321,16 @@ def geometric_pourpoint_network(flowdir, labeled_bluespots, pour_points, backgro
     -------
 
     """
+    if not isinstance(flowdir, FlowGraph):
+        flowdir = FlowGraph(flowdir)
+    pour_points = list(_pourpoint_enumerator(pour_points))
+    down_lbls, found = next_downstream_labels(flowdir, labeled_bluespots, [pp for _, pp in pour_points],
+                                              background_label)
     upstream_nodes = defaultdict(list)
-    for pid, pp in _pourpoint_enumerator(pour_points):
-        down_lbl, geom = next_downstream_label(flowdir, labeled_bluespots, pp, background_label, geometry=True)
+    cols = flowdir.shape[1]
+    for (pid, pp), down_lbl, end in zip(pour_points, down_lbls, found.tolist()):
+        path = downstream_path(flowdir, pp, divmod(end, cols) if end >= 0 else None)
+        geom = [tuple(c) for c in path.tolist()]
         node = dict(id=pid, downstream_id=down_lbl, nodetype='pourpoint', pix=tuple(pp), geometry=geom)
         upstream_nodes[down_lbl].append(node)
 
@@ -17,10 +17,10 @@ Speedups are enabled by default if they are available.
 """
 import warnings
 
-from .. import flow, fill, label
+from .. import flow, fill, flats, label, net
 
 try:
-    from malstroem.algorithms.speedups import _fill, _flow, _label
+    from malstroem.algorithms.speedups import _fill, _flow, _flats, _label, _net
     available = True
     import_error_msg = None
 except ImportError:
@@ -45,26 +45,60 @@ def enable():
         return
 
     # Fill
-    _orig['fill._fill_terrain'] = fill._fill_terrain
-    fill._fill_terrain = _fill._fill_terrain
+    _orig['fill._fill_blocks'] = fill._fill_blocks
+    fill._fill_blocks = _fill._fill_blocks
 
-    _orig['fill._fill_terrain_no_flats'] = fill._fill_terrain_no_flats
-    fill._fill_terrain_no_flats = _fill._fill_terrain_no_flats
+    _orig['fill._fill_blocks_no_flats'] = fill._fill_blocks_no_flats
+    fill._fill_blocks_no_flats = _fill._fill_blocks_no_flats
+
+    _orig['fill._priority_flood'] = fill._priority_flood
+    fill._priority_flood = _fill._priority_flood
+
+    _orig['fill._priority_flood_no_flats'] = fill._priority_flood_no_flats
+    fill._priority_flood_no_flats = _fill._priority_flood_no_flats
+
+    _orig['fill._priority_flood_fused'] = fill._priority_flood_fused
+    fill._priority_flood_fused = _fill._priority_flood_fused
+
+    _orig['fill._priority_flood_labels'] = fill._priority_flood_labels
+    fill._priority_flood_labels = _fill._priority_flood_labels
+
+    _orig['fill._flood_spill_graph'] = fill._flood_spill_graph
+    fill._flood_spill_graph = _fill._flood_spill_graph
+
+    _orig['fill._refill'] = fill._refill
+    fill._refill = _fill._refill
 
     # Accumulated flow
     _orig['flow.trace_accumulated_flow'] = flow.trace_accumulated_flow
     flow.trace_accumulated_flow = _flow.trace_accumulated_flow
 
-    _orig['flow.accumulated_flow'] = flow.accumulated_flow
-    flow.accumulated_flow = _flow.accumulated_flow
+    _orig['flow._accumulate'] = flow._accumulate
+    flow._accumulate = _flow.accumulate
 
     # Flow directions
     _orig['flow._terrain_flow'] = flow._terrain_flow
     flow._terrain_flow = _flow.terrain_flow
 
+    _orig['flow._terrain_flow_rows'] = flow._terrain_flow_rows
+    flow._terrain_flow_rows = _flow.terrain_flow_rows
+
+    _orig['flats._resolve_flats'] = flats._resolve_flats
+    flats._resolve_flats = _flats._resolve_flats
+
     # Watershed
-    _orig['flow.assign_watersheds_upstream'] = flow.assign_watersheds_upstream
-    flow.assign_watersheds_upstream = _flow.assign_watersheds_upstream
+    _orig['flow._watersheds_from_labels'] = flow._watersheds_from_labels
+    flow._watersheds_from_labels = _flow.watersheds_from_labels
+
+    # Network
+    _orig['flow._downstream_path'] = flow._downstream_path
+    flow._downstream_path = _flow.downstream_path
+
+    _orig['net._next_downstream_cell'] = net._next_downstream_cell
+    net._next_downstream_cell = _net.next_downstream_cell
+
+    _orig['net._next_downstream_cells'] = net._next_downstream_cells
+    net._next_downstream_cells = _net.next_downstream_cells
 
     # Label
     _orig['label.label_stats'] = label.label_stats
@@ -73,36 +107,80 @@ def enable():
     _orig['label.label_min_index'] = label.label_min_index
     label.label_min_index = _label.label_min_index
 
+    _orig['label.label_max_index'] = label.label_max_index
+    label.label_max_index = _label.label_max_index
+
     _orig['label.label_data'] = label.label_data
     label.label_data = _label.label_data
 
+    _orig['label._zonal_reduce'] = label._zonal_reduce
+    label._zonal_reduce = _label.zonal_reduce
+
     global enabled
     enabled = True
 
 
 def disable():
     """Disable Cython speedups
+
+    Fills and flow directions fall back to the vectorized NumPy versions like when the speedups are not available.
     """
     if not _orig:
         return
-    fill._fill_terrain = _orig['fill._fill_terrain']
-    fill._fill_terrain_no_flats = _orig['fill._fill_terrain_no_flats']
+    fill._fill_blocks = _orig['fill._fill_blocks']
+    fill._fill_blocks_no_flats = _orig['fill._fill_blocks_no_flats']
+    fill._priority_flood = _orig['fill._priority_flood']
+    fill._priority_flood_no_flats = _orig['fill._priority_flood_no_flats']
+    fill._priority_flood_fused = _orig['fill._priority_flood_fused']
+    fill._priority_flood_labels = _orig['fill._priority_flood_labels']
+    fill._flood_spill_graph = _orig['fill._flood_spill_graph']
+    fill._refill = _orig['fill._refill']
 
     flow.trace_accumulated_flow = _orig['flow.trace_accumulated_flow']
-    flow.accumulated_flow = _orig['flow.accumulated_flow']
+    flow._accumulate = _orig['flow._accumulate']
     flow._terrain_flow = _orig['flow._terrain_flow']
-    flow.assign_watersheds_upstream = _orig['flow.assign_watersheds_upstream']
+    flow._terrain_flow_rows = _orig['flow._terrain_flow_rows']
+    flats._resolve_flats = _orig['flats._resolve_flats']
+    flow._watersheds_from_labels = _orig['flow._watersheds_from_labels']
+
+    flow._downstream_path = _orig['flow._downstream_path']
+    net._next_downstream_cell = _orig['net._next_downstream_cell']
+    net._next_downstream_cells = _orig['net._next_downstream_cells']
 
     label.label_stats = _orig['label.label_stats']
     label.label_min_index = _orig['label.label_min_index']
+    label.label_max_index = _orig['label.label_max_index']
     label.label_data = _orig['label.label_data']
+    label._zonal_reduce = _orig['label._zonal_reduce']
 
     _orig.clear()
+    _use_vectorized_fill()
+    _use_vectorized_flow()
 
     global enabled
     enabled = False
 
 
+def _use_vectorized_fill():
+    """Use the vectorized NumPy fill when the Cython speedups are not available or disabled. It gives the same output
+    as the pure Python floods but is usable on large rasters.
+    """
+    fill._priority_flood = fill._reconstruction_fill
+    fill._priority_flood_no_flats = fill._reconstruction_fill
+    fill._priority_flood_fused = fill._reconstruction_fill_fused
+
+
+def _use_vectorized_flow():
+    """Use the vectorized NumPy flow directions when the Cython speedups are not available or disabled. It gives the
+    same output as the compiled version.
+    """
+    flow._terrain_flow = flow._terrain_flow_vectorized
+    flow._terrain_flow_rows = flow._terrain_flow_rows_vectorized
+
+
 # if cython speedups are available, use them by default
 if available:
     enable()
+else:
+    _use_vectorized_fill()
+    _use_vectorized_flow()
@@ -0,0 +1,110 @@
+# coding=utf-8
+# -------------------------------------------------------------------------------------------------
+# Copyright (c) 2016
+# Developed by Septima.dk and Thomas Balstrøm (University of Copenhagen) for the Danish Agency for
+# Data Supply and Efficiency. This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free Software Foundation,
+# either version 2 of the License, or (at you option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PORPOSE. See the GNU Gene-
+# ral Public License for more details.
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see http://www.gnu.org/licenses/.
+# -------------------------------------------------------------------------------------------------
+
+# D8 steepest descent shared by the flow direction and fill kernels.
+
+cimport cython
+from libc.math cimport sqrt
+from ._definitions cimport DTYPE_t_FLOWDIR, DTYPE_t_FLOOD
+
+cdef enum:
+    D8_UP        = 0
+    D8_UPRIGHT   = 1
+    D8_RIGHT     = 2
+    D8_DOWNRIGHT = 3
+    D8_DOWN      = 4
+    D8_DOWNLEFT  = 5
+    D8_LEFT      = 6
+    D8_UPLEFT    = 7
+    D8_NODIR     = 8
+
+
+cdef inline DTYPE_t_FLOWDIR d8_direction(DTYPE_t_FLOOD[:, :] terrain, Py_ssize_t r, Py_ssize_t c) noexcept nogil:
+    """Steepest downslope direction from interior cell (r, c). Ties go to the first direction in AGNPS order.
+
+    Slopes are calculated in the precision of the terrain. Diagonal slopes are scaled in double precision.
+    """
+    cdef DTYPE_t_FLOOD z, dz, dzmax
+    cdef double inv_sqrt2 = 1 / sqrt(2.0)
+    cdef DTYPE_t_FLOWDIR i
+    cdef Py_ssize_t up = r - 1, down = r + 1, left = c - 1, right = c + 1
+
+    with cython.boundscheck(False), cython.wraparound(False):
+        z = terrain[r, c]
+        i = D8_NODIR
+        dzmax = 0.0
+
+        dz = (z - terrain[up, c])
+        if dz > dzmax:
+            dzmax = dz
+            i = D8_UP
+        dz = (z - terrain[up, right]) * inv_sqrt2
+        if dz > dzmax:
+            dzmax = dz
+            i = D8_UPRIGHT
+        dz = (z - terrain[r, right])
+        if dz > dzmax:
+            dzmax = dz
+            i = D8_RIGHT
+        dz = (z - terrain[down, right]) * inv_sqrt2
+        if dz > dzmax:
+            dzmax = dz
+            i = D8_DOWNRIGHT
+        dz = (z - terrain[down, c])
+        if dz > dzmax:
+            dzmax = dz
+            i = D8_DOWN
+        dz = (z - terrain[down, left]) * inv_sqrt2
+        if dz > dzmax:
+            dzmax = dz
+            i = D8_DOWNLEFT
+        dz = (z - terrain[r, left])
+        if dz > dzmax:
+            dzmax = dz
+            i = D8_LEFT
+        dz = (z - terrain[up, left]) * inv_sqrt2
+        if dz > dzmax:
+            dzmax = dz
+            i = D8_UPLEFT
+        return i
+
+
+cdef inline DTYPE_t_FLOWDIR d8_flowdir(DTYPE_t_FLOWDIR[:, :] flowdir, bint packed, Py_ssize_t r,
+                                       Py_ssize_t c) noexcept nogil:
+    """Flow direction of cell (r, c). Packed flow directions hold two cells per byte. See `flow.PackedFlowdir`"""
+    cdef DTYPE_t_FLOWDIR value
+    with cython.boundscheck(False), cython.wraparound(False):
+        if not packed:
+            return flowdir[r, c]
+        value = flowdir[r, c >> 1]
+    return value >> 4 if c & 1 else value & 15
+
+
+cdef inline Py_ssize_t d8_receiver(DTYPE_t_FLOWDIR[:, :] flowdir, bint packed, Py_ssize_t cols, Py_ssize_t r,
+                                   Py_ssize_t c) noexcept nogil:
+    """Linear index of the downstream cell of (r, c) in a raster with cols columns. -1 if there is none"""
+    cdef DTYPE_t_FLOWDIR direction = d8_flowdir(flowdir, packed, r, c)
+    cdef Py_ssize_t nr = r, nc = c
+
+    if direction == D8_UP or direction == D8_UPRIGHT or direction == D8_UPLEFT:
+        nr = r - 1
+    elif direction == D8_DOWNRIGHT or direction == D8_DOWN or direction == D8_DOWNLEFT:
+        nr = r + 1
+    if direction == D8_UPRIGHT or direction == D8_RIGHT or direction == D8_DOWNRIGHT:
+        nc = c + 1
+    elif direction == D8_DOWNLEFT or direction == D8_LEFT or direction == D8_UPLEFT:
+        nc = c - 1
+    if direction > D8_UPLEFT or nr < 0 or nr >= flowdir.shape[0] or nc < 0 or nc >= cols:
+        return -1
+    return nr * cols + nc
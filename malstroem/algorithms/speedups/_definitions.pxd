@@ -20,6 +20,26 @@ ctypedef np.float32_t DTYPE_t_FILL
 
 ctypedef np.float64_t DTYPE_t_FILLNOFLAT
 
+# Filled surfaces which may be flooded by the same kernel
+ctypedef fused DTYPE_t_FLOOD:
+    DTYPE_t_FILL
+    DTYPE_t_FILLNOFLAT
+
 ctypedef np.uint8_t   DTYPE_t_FLOWDIR
 
-ctypedef np.float64_t DTYPE_t_ACCUM
\ No newline at end of file
+ctypedef np.float64_t DTYPE_t_ACCUM
+
+# Data values reduced per label
+ctypedef fused DTYPE_t_VALUE:
+    np.float32_t
+    np.float64_t
+
+# Cell labels
+ctypedef fused DTYPE_t_LABEL:
+    np.int32_t
+    np.int64_t
+
+# Linear cell indexes. See `flow.receivers_from_flowdir`
+ctypedef fused DTYPE_t_INDEX:
+    np.int32_t
+    np.int64_t
@@ -14,111 +14,667 @@
 from __future__ import division
 import cython
 import numpy as np
-from ._definitions cimport DTYPE_t_FILL, DTYPE_t_DTM, DTYPE_t_FILLNOFLAT
+from ._definitions cimport DTYPE_t_FILL, DTYPE_t_DTM, DTYPE_t_FILLNOFLAT, DTYPE_t_FLOWDIR, DTYPE_t_FLOOD
+from ._d8 cimport d8_direction
+from ._heap cimport heap_t, heap_item, heap_init, heap_free, heap_push, heap_pop
 cimport numpy as np
+from libc.math cimport INFINITY
 
 
-cdef inline DTYPE_t_FILL fill_float_max(DTYPE_t_FILL a, DTYPE_t_FILL b): return a if a >= b else b
-cdef inline DTYPE_t_FILL fill_float_min(DTYPE_t_FILL a, DTYPE_t_FILL b): return a if a <= b else b
+cdef inline DTYPE_t_FILL fill_float_max(DTYPE_t_FILL a, DTYPE_t_FILL b) nogil: return a if a >= b else b
+cdef inline DTYPE_t_FILL fill_float_min(DTYPE_t_FILL a, DTYPE_t_FILL b) nogil: return a if a <= b else b
 
-cdef inline DTYPE_t_FILLNOFLAT fillnoflat_float_max(DTYPE_t_FILLNOFLAT a, DTYPE_t_FILLNOFLAT b): return a if a >= b else b
-cdef inline DTYPE_t_FILLNOFLAT fillnoflat_float_min(DTYPE_t_FILLNOFLAT a, DTYPE_t_FILLNOFLAT b): return a if a <= b else b
+cdef inline DTYPE_t_FILLNOFLAT fillnoflat_float_max(DTYPE_t_FILLNOFLAT a, DTYPE_t_FILLNOFLAT b) nogil: return a if a >= b else b
+cdef inline DTYPE_t_FILLNOFLAT fillnoflat_float_min(DTYPE_t_FILLNOFLAT a, DTYPE_t_FILLNOFLAT b) nogil: return a if a <= b else b
 
 cimport cython
-@cython.boundscheck(False) # turn of bounds-checking for entire function
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline bint fill_cell(DTYPE_t_FILL[:, :] dtm, DTYPE_t_FILL[:, :] filled, Py_ssize_t row, Py_ssize_t col) noexcept nogil:
+    cdef DTYPE_t_FILL filled_value = filled[row, col]
+    cdef DTYPE_t_FILL dtm_value = dtm[row, col]
+    cdef DTYPE_t_FILL min_value, new_value
+    cdef Py_ssize_t up = row - 1, down = row + 1, left = col - 1, right = col + 1
+    if filled_value <= dtm_value:
+        return False
+    min_value = filled_value
+    min_value = fill_float_min( filled[  up, left],  min_value )
+    min_value = fill_float_min( filled[  up, col],   min_value )
+    min_value = fill_float_min( filled[  up, right], min_value )
+    min_value = fill_float_min( filled[ row, left],  min_value )
+    min_value = fill_float_min( filled[ row, right], min_value )
+    min_value = fill_float_min( filled[down, left],  min_value )
+    min_value = fill_float_min( filled[down, col],   min_value )
+    min_value = fill_float_min( filled[down, right], min_value )
+
+    # Cannot be lower than terrain
+    new_value = fill_float_max(min_value, dtm_value)
+    if new_value != filled_value:
+        filled[row, col] = new_value
+        return True
+    return False
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline bint fill_cell_no_flats(DTYPE_t_DTM[:, :] dtm, DTYPE_t_FILLNOFLAT[:, :] filled, Py_ssize_t row, Py_ssize_t col, DTYPE_t_FILLNOFLAT short, DTYPE_t_FILLNOFLAT diag) noexcept nogil:
+    cdef DTYPE_t_FILLNOFLAT filled_value = filled[row, col]
+    cdef DTYPE_t_FILLNOFLAT dtm_value = dtm[row, col]
+    cdef DTYPE_t_FILLNOFLAT min_value, new_value
+    cdef Py_ssize_t up = row - 1, down = row + 1, left = col - 1, right = col + 1
+    if filled_value <= dtm_value:
+        return False
+    min_value = fillnoflat_float_min(filled[  up, left],
+                    fillnoflat_float_min(filled[  up, right],
+                        fillnoflat_float_min( filled[down, left], filled[down, right]))) + diag
+    min_value = fillnoflat_float_min(min_value,
+                    fillnoflat_float_min(filled[  up, col],
+                        fillnoflat_float_min( filled[ row, left],
+                            fillnoflat_float_min( filled[ row, right], filled[down, col]))) + short)
+    min_value = fillnoflat_float_min(min_value, filled_value)
+
+    # Cannot be lower than terrain
+    new_value = fillnoflat_float_max(min_value, dtm_value)
+    if new_value != filled_value:
+        filled[row, col] = new_value
+        return True
+    return False
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void mark_dirty_block(np.uint8_t[:, :] dirty, Py_ssize_t bi, Py_ssize_t bj) noexcept nogil:
+    # Changes in a block may allow changes in the block itself and in its neighbor blocks
+    cdef Py_ssize_t i, j
+    for i in range(max(bi - 1, 0), min(bi + 2, dirty.shape[0])):
+        for j in range(max(bj - 1, 0), min(bj + 2, dirty.shape[1])):
+            dirty[i, j] = 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _fill_blocks(DTYPE_t_FILL[:, :] dtm not None, DTYPE_t_FILL[:, :] filled not None, np.uint8_t[:, :] dirty not None, Py_ssize_t block_size, int rowstep, int colstep):
+    """Sweep the dirty blocks of the raster interior in one direction.
+
+    `dirty` holds a flag for each block of block_size x block_size interior cells. The flag of a block is cleared when
+    the block is swept. Blocks where a cell changed are flagged again along with their neighbor blocks.
+
+    Returns the number of changed cells.
+    """
+    cdef Py_ssize_t rows = dtm.shape[0], cols = dtm.shape[1]
+    cdef Py_ssize_t brows = dirty.shape[0], bcols = dirty.shape[1]
+    cdef Py_ssize_t i, j, bi, bj, n, m, row, col, r0, r1, c0, c1
+    cdef Py_ssize_t changes, total = 0
+    with nogil:
+        for i in range(brows):
+            bi = i if rowstep > 0 else brows - 1 - i
+            for j in range(bcols):
+                bj = j if colstep > 0 else bcols - 1 - j
+                if not dirty[bi, bj]:
+                    continue
+                dirty[bi, bj] = 0
+                r0 = 1 + bi * block_size
+                r1 = min(r0 + block_size, rows - 1)
+                c0 = 1 + bj * block_size
+                c1 = min(c0 + block_size, cols - 1)
+                changes = 0
+                for n in range(r1 - r0):
+                    row = r0 + n if rowstep > 0 else r1 - 1 - n
+                    for m in range(c1 - c0):
+                        col = c0 + m if colstep > 0 else c1 - 1 - m
+                        changes += fill_cell(dtm, filled, row, col)
+                if changes:
+                    total += changes
+                    mark_dirty_block(dirty, bi, bj)
+    return total
+
+
+@cython.boundscheck(False)
 @cython.wraparound(False)
-def _fill_terrain(np.ndarray[DTYPE_t_FILL, ndim=2] dtm not None, np.ndarray[DTYPE_t_FILL, ndim=2] filled not None, unsigned int fromrow, unsigned int torow, unsigned int fromcol, unsigned int tocol):
-    if fromrow == torow or fromcol == tocol:
-        raise ValueError('Width or height of processing area is zero')
-    cdef int rowstep = 1 if torow > fromrow else -1
-    cdef int colstep = 1 if tocol > fromcol else -1
-
-    cdef DTYPE_t_FILL filled_value, dtm_value, min_value, new_value
-    cdef unsigned int up, down, left, right, row, col
-
-    cdef int changes = 0
-    row = fromrow
-    while row != torow:
-        up = <unsigned int>(row - 1)
-        down = <unsigned int>(row + 1)
-        col = fromcol
-        while col != tocol:
-            filled_value = filled[row,col]
-            dtm_value = dtm[row, col]
-            if(filled_value > dtm_value):
-                left = <unsigned int>(col - 1)
-                right = <unsigned int>(col + 1)
-
-                min_value = filled_value
-                min_value = fill_float_min( filled[  up, left],  min_value )
-                min_value = fill_float_min( filled[  up, col],   min_value )
-                min_value = fill_float_min( filled[  up, right], min_value )
-                min_value = fill_float_min( filled[ row, left],  min_value )
-                min_value = fill_float_min( filled[ row, right], min_value )
-                min_value = fill_float_min( filled[down, left],  min_value )
-                min_value = fill_float_min( filled[down, col],   min_value )
-                min_value = fill_float_min( filled[down, right], min_value )
-
-                # Cannot be lower than terrain
-                new_value = fill_float_max(min_value, dtm_value)
-                if( new_value != filled_value):
-                    filled[row, col] = new_value
-                    changes += 1
-            col += colstep
-        row += rowstep
-
-    return changes
-
-@cython.boundscheck(False) # turn of bounds-checking for entire function
+def _fill_blocks_no_flats(DTYPE_t_DTM[:, :] dtm not None, DTYPE_t_FILLNOFLAT[:, :] filled not None, np.uint8_t[:, :] dirty not None, Py_ssize_t block_size, int rowstep, int colstep, DTYPE_t_FILLNOFLAT short, DTYPE_t_FILLNOFLAT diag):
+    """Like `_fill_blocks` but without flats."""
+    cdef Py_ssize_t rows = dtm.shape[0], cols = dtm.shape[1]
+    cdef Py_ssize_t brows = dirty.shape[0], bcols = dirty.shape[1]
+    cdef Py_ssize_t i, j, bi, bj, n, m, row, col, r0, r1, c0, c1
+    cdef Py_ssize_t changes, total = 0
+    with nogil:
+        for i in range(brows):
+            bi = i if rowstep > 0 else brows - 1 - i
+            for j in range(bcols):
+                bj = j if colstep > 0 else bcols - 1 - j
+                if not dirty[bi, bj]:
+                    continue
+                dirty[bi, bj] = 0
+                r0 = 1 + bi * block_size
+                r1 = min(r0 + block_size, rows - 1)
+                c0 = 1 + bj * block_size
+                c1 = min(c0 + block_size, cols - 1)
+                changes = 0
+                for n in range(r1 - r0):
+                    row = r0 + n if rowstep > 0 else r1 - 1 - n
+                    for m in range(c1 - c0):
+                        col = c0 + m if colstep > 0 else c1 - 1 - m
+                        changes += fill_cell_no_flats(dtm, filled, row, col, short, diag)
+                if changes:
+                    total += changes
+                    mark_dirty_block(dirty, bi, bj)
+    return total
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _priority_flood(DTYPE_t_FILL[:, :] dtm not None, DTYPE_t_FILL[:, :] filled not None):
+    """Fill depressions by flooding inwards from the raster edge.
+
+    Edge cells are seeded in a min-heap. Each cell is finalized the first time it is reached, in order of increasing
+    filled elevation, so every cell is visited exactly once.
+
+    Returns the number of cell updates.
+    """
+    cdef Py_ssize_t rows = dtm.shape[0], cols = dtm.shape[1]
+    cdef np.ndarray[np.uint8_t, ndim=2] npclosed = np.zeros((rows, cols), dtype=np.uint8)
+    cdef np.uint8_t[:, :] closed = npclosed
+    cdef Py_ssize_t[8] drow = [-1, -1, 0, 1, 1, 1, 0, -1]
+    cdef Py_ssize_t[8] dcol = [0, 1, 1, 1, 0, -1, -1, -1]
+    cdef Py_ssize_t r, c, nr, nc, i
+    cdef DTYPE_t_FILL value, new_value
+    cdef heap_t heap
+    cdef heap_item item
+    cdef int err = 0
+    cdef Py_ssize_t updates = 0
+
+    if rows == 0 or cols == 0:
+        return 0
+    if heap_init(&heap, 2 * (rows + cols)) != 0:
+        raise MemoryError()
+    try:
+        with nogil:
+            # Seed edge cells
+            for r in range(rows):
+                for c in range(cols):
+                    if r == 0 or c == 0 or r == rows - 1 or c == cols - 1:
+                        closed[r, c] = 1
+                        err |= heap_push(&heap, filled[r, c], r * cols + c)
+
+            while heap.size > 0 and err == 0:
+                item = heap_pop(&heap)
+                r = item.index // cols
+                c = item.index % cols
+                value = filled[r, c]
+                for i in range(8):
+                    nr = r + drow[i]
+                    nc = c + dcol[i]
+                    if nr < 0 or nc < 0 or nr >= rows or nc >= cols or closed[nr, nc]:
+                        continue
+                    closed[nr, nc] = 1
+                    new_value = fill_float_max(value, dtm[nr, nc])
+                    filled[nr, nc] = new_value
+                    err |= heap_push(&heap, new_value, nr * cols + nc)
+                    updates += 1
+    finally:
+        heap_free(&heap)
+    if err != 0:
+        raise MemoryError()
+    return updates
+
+
+@cython.boundscheck(False)
 @cython.wraparound(False)
-def _fill_terrain_no_flats(np.ndarray[DTYPE_t_DTM, ndim=2] dtm not None, np.ndarray[DTYPE_t_FILLNOFLAT, ndim=2] filled not None, unsigned int fromrow, unsigned int torow, unsigned int fromcol, unsigned int tocol, DTYPE_t_FILLNOFLAT short, DTYPE_t_FILLNOFLAT diag):
-    if fromrow == torow or fromcol == tocol:
-        raise ValueError('Width or height of processing area is zero')
-    cdef int rowstep = 1 if torow > fromrow else -1
-    cdef int colstep = 1 if tocol > fromcol else -1
-
-    cdef DTYPE_t_FILLNOFLAT filled_value, dtm_value, min_value, new_value
-    cdef unsigned int up, down, left, right, row, col
-
-    cdef int changes = 0
-    row = fromrow
-    while row != torow:
-        up = <unsigned int>(row - 1)
-        down = <unsigned int>(row + 1)
-        col = fromcol
-        while col != tocol:
-            filled_value = filled[row,col]
-            dtm_value = dtm[row, col]
-            if filled_value > dtm_value:
-                left = <unsigned int>(col - 1)
-                right = <unsigned int>(col + 1)
-
-    #min_value = filled_value
-    #min_value = min( filled[  up, left]  + diag,  min_value )
-    #min_value = min( filled[  up, col]   + short,   min_value )
-    #min_value = min( filled[  up, right] + diag, min_value )
-    #min_value = min( filled[ row, left]  + short,  min_value )
-    #min_value = min( filled[ row, right] + short, min_value )
-    #min_value = min( filled[down, left]  + diag,  min_value )
-    #min_value = min( filled[down, col]   + short,   min_value )
-    #min_value = min( filled[down, right] + diag, min_value )
-
-                # Do essentially the same as above, but with fewer assignments and additions
-                min_value = fillnoflat_float_min(filled[  up, left],
-                                fillnoflat_float_min(filled[  up, right],
-                                    fillnoflat_float_min( filled[down, left], filled[down, right]))) + diag
-                min_value = fillnoflat_float_min(min_value,
-                                fillnoflat_float_min(filled[  up, col],
-                                    fillnoflat_float_min( filled[ row, left],
-                                        fillnoflat_float_min( filled[ row, right], filled[down, col]))) + short)
-                min_value = fillnoflat_float_min(min_value, filled_value)
-
-                # Cannot be lower than terrain
-                new_value = fillnoflat_float_max(min_value, dtm_value)
-                if new_value != filled_value:
-                    filled[row, col] = new_value
-                    changes += 1
-            col += colstep
-        row += rowstep
-
-    return changes
+def _priority_flood_no_flats(DTYPE_t_DTM[:, :] dtm not None, DTYPE_t_FLOOD[:, :] filled not None, DTYPE_t_FILLNOFLAT short, DTYPE_t_FILLNOFLAT diag):
+    """Fill depressions and flats by flooding inwards from the raster edge.
+
+    Like `_priority_flood` but a cell must be at least `short` (edge neighbor) or `diag` (corner neighbor) higher than
+    the cell it drains to. As the minimum gradient differs between edge and corner neighbors a cell may be lowered
+    after it is first reached. Outdated heap entries are skipped when popped.
+
+    Cells are only ever lowered. Interior cells may therefore hold the result of an earlier flood instead of inf, in
+    which case only the cells affected by lowered edge cells are visited. With short and diag 0 this is the plain fill.
+
+    Returns the number of cell updates.
+    """
+    cdef Py_ssize_t rows = dtm.shape[0], cols = dtm.shape[1]
+    cdef Py_ssize_t[8] drow = [-1, -1, 0, 1, 1, 1, 0, -1]
+    cdef Py_ssize_t[8] dcol = [0, 1, 1, 1, 0, -1, -1, -1]
+    cdef DTYPE_t_FILLNOFLAT[8] increment = [short, diag, short, diag, short, diag, short, diag]
+    cdef Py_ssize_t r, c, nr, nc, i
+    cdef DTYPE_t_FLOOD value, new_value
+    cdef heap_t heap
+    cdef heap_item item
+    cdef int err = 0
+    cdef Py_ssize_t updates = 0
+
+    if rows == 0 or cols == 0:
+        return 0
+    if heap_init(&heap, 2 * (rows + cols)) != 0:
+        raise MemoryError()
+    try:
+        with nogil:
+            # Seed edge cells
+            for r in range(rows):
+                for c in range(cols):
+                    if r == 0 or c == 0 or r == rows - 1 or c == cols - 1:
+                        err |= heap_push(&heap, filled[r, c], r * cols + c)
+
+            while heap.size > 0 and err == 0:
+                item = heap_pop(&heap)
+                r = item.index // cols
+                c = item.index % cols
+                value = filled[r, c]
+                if item.value > value:
+                    # Cell has been lowered since this entry was pushed
+                    continue
+                for i in range(8):
+                    nr = r + drow[i]
+                    nc = c + dcol[i]
+                    # Edge cells keep their terrain value
+                    if nr < 1 or nc < 1 or nr >= rows - 1 or nc >= cols - 1:
+                        continue
+                    new_value = <DTYPE_t_FLOOD> fillnoflat_float_max(value + increment[i], dtm[nr, nc])
+                    if new_value < filled[nr, nc]:
+                        filled[nr, nc] = new_value
+                        err |= heap_push(&heap, new_value, nr * cols + nc)
+                        updates += 1
+    finally:
+        heap_free(&heap)
+    if err != 0:
+        raise MemoryError()
+    return updates
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _priority_flood_labels(DTYPE_t_FILL[:, :] dtm not None, DTYPE_t_FILL[:, :] filled not None, Py_ssize_t[:, :] labels not None, Py_ssize_t[:, :] depths not None):
+    """Flood a tile inwards from its edge cells and label each cell with the edge cell it is flooded from.
+
+    Like `_priority_flood` but edge cells must be labelled by the caller and interior cells must be labelled -1. An
+    interior cell gets the label of the cell it is reached from, and `depths` gets its number of steps from the edge
+    cell of its label.
+
+    Returns the number of cell updates.
+    """
+    cdef Py_ssize_t rows = dtm.shape[0], cols = dtm.shape[1]
+    cdef Py_ssize_t[8] drow = [-1, -1, 0, 1, 1, 1, 0, -1]
+    cdef Py_ssize_t[8] dcol = [0, 1, 1, 1, 0, -1, -1, -1]
+    cdef Py_ssize_t r, c, nr, nc, i
+    cdef DTYPE_t_FILL value, new_value
+    cdef heap_t heap
+    cdef heap_item item
+    cdef int err = 0
+    cdef Py_ssize_t updates = 0
+
+    if rows == 0 or cols == 0:
+        return 0
+    if heap_init(&heap, 2 * (rows + cols)) != 0:
+        raise MemoryError()
+    try:
+        with nogil:
+            # Seed edge cells
+            for r in range(rows):
+                for c in range(cols):
+                    if r == 0 or c == 0 or r == rows - 1 or c == cols - 1:
+                        filled[r, c] = dtm[r, c]
+                        depths[r, c] = 0
+                        err |= heap_push(&heap, filled[r, c], r * cols + c)
+
+            while heap.size > 0 and err == 0:
+                item = heap_pop(&heap)
+                r = item.index // cols
+                c = item.index % cols
+                value = filled[r, c]
+                for i in range(8):
+                    nr = r + drow[i]
+                    nc = c + dcol[i]
+                    if nr < 0 or nc < 0 or nr >= rows or nc >= cols or labels[nr, nc] >= 0:
+                        continue
+                    labels[nr, nc] = labels[r, c]
+                    depths[nr, nc] = depths[r, c] + 1
+                    new_value = fill_float_max(value, dtm[nr, nc])
+                    filled[nr, nc] = new_value
+                    err |= heap_push(&heap, new_value, nr * cols + nc)
+                    updates += 1
+    finally:
+        heap_free(&heap)
+    if err != 0:
+        raise MemoryError()
+    return updates
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _flood_spill_graph(Py_ssize_t[:] offsets not None, Py_ssize_t[:] targets not None, DTYPE_t_FILLNOFLAT[:] levels not None, DTYPE_t_FILLNOFLAT[:] increments not None, DTYPE_t_FILLNOFLAT[:] terrain not None, DTYPE_t_FILLNOFLAT[:] values not None):
+    """Flood the spill graph from the labels which hold a value.
+
+    The edges of label `i` are `offsets[i]` to `offsets[i + 1]`. A label reached over an edge gets the higher of the
+    edge level and the value of the label it is reached from plus the increment of the edge, and at least its terrain
+    value. Like `_priority_flood_no_flats` labels are only ever lowered and outdated heap entries are skipped.
+
+    Returns the number of label updates.
+    """
+    cdef Py_ssize_t count = values.shape[0]
+    cdef Py_ssize_t i, j, edge
+    cdef DTYPE_t_FILLNOFLAT value, new_value
+    cdef heap_t heap
+    cdef heap_item item
+    cdef int err = 0
+    cdef Py_ssize_t updates = 0
+
+    if offsets.shape[0] != count + 1 or terrain.shape[0] != count:
+        raise ValueError("offsets and terrain must match values")
+    if targets.shape[0] != levels.shape[0] or targets.shape[0] != increments.shape[0]:
+        raise ValueError("targets, levels and increments must have the same length")
+    if heap_init(&heap, 1024) != 0:
+        raise MemoryError()
+    try:
+        with nogil:
+            for i in range(count):
+                if values[i] < INFINITY:
+                    err |= heap_push(&heap, values[i], i)
+
+            while heap.size > 0 and err == 0:
+                item = heap_pop(&heap)
+                i = item.index
+                value = values[i]
+                if item.value > value:
+                    # Label has been lowered since this entry was pushed
+                    continue
+                for edge in range(offsets[i], offsets[i + 1]):
+                    j = targets[edge]
+                    new_value = fillnoflat_float_max(fillnoflat_float_max(levels[edge], value) + increments[edge], terrain[j])
+                    if new_value < values[j]:
+                        values[j] = new_value
+                        err |= heap_push(&heap, new_value, j)
+                        updates += 1
+    finally:
+        heap_free(&heap)
+    if err != 0:
+        raise MemoryError()
+    return updates
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _priority_flood_fused(DTYPE_t_DTM[:, :] dtm not None, DTYPE_t_FILL[:, :] filled not None, DTYPE_t_FILLNOFLAT[:, :] filled_no_flats not None, DTYPE_t_FLOWDIR[:, :] flowdir not None, DTYPE_t_FILLNOFLAT short, DTYPE_t_FILLNOFLAT diag):
+    """Calculate filled, filled_no_flats and flow directions in one traversal.
+
+    Cells are finalized in the order of `_priority_flood_no_flats`. When a cell is finalized its flow direction is
+    calculated from the no flats surface and its filled value is taken from the lowest finalized neighbor. Filled
+    values found this way are never too low. If a neighbor finalized later shows that a value is too high it is
+    lowered afterwards in a (usually empty) correction flood.
+
+    Returns the number of cell updates.
+    """
+    cdef Py_ssize_t rows = dtm.shape[0], cols = dtm.shape[1]
+    cdef Py_ssize_t[8] drow = [-1, -1, 0, 1, 1, 1, 0, -1]
+    cdef Py_ssize_t[8] dcol = [0, 1, 1, 1, 0, -1, -1, -1]
+    cdef DTYPE_t_FILLNOFLAT[8] increment = [short, diag, short, diag, short, diag, short, diag]
+    cdef Py_ssize_t r, c, nr, nc, i
+    cdef DTYPE_t_FILLNOFLAT value, new_value
+    cdef DTYPE_t_FILL fvalue, fnew_value
+    cdef heap_t heap, corrections
+    cdef heap_item item
+    cdef int err = 0
+    cdef Py_ssize_t updates = 0
+
+    if rows == 0 or cols == 0:
+        return 0
+    if heap_init(&heap, 2 * (rows + cols)) != 0:
+        raise MemoryError()
+    if heap_init(&corrections, 16) != 0:
+        heap_free(&heap)
+        raise MemoryError()
+    try:
+        with nogil:
+            # Seed edge cells
+            for r in range(rows):
+                for c in range(cols):
+                    if r == 0 or c == 0 or r == rows - 1 or c == cols - 1:
+                        err |= heap_push(&heap, filled_no_flats[r, c], r * cols + c)
+
+            while heap.size > 0 and err == 0:
+                item = heap_pop(&heap)
+                r = item.index // cols
+                c = item.index % cols
+                value = filled_no_flats[r, c]
+                if item.value > value:
+                    # Cell has been lowered since this entry was pushed
+                    continue
+                if 0 < r < rows - 1 and 0 < c < cols - 1:
+                    # Finalize interior cell. Unfinalized neighbors are still at +inf
+                    flowdir[r, c] = d8_direction(filled_no_flats, r, c)
+                    fvalue = filled[r, c]
+                    for i in range(8):
+                        fvalue = fill_float_min(fvalue, filled[r + drow[i], c + dcol[i]])
+                    fvalue = fill_float_max(fvalue, dtm[r, c])
+                    filled[r, c] = fvalue
+                    # Finalized interior neighbors which should drain through this cell
+                    for i in range(8):
+                        nr = r + drow[i]
+                        nc = c + dcol[i]
+                        if nr < 1 or nc < 1 or nr >= rows - 1 or nc >= cols - 1:
+                            continue
+                        if filled[nr, nc] == INFINITY:
+                            # Not finalized yet
+                            continue
+                        fnew_value = fill_float_max(fvalue, dtm[nr, nc])
+                        if fnew_value < filled[nr, nc]:
+                            filled[nr, nc] = fnew_value
+                            err |= heap_push(&corrections, fnew_value, nr * cols + nc)
+                            updates += 1
+                for i in range(8):
+                    nr = r + drow[i]
+                    nc = c + dcol[i]
+                    # Edge cells keep their terrain value
+                    if nr < 1 or nc < 1 or nr >= rows - 1 or nc >= cols - 1:
+                        continue
+                    new_value = fillnoflat_float_max(value + increment[i], dtm[nr, nc])
+                    if new_value < filled_no_flats[nr, nc]:
+                        filled_no_flats[nr, nc] = new_value
+                        err |= heap_push(&heap, new_value, nr * cols + nc)
+                        updates += 1
+
+            # Correct filled values which were too high
+            while corrections.size > 0 and err == 0:
+                item = heap_pop(&corrections)
+                r = item.index // cols
+                c = item.index % cols
+                fvalue = filled[r, c]
+                if item.value > fvalue:
+                    continue
+                for i in range(8):
+                    nr = r + drow[i]
+                    nc = c + dcol[i]
+                    if nr < 1 or nc < 1 or nr >= rows - 1 or nc >= cols - 1:
+                        continue
+                    fnew_value = fill_float_max(fvalue, dtm[nr, nc])
+                    if fnew_value < filled[nr, nc]:
+                        filled[nr, nc] = fnew_value
+                        err |= heap_push(&corrections, fnew_value, nr * cols + nc)
+                        updates += 1
+    finally:
+        heap_free(&heap)
+        heap_free(&corrections)
+    if err != 0:
+        raise MemoryError()
+    return updates
+
+
+cdef enum:
+    REFILL_INVALID = 1
+    REFILL_GROUPED = 2
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t _create_support_group(DTYPE_t_FLOOD[:, :] filled, np.uint8_t[:, :] state, Py_ssize_t cell, DTYPE_t_FILLNOFLAT[8] increment, dict group_of, list groups, list valid_supports, list group_created, Py_ssize_t num_invalid):
+    # Group the neighbors supporting each other and count the valid supports from outside the group
+    cdef Py_ssize_t rows = filled.shape[0], cols = filled.shape[1]
+    cdef Py_ssize_t[8] drow = [-1, -1, 0, 1, 1, 1, 0, -1]
+    cdef Py_ssize_t[8] dcol = [0, 1, 1, 1, 0, -1, -1, -1]
+    cdef Py_ssize_t gid = len(groups)
+    cdef Py_ssize_t r, c, nr, nc, i, j, count = 0
+    cdef list members = [cell]
+    group_of[cell] = gid
+    state[cell // cols, cell % cols] |= REFILL_GROUPED
+    j = 0
+    while j < len(members):
+        r = <Py_ssize_t> members[j] // cols
+        c = <Py_ssize_t> members[j] % cols
+        j += 1
+        for i in range(8):
+            nr = r + drow[i]
+            nc = c + dcol[i]
+            if nr < 1 or nc < 1 or nr >= rows - 1 or nc >= cols - 1 or state[nr, nc] & (REFILL_INVALID | REFILL_GROUPED):
+                continue
+            if filled[nr, nc] + increment[i] <= filled[r, c] and filled[r, c] + increment[i] <= filled[nr, nc]:
+                state[nr, nc] |= REFILL_GROUPED
+                group_of[nr * cols + nc] = gid
+                members.append(nr * cols + nc)
+    for j in range(len(members)):
+        r = <Py_ssize_t> members[j] // cols
+        c = <Py_ssize_t> members[j] % cols
+        for i in range(8):
+            nr = r + drow[i]
+            nc = c + dcol[i]
+            if nr < 0 or nc < 0 or nr >= rows or nc >= cols or state[nr, nc] & REFILL_INVALID:
+                continue
+            if state[nr, nc] & REFILL_GROUPED and group_of[nr * cols + nc] == gid:
+                continue
+            if filled[nr, nc] + increment[i] <= filled[r, c]:
+                count += 1
+    groups.append(members)
+    valid_supports.append(count)
+    group_created.append(num_invalid)
+    return gid
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef list _invalidate_supported(DTYPE_t_FLOOD[:, :] filled, np.uint8_t[:, :] state, window, DTYPE_t_FILLNOFLAT[8] increment):
+    # See fill._invalidate_supported. Returns the flat indexes of the invalid cells in the order they became invalid
+    cdef Py_ssize_t rows = filled.shape[0], cols = filled.shape[1]
+    cdef Py_ssize_t[8] drow = [-1, -1, 0, 1, 1, 1, 0, -1]
+    cdef Py_ssize_t[8] dcol = [0, 1, 1, 1, 0, -1, -1, -1]
+    cdef Py_ssize_t row, col, nrows, ncols, r, c, nr, nc, i, k, gid
+    cdef list queue = []
+    cdef dict group_of = {}
+    cdef list groups = [], valid_supports = [], group_created = []
+    row, col, nrows, ncols = window
+
+    for r in range(row, row + nrows):
+        for c in range(col, col + ncols):
+            state[r, c] |= REFILL_INVALID
+            queue.append(r * cols + c)
+
+    k = 0
+    while k < len(queue):
+        r = <Py_ssize_t> queue[k] // cols
+        c = <Py_ssize_t> queue[k] % cols
+        for i in range(8):
+            nr = r + drow[i]
+            nc = c + dcol[i]
+            if nr < 1 or nc < 1 or nr >= rows - 1 or nc >= cols - 1 or state[nr, nc] & REFILL_INVALID:
+                continue
+            if not filled[r, c] + increment[i] <= filled[nr, nc]:
+                continue
+            if state[nr, nc] & REFILL_GROUPED:
+                gid = group_of[nr * cols + nc]
+                # Supports were counted when the group was created
+                if k >= <Py_ssize_t> group_created[gid]:
+                    valid_supports[gid] -= 1
+            else:
+                gid = _create_support_group(filled, state, nr * cols + nc, increment, group_of, groups, valid_supports,
+                                            group_created, len(queue))
+            if valid_supports[gid] == 0:
+                for cell in groups[gid]:
+                    state[<Py_ssize_t> cell // cols, <Py_ssize_t> cell % cols] |= REFILL_INVALID
+                    queue.append(cell)
+        k += 1
+    return queue
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _refill(DTYPE_t_DTM[:, :] dtm not None, DTYPE_t_FLOOD[:, :] filled not None, window, DTYPE_t_FILLNOFLAT short, DTYPE_t_FILLNOFLAT diag):
+    """Update filled values after the DEM was changed inside a window.
+
+    Cells which may depend on the window are reset and flooded again from the valid cells around them. The flood also
+    lowers valid cells which drain through the window after the change.
+
+    Returns
+    -------
+    window : (int, int, int, int)
+        (min row, min col, max row, max col) of the recalculated cells
+    """
+    cdef Py_ssize_t rows = dtm.shape[0], cols = dtm.shape[1]
+    cdef Py_ssize_t[8] drow = [-1, -1, 0, 1, 1, 1, 0, -1]
+    cdef Py_ssize_t[8] dcol = [0, 1, 1, 1, 0, -1, -1, -1]
+    cdef DTYPE_t_FILLNOFLAT[8] increment = [short, diag, short, diag, short, diag, short, diag]
+    cdef np.ndarray[np.uint8_t, ndim=2] npstate = np.zeros((rows, cols), dtype=np.uint8)
+    cdef np.uint8_t[:, :] state = npstate
+    cdef Py_ssize_t r, c, nr, nc, i, j, idx
+    cdef Py_ssize_t minrow = rows, mincol = cols, maxrow = -1, maxcol = -1
+    cdef DTYPE_t_FLOOD value, new_value
+    cdef list invalid = _invalidate_supported(filled, state, window, increment)
+    cdef heap_t heap
+    cdef heap_item item
+    cdef int err = 0
+
+    if heap_init(&heap, 8 * len(invalid)) != 0:
+        raise MemoryError()
+    try:
+        for j in range(len(invalid)):
+            idx = invalid[j]
+            r = idx // cols
+            c = idx % cols
+            minrow = min(minrow, r)
+            mincol = min(mincol, c)
+            maxrow = max(maxrow, r)
+            maxcol = max(maxcol, c)
+            if 0 < r < rows - 1 and 0 < c < cols - 1:
+                filled[r, c] = INFINITY
+            else:
+                # Edge cells keep their terrain value
+                filled[r, c] = dtm[r, c]
+                err |= heap_push(&heap, filled[r, c], idx)
+        # Flood from the valid cells next to the invalid cells
+        for j in range(len(invalid)):
+            idx = invalid[j]
+            r = idx // cols
+            c = idx % cols
+            for i in range(8):
+                nr = r + drow[i]
+                nc = c + dcol[i]
+                if nr < 0 or nc < 0 or nr >= rows or nc >= cols or state[nr, nc] & REFILL_INVALID:
+                    continue
+                err |= heap_push(&heap, filled[nr, nc], nr * cols + nc)
+
+        with nogil:
+            while heap.size > 0 and err == 0:
+                item = heap_pop(&heap)
+                r = item.index // cols
+                c = item.index % cols
+                value = filled[r, c]
+                if item.value > value:
+                    # Cell has been lowered since this entry was pushed
+                    continue
+                for i in range(8):
+                    nr = r + drow[i]
+                    nc = c + dcol[i]
+                    # Edge cells keep their terrain value
+                    if nr < 1 or nc < 1 or nr >= rows - 1 or nc >= cols - 1:
+                        continue
+                    new_value = <DTYPE_t_FLOOD> fillnoflat_float_max(value + increment[i], dtm[nr, nc])
+                    if new_value < filled[nr, nc]:
+                        filled[nr, nc] = new_value
+                        err |= heap_push(&heap, new_value, nr * cols + nc)
+                        minrow = min(minrow, nr)
+                        mincol = min(mincol, nc)
+                        maxrow = max(maxrow, nr)
+                        maxcol = max(maxcol, nc)
+    finally:
+        heap_free(&heap)
+    if err != 0:
+        raise MemoryError()
+    return minrow, mincol, maxrow, maxcol
@@ -0,0 +1,228 @@
+# coding=utf-8
+# -------------------------------------------------------------------------------------------------
+# Copyright (c) 2016
+# Developed by Septima.dk and Thomas Balstrøm (University of Copenhagen) for the Danish Agency for
+# Data Supply and Efficiency. This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free Software Foundation,
+# either version 2 of the License, or (at you option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PORPOSE. See the GNU Gene-
+# ral Public License for more details.
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see http://www.gnu.org/licenses/.
+# -------------------------------------------------------------------------------------------------
+from __future__ import division
+import cython
+import numpy as np
+
+# cimports
+cimport cython
+from libc.stdlib cimport malloc, free
+from ._definitions cimport DTYPE_t_FLOWDIR, DTYPE_t_FLOOD
+from ._lists cimport index_list, list_append
+
+cdef enum:
+    FLOWDIR_NODIR = 8
+    FLAT_PENDING = 9
+
+cdef Py_ssize_t[8] DR = [-1, -1, 0, 1, 1, 1, 0, -1]
+cdef Py_ssize_t[8] DC = [0, 1, 1, 1, 0, -1, -1, -1]
+cdef double INV_SQRT2 = 1 / 2**0.5
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _resolve_flat(DTYPE_t_FLOOD[:, :] filled, DTYPE_t_FLOWDIR[:, :] flowdir, Py_ssize_t row, Py_ssize_t col,
+                       index_list* cells, index_list* queue) noexcept nogil:
+    """Assign flow directions to the flat containing interior cell (row, col). Returns -1 if out of memory."""
+    cdef Py_ssize_t rows = filled.shape[0], cols = filled.shape[1]
+    cdef DTYPE_t_FLOOD z = filled[row, col]
+    cdef Py_ssize_t i, k, r, c, nr, nc, minr, minc, maxr, maxc, width, height, li, ni, head
+    cdef int d, flat_height, m, n
+    cdef bint is_high_edge
+    cdef int* towards
+    cdef int* away
+    cdef DTYPE_t_FLOWDIR direction
+    cdef double dz, dzmax
+
+    # Collect the flat
+    cells.size = 0
+    flowdir[row, col] = FLAT_PENDING
+    if list_append(cells, row * cols + col) < 0:
+        return -1
+    minr, minc, maxr, maxc = row, col, row, col
+    i = 0
+    while i < cells.size:
+        r = cells.items[i] // cols
+        c = cells.items[i] % cols
+        i += 1
+        for k in range(8):
+            nr = r + DR[k]
+            nc = c + DC[k]
+            if 0 < nr < rows - 1 and 0 < nc < cols - 1 and flowdir[nr, nc] == FLOWDIR_NODIR and filled[nr, nc] == z:
+                flowdir[nr, nc] = FLAT_PENDING
+                if list_append(cells, nr * cols + nc) < 0:
+                    return -1
+                minr, minc = min(minr, nr), min(minc, nc)
+                maxr, maxc = max(maxr, nr), max(maxc, nc)
+
+    # Distances are stored for the bounding box of the flat and its outlets
+    minr, minc = minr - 1, minc - 1
+    height, width = maxr - minr + 2, maxc - minc + 2
+    towards = <int*> malloc(height * width * sizeof(int))
+    away = <int*> malloc(height * width * sizeof(int))
+    if towards == NULL or away == NULL:
+        free(towards)
+        free(away)
+        return -1
+    for li in range(height * width):
+        towards[li] = -1
+        away[li] = -1
+
+    # Outlets are cells at the level of the flat which have a flow direction or are raster edge cells.
+    # Queue holds the outlets followed by the high edges of the flat.
+    queue.size = 0
+    for i in range(cells.size):
+        r = cells.items[i] // cols
+        c = cells.items[i] % cols
+        for k in range(8):
+            nr = r + DR[k]
+            nc = c + DC[k]
+            ni = (nr - minr) * width + nc - minc
+            if filled[nr, nc] == z and flowdir[nr, nc] != FLAT_PENDING and towards[ni] < 0:
+                towards[ni] = 0
+                if list_append(queue, nr * cols + nc) < 0:
+                    free(towards)
+                    free(away)
+                    return -1
+
+    if queue.size == 0:
+        free(towards)
+        free(away)
+        return 0
+
+    # Gradient towards lower terrain
+    head = 0
+    while head < queue.size:
+        r = queue.items[head] // cols
+        c = queue.items[head] % cols
+        head += 1
+        d = towards[(r - minr) * width + c - minc] + 1
+        for k in range(8):
+            nr = r + DR[k]
+            nc = c + DC[k]
+            if not (0 <= nr - minr < height and 0 <= nc - minc < width):
+                continue
+            ni = (nr - minr) * width + nc - minc
+            if towards[ni] < 0 and flowdir[nr, nc] == FLAT_PENDING and filled[nr, nc] == z:
+                towards[ni] = d
+                if list_append(queue, nr * cols + nc) < 0:
+                    free(towards)
+                    free(away)
+                    return -1
+
+    # Gradient away from higher terrain
+    queue.size = 0
+    for i in range(cells.size):
+        r = cells.items[i] // cols
+        c = cells.items[i] % cols
+        is_high_edge = False
+        for k in range(8):
+            if filled[r + DR[k], c + DC[k]] > z:
+                is_high_edge = True
+                break
+        if is_high_edge:
+            away[(r - minr) * width + c - minc] = 1
+            if list_append(queue, cells.items[i]) < 0:
+                free(towards)
+                free(away)
+                return -1
+    flat_height = 0
+    head = 0
+    while head < queue.size:
+        r = queue.items[head] // cols
+        c = queue.items[head] % cols
+        head += 1
+        d = away[(r - minr) * width + c - minc]
+        flat_height = d
+        for k in range(8):
+            nr = r + DR[k]
+            nc = c + DC[k]
+            if not (0 <= nr - minr < height and 0 <= nc - minc < width):
+                continue
+            ni = (nr - minr) * width + nc - minc
+            if away[ni] < 0 and flowdir[nr, nc] == FLAT_PENDING and filled[nr, nc] == z:
+                away[ni] = d + 1
+                if list_append(queue, nr * cols + nc) < 0:
+                    free(towards)
+                    free(away)
+                    return -1
+
+    # Combined gradient. Outlets are 0 and cells not on the flat are -1
+    for i in range(cells.size):
+        r = cells.items[i] // cols
+        c = cells.items[i] % cols
+        li = (r - minr) * width + c - minc
+        towards[li] = 2 * towards[li]
+        if flat_height:
+            towards[li] += flat_height - away[li]
+
+    # Steepest descent on the combined gradient
+    for i in range(cells.size):
+        r = cells.items[i] // cols
+        c = cells.items[i] % cols
+        m = towards[(r - minr) * width + c - minc]
+        direction = FLOWDIR_NODIR
+        dzmax = 0.0
+        for k in range(8):
+            n = towards[(r + DR[k] - minr) * width + c + DC[k] - minc]
+            if n < 0:
+                continue
+            dz = (m - n) * INV_SQRT2 if k % 2 else m - n
+            if dz > dzmax:
+                dzmax = dz
+                direction = k
+        flowdir[r, c] = direction
+
+    free(towards)
+    free(away)
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _resolve_flats(DTYPE_t_FLOOD[:, :] filled, DTYPE_t_FLOWDIR[:, :] flowdir):
+    """Assign flow directions to the interior cells without a direction in place"""
+    cdef Py_ssize_t rows = filled.shape[0], cols = filled.shape[1]
+    cdef Py_ssize_t r, c
+    cdef int status = 0
+    cdef index_list cells, queue
+
+    cells.capacity = queue.capacity = 64
+    cells.size = queue.size = 0
+    cells.items = <Py_ssize_t*> malloc(cells.capacity * sizeof(Py_ssize_t))
+    queue.items = <Py_ssize_t*> malloc(queue.capacity * sizeof(Py_ssize_t))
+    if cells.items == NULL or queue.items == NULL:
+        free(cells.items)
+        free(queue.items)
+        raise MemoryError()
+
+    with nogil:
+        for r in range(1, rows - 1):
+            for c in range(1, cols - 1):
+                if flowdir[r, c] == FLOWDIR_NODIR:
+                    status = _resolve_flat(filled, flowdir, r, c, &cells, &queue)
+                    if status < 0:
+                        break
+            if status < 0:
+                break
+        # Flats without an outlet
+        for r in range(rows):
+            for c in range(cols):
+                if flowdir[r, c] == FLAT_PENDING:
+                    flowdir[r, c] = FLOWDIR_NODIR
+
+    free(cells.items)
+    free(queue.items)
+    if status < 0:
+        raise MemoryError()
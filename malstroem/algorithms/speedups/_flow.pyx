@@ -15,24 +15,22 @@ from __future__ import (absolute_import, division, print_function) #, unicode_li
 import cython
 import numpy as np
 from ..dtypes import DTYPE_FLOWDIR
+from ..flow import FlowGraph, PackedFlowdir
+from .._raster_utils import cell_in_raster
 
 # cimports
 cimport numpy as np
-from ._definitions cimport DTYPE_t_FLOWDIR, DTYPE_t_ACCUM, DTYPE_t_FILL, DTYPE_t_DTM, DTYPE_t_FILLNOFLAT
+from ._definitions cimport DTYPE_t_FLOWDIR, DTYPE_t_ACCUM, DTYPE_t_FILL, DTYPE_t_DTM, DTYPE_t_FILLNOFLAT, DTYPE_t_FLOOD, \
+    DTYPE_t_LABEL
+from ._d8 cimport d8_direction, d8_flowdir, d8_receiver
+from ._lists cimport index_list, list_append
+from libc.stdlib cimport malloc, free
 # from libc.math cimport M_PI, atan2, sin, cos, sqrt # See https://github.com/cython/cython/blob/master/Cython/Includes/libc/math.pxd
 
 
 cdef packed struct cell_struct:
     np.int_t r, c
 
-cdef packed struct cell_label32_struct:
-    np.int_t r, c
-    np.int32_t label
-
-cdef packed struct cell_label64_struct:
-    np.int_t r, c
-    np.int64_t label
-
 AGNPS_DELTA_NP = np.array(
         [
          [-1, 0], # Up
@@ -90,13 +88,20 @@ AGNPS_LEFT_DELTA.c = -1
 AGNPS_UPLEFT_DELTA.r = -1
 AGNPS_UPLEFT_DELTA.c = -1
 
-cdef DTYPE_t_FILLNOFLAT SQRT2 = 2**0.5
-cdef DTYPE_t_FILLNOFLAT INV_SQRT2 = 1 / SQRT2
-
 # See http://sourceforge.net/p/saga-gis/code-0/HEAD/tree/tags/release-2-0-1/saga_2/src/modules_terrain_analysis/terrain_analysis/ta_channels/D8_Flow_Analysis.cpp#l166
 # and http://www.saga-gis.org/saga_api_doc/html/grid__operation_8cpp_source.html#l01060
 @cython.boundscheck(False)
-def terrain_flow(DTYPE_t_FILLNOFLAT[:,:] terrain):
+@cython.wraparound(False)
+cdef void _terrain_flow_rows(DTYPE_t_FLOOD[:,:] terrain, DTYPE_t_FLOWDIR[:,:] flow, Py_ssize_t first,
+                             Py_ssize_t last) noexcept nogil:
+    cdef Py_ssize_t r, c
+    cdef Py_ssize_t cols = terrain.shape[1]
+    for r in range(first, last):
+        for c in range(1, cols - 1):
+            flow[r, c] = d8_direction(terrain, r, c)
+
+
+def terrain_flow(DTYPE_t_FLOOD[:,:] terrain):
     """Calculate flow directions for the specified terrain.
 
     Assumes water will always flow via the steepest path from cell to cell. This is sometimes called D8 flow.
@@ -111,71 +116,29 @@ def terrain_flow(DTYPE_t_FILLNOFLAT[:,:] terrain):
     -------
 
     """
-
-    cdef unsigned int rows, cols, maxrow, maxcol, r, c, left, right, up, down
-    cdef DTYPE_t_FILLNOFLAT z, dz, dzmax
     cdef DTYPE_t_FLOWDIR[:,:] flow
+    cdef Py_ssize_t rows = terrain.shape[0]
     npflow = np.empty_like(terrain, dtype=DTYPE_FLOWDIR)
     npflow.fill(AGNPS_NODIR)
     flow = npflow
-    rows, cols = terrain.shape[0], terrain.shape[1]
-    maxrow, maxcol = (rows - 2, cols - 2)
-    for r in range(1, maxrow + 1):
-        up = r - 1
-        down = r + 1
-        for c in range(1, maxcol + 1):
-            left = c - 1
-            right = c + 1
-            z = terrain[r, c]
-
-            i = AGNPS_NODIR
-            dzmax = 0.0
-
-            # Up
-            dz = (z - terrain[up, c])
-            if dz > dzmax:
-                dzmax = dz
-                i = AGNPS_UP
-            # UpRight
-            dz = (z - terrain[up, right]) * INV_SQRT2
-            if dz > dzmax:
-                dzmax = dz
-                i = AGNPS_UPRIGHT
-            # Right
-            dz = (z - terrain[r, right])
-            if dz > dzmax:
-                dzmax = dz
-                i = AGNPS_RIGHT
-            # DownRight
-            dz = (z - terrain[down, right]) * INV_SQRT2
-            if dz > dzmax:
-                dzmax = dz
-                i = AGNPS_DOWNRIGHT
-            # Down
-            dz = (z - terrain[down, c])
-            if dz > dzmax:
-                dzmax = dz
-                i = AGNPS_DOWN
-            # DownLeft
-            dz = (z - terrain[down, left]) * INV_SQRT2
-            if dz > dzmax:
-                dzmax = dz
-                i = AGNPS_DOWNLEFT
-            # Left
-            dz = (z - terrain[r, left])
-            if dz > dzmax:
-                dzmax = dz
-                i = AGNPS_LEFT
-            # UpLeft
-            dz = (z - terrain[up, left]) * INV_SQRT2
-            if dz > dzmax:
-                dzmax = dz
-                i = AGNPS_UPLEFT
-
-            flow[r, c] = i
+    with nogil:
+        _terrain_flow_rows(terrain, flow, 1, rows - 1)
     return npflow
 
 
+def terrain_flow_rows(DTYPE_t_FLOOD[:,:] terrain, DTYPE_t_FLOWDIR[:,:] flow, Py_ssize_t first, Py_ssize_t last):
+    """Calculate flow directions of the interior cells in rows `first` to `last` (exclusive) in place.
+
+    Runs without the GIL, so several threads can calculate separate rows of the same raster at the same time.
+    """
+    if flow.shape[0] != terrain.shape[0] or flow.shape[1] != terrain.shape[1]:
+        raise ValueError("Terrain and flow directions must have the same shape")
+    if first < 1 or last > terrain.shape[0] - 1:
+        raise ValueError("Rows must be interior rows of the raster")
+    with nogil:
+        _terrain_flow_rows(terrain, flow, first, last)
+
+
 @cython.boundscheck(False)
 cdef cell_struct cell_in_direction_cython(cell_struct from_cell, DTYPE_t_FLOWDIR direction):
     cdef cell_struct c
@@ -253,151 +216,190 @@ def trace_accumulated_flow(DTYPE_t_FLOWDIR[:,:] flowdir, DTYPE_t_ACCUM[:,:] accu
     trace_accumulated_flow_cython(flowdir, accum, c)
 
 
-@cython.boundscheck(False)
-def accumulated_flow(DTYPE_t_FLOWDIR[:,:] flowdir not None):
-    cdef unsigned int rows, cols, r, c
-    rows, cols = flowdir.shape[0], flowdir.shape[1]
-    cdef np.ndarray[DTYPE_t_ACCUM, ndim=2] npaccum = np.zeros((rows, cols))
-    cdef cell_struct cell
-    cdef DTYPE_t_ACCUM[:,:] accum = npaccum
-    # accum = np.zeros(flowdir.shape)
-    for r in range(0, flowdir.shape[0]):
-        for c in range(0, flowdir.shape[1]):
-            cell.r = r
-            cell.c = c
-            #up_cells = upstream_cells(flowdir, cell)
-            #if not up_cells:
-                # This is a leaf in the flow dir tree
-                # Trace down
-            trace_accumulated_flow_cython(flowdir, accum, cell)
-    return npaccum
+cdef Py_ssize_t[8] DELTA_ROW = [-1, -1, 0, 1, 1, 1, 0, -1]
+cdef Py_ssize_t[8] DELTA_COL = [0, 1, 1, 1, 0, -1, -1, -1]
 
 
-@cython.boundscheck(False)
-cdef assign_watersheds_upstream_32_cython(DTYPE_t_FLOWDIR[:,:] flowdir, np.int32_t[:,:] labelled, cell, unassigned):
-    cdef cell_struct neighbor_cell, current_cell
-    cdef np.int32_t lbl, background
-    cdef cell_label32_struct current_cell_label, neighbor_cell_label
-    cdef list stack
-    cdef int rows, cols
+def flowdir_data(flowdir):
+    """Flow direction array, whether it is packed and the number of columns of the raster.
 
-    rows, cols = flowdir.shape[0], flowdir.shape[1]
-    background = unassigned
-
-    current_cell_label.r = cell[0]
-    current_cell_label.c = cell[1]
-    current_cell_label.label = background
-
-    # Stack holds cell coord and downstream label
-    stack = list()
-    stack.append(current_cell_label)
-
-    while stack:
-        current_cell_label = stack.pop()
-        lbl = labelled[current_cell_label.r, current_cell_label.c]
-        if lbl == background:
-            # unassigned cell. Assign to downstream label
-            labelled[current_cell_label.r, current_cell_label.c] = current_cell_label.label
-            lbl = current_cell_label.label
-        else:
-            # Either a new label met, or a cell with same label as downstream.
-            pass
-        # Loop over neighbor cells
-        for direction in range(8):
-            current_cell.r = current_cell_label.r
-            current_cell.c = current_cell_label.c
-            neighbor_cell = cell_in_direction_cython(current_cell, direction)
-            if is_in_raster_cython(rows, cols, neighbor_cell) and is_upstream_cython(flowdir, current_cell, direction, neighbor_cell):
-                neighbor_cell_label.r = neighbor_cell.r
-                neighbor_cell_label.c = neighbor_cell.c
-                neighbor_cell_label.label = lbl
-                stack.append(neighbor_cell_label)
+    flowdir may be a 2D array, a `flow.PackedFlowdir` or a `flow.FlowGraph`.
+    """
+    if isinstance(flowdir, FlowGraph):
+        flowdir = flowdir.flowdir
+    if isinstance(flowdir, PackedFlowdir):
+        return flowdir.data, True, flowdir.shape[1]
+    return flowdir, False, flowdir.shape[1]
 
-@cython.boundscheck(False)
-cdef assign_watersheds_upstream_64_cython(DTYPE_t_FLOWDIR[:,:] flowdir, np.int64_t[:,:] labelled, cell, unassigned):
-    cdef cell_struct neighbor_cell, current_cell
-    cdef np.int64_t lbl, background
-    cdef cell_label64_struct current_cell_label, neighbor_cell_label
-    cdef list stack
-    cdef int rows, cols
 
-    rows, cols = flowdir.shape[0], flowdir.shape[1]
-    background = unassigned
-
-    current_cell_label.r = cell[0]
-    current_cell_label.c = cell[1]
-    current_cell_label.label = background
-
-    # Stack holds cell coord and downstream label
-    stack = list()
-    stack.append(current_cell_label)
-
-    while stack:
-        current_cell_label = stack.pop()
-        lbl = labelled[current_cell_label.r, current_cell_label.c]
-        if lbl == background:
-            # unassigned cell. Assign to downstream label
-            labelled[current_cell_label.r, current_cell_label.c] = current_cell_label.label
-            lbl = current_cell_label.label
-        else:
-            # Either a new label met, or a cell with same label as downstream.
-            pass
-        # Loop over neighbor cells
-        for direction in range(8):
-            current_cell.r = current_cell_label.r
-            current_cell.c = current_cell_label.c
-            neighbor_cell = cell_in_direction_cython(current_cell, direction)
-            if is_in_raster_cython(rows, cols, neighbor_cell) and is_upstream_cython(flowdir, current_cell, direction, neighbor_cell):
-                neighbor_cell_label.r = neighbor_cell.r
-                neighbor_cell_label.c = neighbor_cell.c
-                neighbor_cell_label.label = lbl
-                stack.append(neighbor_cell_label)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def accumulate(flowdir_or_packed, DTYPE_t_ACCUM[:,::1] accum not None):
+    """Accumulate flow in place. `accum` holds the weight of each cell on input. See `flow.accumulated_flow`"""
+    cdef DTYPE_t_FLOWDIR[:,:] flowdir
+    cdef bint packed
+    cdef Py_ssize_t rows, cols
+    cdef Py_ssize_t r, c, start, cell, downstream
+    cdef DTYPE_t_ACCUM* flat
+    # Number of unresolved upstream cells. At most 8. Resolved cells are marked RESOLVED
+    cdef np.uint8_t[::1] unresolved
+    cdef np.uint8_t RESOLVED = 255
+
+    flowdir, packed, cols = flowdir_data(flowdir_or_packed)
+    rows = flowdir.shape[0]
+    unresolved = np.zeros(rows * cols, dtype=np.uint8)
+    if accum.shape[0] != rows or accum.shape[1] != cols:
+        raise ValueError("Accumulated flow and flow directions must have the same shape")
+    if rows * cols == 0:
+        return
+    flat = &accum[0, 0]
+
+    with nogil:
+        for r in range(rows):
+            for c in range(cols):
+                downstream = d8_receiver(flowdir, packed, cols, r, c)
+                if downstream >= 0:
+                    unresolved[downstream] += 1
+
+        for start in range(rows * cols):
+            if unresolved[start] != 0:
+                continue
+            cell = start
+            while True:
+                unresolved[cell] = RESOLVED
+                downstream = d8_receiver(flowdir, packed, cols, cell // cols, cell % cols)
+                if downstream < 0:
+                    break
+                flat[downstream] += flat[cell]
+                unresolved[downstream] -= 1
+                if unresolved[downstream] != 0:
+                    break
+                cell = downstream
+
+        # Cells on a flow direction cycle
+        for start in range(rows * cols):
+            if unresolved[start] != RESOLVED:
+                flat[start] = 0
 
 
 @cython.boundscheck(False)
-cdef assign_watersheds_upstream_fallback_cython(DTYPE_t_FLOWDIR[:,:] flowdir, labelled, cell, unassigned):
-    cdef cell_struct neighbor_cell, current_cell
-    cdef np.int64_t lbl, background
-    cdef cell_label64_struct current_cell_label, neighbor_cell_label
-    cdef list stack
-    cdef int rows, cols
-
-    rows, cols = flowdir.shape[0], flowdir.shape[1]
-    background = unassigned
-
-    current_cell_label.r = cell[0]
-    current_cell_label.c = cell[1]
-    current_cell_label.label = background
-
-    # Stack holds cell coord and downstream label
-    stack = list()
-    stack.append(current_cell_label)
-
-    while stack:
-        current_cell_label = stack.pop()
-        lbl = labelled[current_cell_label.r, current_cell_label.c]
-        if lbl == background:
-            # unassigned cell. Assign to downstream label
-            labelled[current_cell_label.r, current_cell_label.c] = current_cell_label.label
-            lbl = current_cell_label.label
-        else:
-            # Either a new label met, or a cell with same label as downstream.
-            pass
-        # Loop over neighbor cells
-        for direction in range(8):
-            current_cell.r = current_cell_label.r
-            current_cell.c = current_cell_label.c
-            neighbor_cell = cell_in_direction_cython(current_cell, direction)
-            if is_in_raster_cython(rows, cols, neighbor_cell) and is_upstream_cython(flowdir, current_cell, direction, neighbor_cell):
-                neighbor_cell_label.r = neighbor_cell.r
-                neighbor_cell_label.c = neighbor_cell.c
-                neighbor_cell_label.label = lbl
-                stack.append(neighbor_cell_label)
-
-def assign_watersheds_upstream(flowdir, labelled, cell, unassigned):
+@cython.wraparound(False)
+cdef int _watersheds_from_labels(DTYPE_t_FLOWDIR[:,:] flowdir, bint packed, Py_ssize_t cols,
+                                 DTYPE_t_LABEL[:,:] labelled, DTYPE_t_LABEL unassigned) noexcept nogil:
+    """Assign unassigned cells the label of their downstream cell in place. Returns -1 if out of memory."""
+    cdef Py_ssize_t rows = flowdir.shape[0]
+    cdef Py_ssize_t r, c, k, nr, nc, cell
+    cdef DTYPE_t_LABEL lbl
+    cdef index_list stack
+
+    stack.capacity = 64
+    stack.size = 0
+    stack.items = <Py_ssize_t*> malloc(stack.capacity * sizeof(Py_ssize_t))
+    if stack.items == NULL:
+        return -1
+
+    # Edge cells without a downstream cell are the outlets
+    for r in range(rows):
+        for c in range(cols):
+            if 0 < r < rows - 1 and 0 < c < cols - 1:
+                continue
+            if d8_receiver(flowdir, packed, cols, r, c) < 0 and list_append(&stack, r * cols + c) < 0:
+                free(stack.items)
+                return -1
+
+    # Downstream cells are labelled before their upstream cells
+    while stack.size > 0:
+        stack.size -= 1
+        cell = stack.items[stack.size]
+        r = cell // cols
+        c = cell % cols
+        lbl = labelled[r, c]
+        for k in range(8):
+            nr = r + DELTA_ROW[k]
+            nc = c + DELTA_COL[k]
+            if nr < 0 or nr >= rows or nc < 0 or nc >= cols or d8_flowdir(flowdir, packed, nr, nc) != (k + 4) % 8:
+                continue
+            if labelled[nr, nc] == unassigned:
+                labelled[nr, nc] = lbl
+            if list_append(&stack, nr * cols + nc) < 0:
+                free(stack.items)
+                return -1
+
+    free(stack.items)
+    return 0
+
+
+def watersheds_from_labels(flowdir_or_packed, labelled, unassigned):
+    """Calculate local watersheds for labelled cells in place. See `flow.watersheds_from_labels`
+
+    Runs without the GIL for int32 and int64 labels. Other label types are processed as int64.
+    """
+    cdef DTYPE_t_FLOWDIR[:,:] flowdir
+    cdef bint packed
+    cdef Py_ssize_t cols
+    cdef np.int32_t[:,:] labelled32
+    cdef np.int64_t[:,:] labelled64
+    cdef np.int32_t unassigned32
+    cdef np.int64_t unassigned64
+    cdef int status
+
+    flowdir, packed, cols = flowdir_data(flowdir_or_packed)
+    if labelled.shape[0] != flowdir.shape[0] or labelled.shape[1] != cols:
+        raise ValueError("Labels and flow directions must have the same shape")
     if labelled.dtype == np.int32:
-        assign_watersheds_upstream_32_cython(flowdir, labelled, cell, unassigned)
-    elif labelled.dtype == np.int64:
-        assign_watersheds_upstream_64_cython(flowdir, labelled, cell, unassigned)
+        labelled32 = labelled
+        unassigned32 = unassigned
+        with nogil:
+            status = _watersheds_from_labels(flowdir, packed, cols, labelled32, unassigned32)
     else:
-        assign_watersheds_upstream_fallback_cython(flowdir, labelled, cell, unassigned)
+        nplabelled = labelled if labelled.dtype == np.int64 else labelled.astype(np.int64)
+        labelled64 = nplabelled
+        unassigned64 = unassigned
+        with nogil:
+            status = _watersheds_from_labels(flowdir, packed, cols, labelled64, unassigned64)
+        if nplabelled is not labelled:
+            labelled[...] = nplabelled
+    if status < 0:
+        raise MemoryError()
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t _downstream_path(DTYPE_t_FLOWDIR[:,:] flowdir, bint packed, Py_ssize_t cols, Py_ssize_t start,
+                                 Py_ssize_t end, Py_ssize_t[:,::1] path) noexcept nogil:
+    """Number of cells from start downstream to end. Stores them in path unless it is empty."""
+    cdef Py_ssize_t limit = flowdir.shape[0] * cols
+    cdef Py_ssize_t cell = start, n = 0
+    while cell >= 0 and n < limit:
+        if path.shape[0] > 0:
+            path[n, 0] = cell // cols
+            path[n, 1] = cell % cols
+        n += 1
+        if cell == end:
+            break
+        cell = d8_receiver(flowdir, packed, cols, cell // cols, cell % cols)
+    return n
+
+
+def downstream_path(flowdir, cell, end=None):
+    """Cells from cell and downstream as an (n, 2) array. See `flow.downstream_path`"""
+    cdef DTYPE_t_FLOWDIR[:,:] raster
+    cdef bint packed
+    cdef Py_ssize_t[:,::1] path
+    cdef Py_ssize_t cols, start, stop = -1, n
+
+    if not cell_in_raster(flowdir.shape, cell):
+        return np.empty((0, 2), dtype=np.intp)
+    raster, packed, cols = flowdir_data(flowdir)
+    start = cell[0] * cols + cell[1]
+    if end is not None:
+        stop = end[0] * cols + end[1]
+    nppath = np.empty((0, 2), dtype=np.intp)
+    path = nppath
+    with nogil:
+        n = _downstream_path(raster, packed, cols, start, stop, path)
+    nppath = np.empty((n, 2), dtype=np.intp)
+    path = nppath
+    with nogil:
+        _downstream_path(raster, packed, cols, start, stop, path)
+    return nppath
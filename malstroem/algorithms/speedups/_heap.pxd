@@ -0,0 +1,99 @@
+# coding=utf-8
+# -------------------------------------------------------------------------------------------------
+# Copyright (c) 2016
+# Developed by Septima.dk and Thomas Balstrøm (University of Copenhagen) for the Danish Agency for
+# Data Supply and Efficiency. This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free Software Foundation,
+# either version 2 of the License, or (at you option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PORPOSE. See the GNU Gene-
+# ral Public License for more details.
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see http://www.gnu.org/licenses/.
+# -------------------------------------------------------------------------------------------------
+
+# Binary min-heap of (value, cell index) pairs used by the priority-flood algorithms.
+# Items are ordered by value and then by cell index, which makes the processing order deterministic.
+
+from libc.stdlib cimport malloc, realloc, free
+
+
+cdef struct heap_item:
+    double value
+    Py_ssize_t index
+
+
+cdef struct heap_t:
+    heap_item* items
+    Py_ssize_t size
+    Py_ssize_t capacity
+
+
+cdef inline bint heap_less(heap_item a, heap_item b) noexcept nogil:
+    return a.value < b.value or (a.value == b.value and a.index < b.index)
+
+
+cdef inline int heap_init(heap_t* h, Py_ssize_t capacity) noexcept nogil:
+    if capacity < 16:
+        capacity = 16
+    h.items = <heap_item*> malloc(capacity * sizeof(heap_item))
+    h.size = 0
+    h.capacity = capacity
+    return 0 if h.items != NULL else -1
+
+
+cdef inline void heap_free(heap_t* h) noexcept nogil:
+    free(h.items)
+    h.items = NULL
+    h.size = 0
+    h.capacity = 0
+
+
+cdef inline int heap_push(heap_t* h, double value, Py_ssize_t index) noexcept nogil:
+    cdef heap_item item, parent
+    cdef heap_item* grown
+    cdef Py_ssize_t i, p
+    if h.size == h.capacity:
+        grown = <heap_item*> realloc(h.items, 2 * h.capacity * sizeof(heap_item))
+        if grown == NULL:
+            return -1
+        h.items = grown
+        h.capacity = 2 * h.capacity
+    item.value = value
+    item.index = index
+    # Sift up
+    i = h.size
+    h.size += 1
+    while i > 0:
+        p = (i - 1) >> 1
+        parent = h.items[p]
+        if not heap_less(item, parent):
+            break
+        h.items[i] = parent
+        i = p
+    h.items[i] = item
+    return 0
+
+
+cdef inline heap_item heap_pop(heap_t* h) noexcept nogil:
+    # Caller must make sure the heap is not empty
+    cdef heap_item top = h.items[0]
+    cdef heap_item last
+    cdef Py_ssize_t i, child
+    h.size -= 1
+    if h.size > 0:
+        last = h.items[h.size]
+        # Sift down
+        i = 0
+        while True:
+            child = 2 * i + 1
+            if child >= h.size:
+                break
+            if child + 1 < h.size and heap_less(h.items[child + 1], h.items[child]):
+                child += 1
+            if not heap_less(h.items[child], last):
+                break
+            h.items[i] = h.items[child]
+            i = child
+        h.items[i] = last
+    return top
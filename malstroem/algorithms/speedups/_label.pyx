@@ -17,7 +17,8 @@ import numpy as np
 
 # cimports
 cimport numpy as np
-from cyarray.carray cimport FloatArray, DoubleArray
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+from ._definitions cimport DTYPE_t_LABEL, DTYPE_t_VALUE
 
 
 cdef packed struct stat_record:
@@ -29,14 +30,21 @@ cdef packed struct index_record:
     np.int_t row, col
 
 
-def label_stats(data, labelled, nlabels=None):
-    if data.dtype == np.float32 and labelled.dtype == np.int32:
-        return label_stats_float32_int32_cython(data, labelled, nlabels)
-    return label_stats_fallback_cython(data, labelled, nlabels)
+def _typed_data(data):
+    """Data as one of the value types of the kernels"""
+    if data.dtype != np.float32:
+        return data.astype(np.float64, copy=False)
+    return data
 
 
-@cython.boundscheck(False)
-cdef label_stats_fallback_cython(data, labelled, nlabels=None):
+def _typed_labels(labelled):
+    """Labels as one of the label types of the kernels"""
+    if labelled.dtype != np.int32:
+        return labelled.astype(np.int64, copy=False)
+    return labelled
+
+
+def label_stats(data, labelled, nlabels=None):
     if not nlabels:
         nlabels = np.max(labelled)
 
@@ -45,124 +53,94 @@ cdef label_stats_fallback_cython(data, labelled, nlabels=None):
     stats = np.zeros((nlabels + 1,), dtype=dtype)
     stats[:]['min'] = float('inf')
     stats[:]['max'] = float('-inf')
+    if _label_stats(_typed_data(data), _typed_labels(labelled), stats) < 0:
+        raise ValueError("Labels must be in the range [0;nlabels]")
+    return stats
 
-    cdef unsigned int r, c
+
+def _label_stats(DTYPE_t_VALUE[:, :] data, DTYPE_t_LABEL[:, :] labelled, stat_record[:] records):
+    cdef int status
+    with nogil:
+        status = label_stats_cython(data, labelled, records)
+    return status
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int label_stats_cython(DTYPE_t_VALUE[:, :] data, DTYPE_t_LABEL[:, :] labelled,
+                            stat_record[:] records) noexcept nogil:
+    """Update stats of each label. Returns -1 if a label is out of range"""
+    cdef Py_ssize_t r, c
+    cdef Py_ssize_t nrecords = records.shape[0]
     cdef np.float64_t val
-    cdef np.int64_t lbl
-    cdef stat_record[:] records = stats
-    cdef stat_record record
+    cdef DTYPE_t_LABEL lbl
 
-    for r in range(0, data.shape[0]):
-        for c in range(0, data.shape[1]):
+    for r in range(data.shape[0]):
+        for c in range(data.shape[1]):
             val = data[r, c]
             lbl = labelled[r, c]
-            record = records[lbl]
-            record.count += 1
-            record.sum += val
-            if val < record.min:
-                record.min = val
-            if val > record.max:
-                record.max = val
-            records[lbl] = record
-    return stats
+            if lbl < 0 or lbl >= nrecords:
+                return -1
+            records[lbl].count += 1
+            records[lbl].sum += val
+            if val < records[lbl].min:
+                records[lbl].min = val
+            if val > records[lbl].max:
+                records[lbl].max = val
+    return 0
 
-@cython.boundscheck(False)
-cdef label_stats_float32_int32_cython(np.float32_t[:,:] data, np.int32_t[:,:] labelled, nlabels=None):
-    if not nlabels:
-        nlabels = np.max(labelled)
 
-    # dtype field names across py2 and py3 are a mess: https://github.com/numpy/numpy/issues/2407
-    dtype = [('min', np.float64), ('max', np.float64), ('sum', np.float64), ('count', np.int64)]
-    stats = np.zeros((nlabels + 1,), dtype=dtype)
-    stats[:]['min'] = float('inf')
-    stats[:]['max'] = float('-inf')
+def label_min_index(data, labelled, nlabels=None):
+    return _label_extreme_index(data, labelled, nlabels, False)
 
-    cdef unsigned int r, c
-    cdef np.float32_t val
-    cdef np.int32_t lbl
-    cdef stat_record[:] records = stats
-    cdef stat_record record
 
-    for r in range(0, data.shape[0]):
-        for c in range(0, data.shape[1]):
-            val = data[r, c]
-            lbl = labelled[r, c]
-            record = records[lbl]
-            record.count += 1
-            record.sum += val
-            if val < record.min:
-                record.min = val
-            if val > record.max:
-                record.max = val
-            records[lbl] = record
-    return stats
+def label_max_index(data, labelled, nlabels=None):
+    return _label_extreme_index(data, labelled, nlabels, True)
 
-@cython.boundscheck(False)
-cdef label_min_index_float64_int32_cython(np.float64_t[:,:] data, np.int32_t [:,:] labelled, nlabels=None):
+
+def _label_extreme_index(data, labelled, nlabels, bint find_max):
     if not nlabels:
         nlabels = np.max(labelled)
 
     dtype = [('value', np.float64), ('row', int), ('col', int)]
-    lmin = np.zeros((nlabels + 1,), dtype=dtype)
-    lmin[:]['value'] = float('inf')
-    lmin[:]['row'] = -1
-    lmin[:]['col'] = -1
+    lext = np.zeros((nlabels + 1,), dtype=dtype)
+    lext[:]['value'] = float('-inf') if find_max else float('inf')
+    lext[:]['row'] = -1
+    lext[:]['col'] = -1
+    if _label_index(_typed_data(data), _typed_labels(labelled), lext, find_max) < 0:
+        raise ValueError("Labels must be in the range [0;nlabels]")
+    return lext
 
-    cdef unsigned int r, c
-    cdef np.float64_t val
-    cdef np.int32_t lbl
-    cdef index_record[:] records = lmin
-    cdef index_record record
-    cdef unsigned int rows, cols
-    rows, cols = data.shape[0], data.shape[1]
-
-    for r in range(0, rows):
-        for c in range(0, cols):
-            val = data[r, c]
-            lbl = labelled[r, c]
-            record = records[lbl]
-            if val < record.value:
-                record.value = val
-                record.row = r
-                record.col = c
-            records[lbl] = record
-    return lmin
 
-@cython.boundscheck(False)
-cdef label_min_index_fallback_cython(data, labelled, nlabels=None):
-    if not nlabels:
-        nlabels = np.max(labelled)
+def _label_index(DTYPE_t_VALUE[:, :] data, DTYPE_t_LABEL[:, :] labelled, index_record[:] records, bint find_max):
+    cdef int status
+    with nogil:
+        status = label_index_cython(data, labelled, records, find_max)
+    return status
 
-    dtype = [('value', np.float64), ('row', int), ('col', int)]
-    lmin = np.zeros((nlabels + 1,), dtype=dtype)
-    lmin[:]['value'] = float('inf')
-    lmin[:]['row'] = -1
-    lmin[:]['col'] = -1
 
-    cdef unsigned int r, c
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int label_index_cython(DTYPE_t_VALUE[:, :] data, DTYPE_t_LABEL[:, :] labelled, index_record[:] records,
+                            bint find_max) noexcept nogil:
+    """Update the min or max value and its first cell of each label. Returns -1 if a label is out of range"""
+    cdef Py_ssize_t r, c
+    cdef Py_ssize_t nrecords = records.shape[0]
     cdef np.float64_t val
-    cdef np.int32_t lbl
-    cdef index_record[:] records = lmin
-    cdef index_record record
-    cdef unsigned int rows, cols
-    rows, cols = data.shape[0], data.shape[1]
-
-    for r in range(0, rows):
-        for c in range(0, cols):
+    cdef DTYPE_t_LABEL lbl
+
+    for r in range(data.shape[0]):
+        for c in range(data.shape[1]):
             val = data[r, c]
             lbl = labelled[r, c]
-            record = records[lbl]
-            if val < record.value:
-                record.value = val
-                record.row = r
-                record.col = c
-            records[lbl] = record
-    return lmin
+            if lbl < 0 or lbl >= nrecords:
+                return -1
+            if (val > records[lbl].value) if find_max else (val < records[lbl].value):
+                records[lbl].value = val
+                records[lbl].row = r
+                records[lbl].col = c
+    return 0
 
-def label_min_index(data, labelled, nlabels=None):
-    if data.dtype == np.float64 and labelled.dtype == np.int32:
-        return label_min_index_float64_int32_cython(data, labelled, nlabels)
-    return label_min_index_fallback_cython(data, labelled, nlabels)
 
 def label_data(data, labelled, nlabels=None, background=0):
     # Check types
@@ -173,76 +151,235 @@ def label_data(data, labelled, nlabels=None, background=0):
         nlabels = np.max(labelled)
     elif not np.can_cast(nlabels, np.int32, "safe"):
             raise TypeError("nlabels must be integer")
-        
-    if data.dtype == np.float64 and labelled.dtype == np.int32:
-        result = label_data_float64_int32_cython(data, labelled, nlabels, background)
-    elif data.dtype == np.float32 and labelled.dtype == np.int32:
-        result = label_data_float32_int32_cython(data, labelled, nlabels, background)
-    else:
-        result = label_data_fallback_cython(data, labelled, nlabels, background)
-    return [np.array(x.get_npy_array()) for x in result]
+
+    data = np.ascontiguousarray(_typed_data(data)).ravel()
+    labelled = np.ascontiguousarray(_typed_labels(labelled)).ravel()
+
+    # Values are only allocated for the labelled cells once they are counted
+    offsets = np.zeros(nlabels + 2, dtype=np.int64)
+    if _count_labels(labelled, offsets, background) < 0:
+        raise ValueError("Labels must be in the range [0;nlabels]")
+    values = np.empty(offsets[-1], dtype=data.dtype)
+    _scatter_label_data(data, labelled, values, offsets, background)
+    return values, offsets
+
+
+def _count_labels(DTYPE_t_LABEL[::1] labels, np.int64_t[::1] offsets, Py_ssize_t background):
+    cdef int status
+    with nogil:
+        status = count_labels_cython(labels, offsets, background)
+    return status
+
+
+def _scatter_label_data(DTYPE_t_VALUE[::1] data, DTYPE_t_LABEL[::1] labels, DTYPE_t_VALUE[::1] values,
+                        np.int64_t[::1] offsets, Py_ssize_t background):
+    with nogil:
+        scatter_label_data_cython(data, labels, values, offsets, background)
 
 
 @cython.boundscheck(False)
-cdef label_data_float32_int32_cython(np.float32_t[:,:] data, np.int32_t[:,:] labels, max_label, background):
-    cdef FloatArray tmp_cyarray    
-    cdef unsigned int r, c
-    cdef np.float32_t val
-    cdef np.int32_t lbl, background_lbl
-
-    # In cython list of lists: https://stackoverflow.com/questions/33851333/cython-how-do-you-create-an-array-of-cdef-class    
-    list_of_cyarrays = list(FloatArray() for i in range(max_label + 1))
-    
-    # Collect data per label
-    for r in range(0, data.shape[0]):
-        for c in range(0, data.shape[1]):
-            lbl = labels[r,c]
-            val = data[r,c]
-            if lbl == 0:
-                continue
-            tmp_cyarray = <FloatArray?>list_of_cyarrays[lbl]
-            tmp_cyarray.c_append(val)
-    return list_of_cyarrays
+@cython.wraparound(False)
+cdef int count_labels_cython(DTYPE_t_LABEL[::1] labels, np.int64_t[::1] offsets, Py_ssize_t background) noexcept nogil:
+    """Offsets of a counting sort by label. Returns -1 if a label is out of range"""
+    cdef Py_ssize_t i, lbl
+    cdef Py_ssize_t nlabels = offsets.shape[0] - 2
+
+    # Count values of each label in offsets[lbl + 1]
+    for i in range(labels.shape[0]):
+        lbl = labels[i]
+        if lbl < 0 or lbl > nlabels:
+            return -1
+        offsets[lbl + 1] += 1
+    if 0 <= background <= nlabels:
+        offsets[background + 1] = 0
+    for lbl in range(nlabels + 1):
+        offsets[lbl + 1] += offsets[lbl]
+    return 0
 
 
 @cython.boundscheck(False)
-cdef label_data_float64_int32_cython(np.float64_t[:,:] data, np.int32_t[:,:] labels, max_label, background):
-    cdef DoubleArray tmp_cyarray    
-    cdef unsigned int r, c
-    cdef np.float64_t val
-    cdef np.int32_t lbl, background_lbl
-    
-    # In cython list of lists: https://stackoverflow.com/questions/33851333/cython-how-do-you-create-an-array-of-cdef-class    
-    list_of_cyarrays = list(DoubleArray() for i in range(max_label + 1))
-    
-    # Collect data per label
-    for r in range(0, data.shape[0]):
-        for c in range(0, data.shape[1]):
-            lbl = labels[r,c]
-            val = data[r,c]
-            if lbl == 0:
-                continue
-            tmp_cyarray = <DoubleArray?>list_of_cyarrays[lbl]
-            tmp_cyarray.c_append(val)
-    return list_of_cyarrays
+@cython.wraparound(False)
+cdef void scatter_label_data_cython(DTYPE_t_VALUE[::1] data, DTYPE_t_LABEL[::1] labels, DTYPE_t_VALUE[::1] values,
+                                    np.int64_t[::1] offsets, Py_ssize_t background) noexcept nogil:
+    """Scatter data to values sorted by label using the offsets of `count_labels_cython`"""
+    cdef Py_ssize_t i, lbl
+    cdef Py_ssize_t nlabels = offsets.shape[0] - 2
+
+    # offsets[lbl] is used as the next free position of lbl and ends up as offsets[lbl + 1]
+    for i in range(labels.shape[0]):
+        lbl = labels[i]
+        if lbl == background:
+            continue
+        values[offsets[lbl]] = data[i]
+        offsets[lbl] += 1
+    # Shift back
+    for lbl in range(nlabels, -1, -1):
+        offsets[lbl + 1] = offsets[lbl]
+    offsets[0] = 0
+
+
+# Output arrays of the reductions of one raster in `zonal_reduce`. NULL if the reduction is not requested
+cdef struct reduction:
+    np.float64_t *min
+    np.float64_t *max
+    np.float64_t *sum
+    np.int64_t *count
+    np.int64_t *argmin
+    np.int64_t *argmax
+    np.int64_t *histogram
+    np.float64_t *edges
+    Py_ssize_t nbins
+
+
+cdef inline np.float64_t *_float64_pointer(result, name):
+    cdef np.float64_t[::1] view
+    if name not in result:
+        return NULL
+    view = result[name]
+    return &view[0]
+
+
+cdef inline np.int64_t *_int64_pointer(result, name):
+    cdef np.int64_t[::1] view
+    if name not in result:
+        return NULL
+    view = result[name]
+    return &view[0]
+
 
 @cython.boundscheck(False)
-cdef label_data_fallback_cython(data, labels, max_label, background):
-    cdef DoubleArray tmp_cyarray    
-    cdef unsigned int r, c
+@cython.wraparound(False)
+cdef int _zonal_reduce_row(DTYPE_t_LABEL[::1] labels, np.float64_t[:, ::1] values, reduction *reductions,
+                           np.int64_t *count, Py_ssize_t nlabels, Py_ssize_t offset) nogil:
+    """Update the reductions with a row of cells. Returns -1 if a label is out of range"""
+    cdef Py_ssize_t c, k, lo, hi, mid
+    cdef Py_ssize_t cols = labels.shape[0]
+    cdef Py_ssize_t nrasters = values.shape[0]
+    cdef DTYPE_t_LABEL lbl
     cdef np.float64_t val
-    cdef np.int64_t lbl, background_lbl
-    
-    # In cython list of lists: https://stackoverflow.com/questions/33851333/cython-how-do-you-create-an-array-of-cdef-class    
-    list_of_cyarrays = list(DoubleArray() for i in range(max_label + 1))
-    
-    # Collect data per label
-    for r in range(0, data.shape[0]):
-        for c in range(0, data.shape[1]):
-            lbl = labels[r,c]
-            val = data[r,c]
-            if lbl == 0:
+    cdef reduction *red
+
+    for c in range(cols):
+        lbl = labels[c]
+        if lbl < 0 or lbl > nlabels:
+            return -1
+        count[lbl] += 1
+        for k in range(nrasters):
+            val = values[k, c]
+            red = &reductions[k]
+            if red.sum != NULL:
+                red.sum[lbl] += val
+            # NaN fails all comparisons below
+            if val != val:
                 continue
-            tmp_cyarray = <DoubleArray?>list_of_cyarrays[lbl]
-            tmp_cyarray.c_append(val)
-    return list_of_cyarrays
\ No newline at end of file
+            if red.count != NULL:
+                red.count[lbl] += 1
+            if red.min != NULL and val < red.min[lbl]:
+                red.min[lbl] = val
+            if red.max != NULL and val > red.max[lbl]:
+                red.max[lbl] = val
+            if red.argmin != NULL and val < red.min[lbl + nlabels + 1]:
+                red.min[lbl + nlabels + 1] = val
+                red.argmin[lbl] = offset + c
+            if red.argmax != NULL and val > red.max[lbl + nlabels + 1]:
+                red.max[lbl + nlabels + 1] = val
+                red.argmax[lbl] = offset + c
+            if red.histogram != NULL and red.edges[0] <= val <= red.edges[red.nbins]:
+                # Last bin with a left edge <= val. The last bin includes its right edge
+                lo = 0
+                hi = red.nbins
+                while hi - lo > 1:
+                    mid = (lo + hi) // 2
+                    if red.edges[mid] <= val:
+                        lo = mid
+                    else:
+                        hi = mid
+                red.histogram[lbl * red.nbins + lo] += 1
+    return 0
+
+
+def zonal_reduce(labelled, nlabels, rasters):
+    """Reduce each raster for each label in one pass over the rows. See `label._zonal_reduce`"""
+    cdef Py_ssize_t r, k
+    cdef Py_ssize_t rows = labelled.shape[0]
+    cdef Py_ssize_t cols = labelled.shape[1]
+    cdef Py_ssize_t n = nlabels
+    cdef Py_ssize_t nrasters = len(rasters)
+    cdef int status = 0
+    cdef np.int64_t[::1] count_view
+    cdef np.float64_t[::1] edges_view
+    cdef np.float64_t[:, ::1] values
+    cdef reduction *reductions
+    cdef np.int32_t[::1] labels32
+    cdef np.int64_t[::1] labels64
+
+    labelled = _typed_labels(labelled)
+    count = np.zeros(n + 1, dtype=np.int64)
+    count_view = count
+
+    # Extremes used by argmin and argmax are kept after the extremes of min and max
+    results = []
+    for data, requested, edges in rasters:
+        result = {}
+        if 'min' in requested or 'argmin' in requested:
+            result['min'] = np.full(2 * (n + 1), np.inf)
+        if 'max' in requested or 'argmax' in requested:
+            result['max'] = np.full(2 * (n + 1), -np.inf)
+        if 'sum' in requested:
+            result['sum'] = np.zeros(n + 1)
+        if 'count' in requested:
+            result['count'] = np.zeros(n + 1, dtype=np.int64)
+        if 'argmin' in requested:
+            result['argmin'] = np.full(n + 1, -1, dtype=np.int64)
+        if 'argmax' in requested:
+            result['argmax'] = np.full(n + 1, -1, dtype=np.int64)
+        if 'histogram' in requested:
+            result['edges'] = np.ascontiguousarray(edges, dtype=np.float64)
+            result['histogram'] = np.zeros((n + 1) * (len(edges) - 1), dtype=np.int64)
+        results.append(result)
+
+    buffer = np.empty((nrasters, cols), dtype=np.float64)
+    values = buffer
+    reductions = <reduction *> PyMem_Malloc(max(nrasters, 1) * sizeof(reduction))
+    if reductions == NULL:
+        raise MemoryError()
+    try:
+        for k, result in enumerate(results):
+            reductions[k].min = _float64_pointer(result, 'min')
+            reductions[k].max = _float64_pointer(result, 'max')
+            reductions[k].sum = _float64_pointer(result, 'sum')
+            reductions[k].count = _int64_pointer(result, 'count')
+            reductions[k].argmin = _int64_pointer(result, 'argmin')
+            reductions[k].argmax = _int64_pointer(result, 'argmax')
+            reductions[k].histogram = _int64_pointer(result, 'histogram')
+            reductions[k].edges = _float64_pointer(result, 'edges')
+            reductions[k].nbins = len(result['edges']) - 1 if 'edges' in result else 0
+
+        for r in range(rows):
+            for k in range(nrasters):
+                buffer[k] = rasters[k][0][r]
+            if labelled.dtype == np.int32:
+                labels32 = np.ascontiguousarray(labelled[r])
+                with nogil:
+                    status = _zonal_reduce_row(labels32, values, reductions, &count_view[0], n, r * cols)
+            else:
+                labels64 = np.ascontiguousarray(labelled[r])
+                with nogil:
+                    status = _zonal_reduce_row(labels64, values, reductions, &count_view[0], n, r * cols)
+            if status < 0:
+                raise ValueError("Labels must be in the range [0;nlabels]")
+    finally:
+        PyMem_Free(reductions)
+
+    for data_requested, result in zip(rasters, results):
+        requested = data_requested[1]
+        for name in ('min', 'max'):
+            if name in result:
+                if name in requested:
+                    result[name] = result[name][:n + 1]
+                else:
+                    del result[name]
+        if 'histogram' in result:
+            del result['edges']
+            result['histogram'] = result['histogram'].reshape(n + 1, -1)
+    return count, results
@@ -0,0 +1,38 @@
+# coding=utf-8
+# -------------------------------------------------------------------------------------------------
+# Copyright (c) 2016
+# Developed by Septima.dk and Thomas Balstrøm (University of Copenhagen) for the Danish Agency for
+# Data Supply and Efficiency. This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free Software Foundation,
+# either version 2 of the License, or (at you option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PORPOSE. See the GNU Gene-
+# ral Public License for more details.
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see http://www.gnu.org/licenses/.
+# -------------------------------------------------------------------------------------------------
+
+
+# Growable array of cell indexes for kernels running without the GIL.
+
+from libc.stdlib cimport realloc
+
+
+cdef struct index_list:
+    Py_ssize_t* items
+    Py_ssize_t size
+    Py_ssize_t capacity
+
+
+cdef inline int list_append(index_list* l, Py_ssize_t value) noexcept nogil:
+    """Append value to the list. Returns -1 if out of memory."""
+    cdef Py_ssize_t* grown
+    if l.size == l.capacity:
+        grown = <Py_ssize_t*> realloc(l.items, 2 * l.capacity * sizeof(Py_ssize_t))
+        if grown == NULL:
+            return -1
+        l.items = grown
+        l.capacity = 2 * l.capacity
+    l.items[l.size] = value
+    l.size += 1
+    return 0
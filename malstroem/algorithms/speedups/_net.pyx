@@ -0,0 +1,226 @@
+# coding=utf-8
+# -------------------------------------------------------------------------------------------------
+# Copyright (c) 2016
+# Developed by Septima.dk and Thomas Balstrøm (University of Copenhagen) for the Danish Agency for
+# Data Supply and Efficiency. This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free Software Foundation,
+# either version 2 of the License, or (at you option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PORPOSE. See the GNU Gene-
+# ral Public License for more details.
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see http://www.gnu.org/licenses/.
+# -------------------------------------------------------------------------------------------------
+from __future__ import (absolute_import, division, print_function) #, unicode_literals)
+import cython
+import numpy as np
+from ._flow import flowdir_data
+
+# cimports
+cimport cython
+cimport numpy as np
+from libc.stdlib cimport malloc, free
+from ._definitions cimport DTYPE_t_FLOWDIR, DTYPE_t_LABEL, DTYPE_t_INDEX
+from ._d8 cimport d8_receiver
+from ._lists cimport index_list, list_append
+
+# Memo states. Resolved cells hold a linear index or NO_CELL
+cdef enum:
+    NO_CELL = -1
+    UNVISITED = -2
+    ON_PATH = -3
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline np.int64_t _resolve_first(DTYPE_t_INDEX[::1] receivers, DTYPE_t_LABEL[::1] labels, np.int64_t[::1] first,
+                                      Py_ssize_t cell, bint has_background, DTYPE_t_LABEL background) noexcept nogil:
+    """First cell downstream of cell with another label, given the memoized first cell of its downstream cell"""
+    cdef Py_ssize_t downstream = receivers[cell]
+    cdef np.int64_t next_cell
+    cdef DTYPE_t_LABEL lbl, downstream_lbl
+    if downstream < 0:
+        return NO_CELL
+    lbl = labels[cell]
+    downstream_lbl = labels[downstream]
+    if downstream_lbl == lbl:
+        return first[downstream]
+    if not has_background or downstream_lbl != background:
+        return downstream
+    # Downstream cell is background. Its first cell is the next labelled cell
+    next_cell = first[downstream]
+    if next_cell >= 0 and labels[next_cell] == lbl:
+        next_cell = first[next_cell]
+    return next_cell
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _next_downstream_cells(DTYPE_t_INDEX[::1] receivers, DTYPE_t_LABEL[::1] labels, np.int64_t[::1] starts,
+                                bint has_background, DTYPE_t_LABEL background, np.int64_t[::1] first,
+                                np.int64_t[::1] found) noexcept nogil:
+    """Memoized search for the first cell downstream with another label. Returns -1 if out of memory."""
+    cdef Py_ssize_t i, j, lap, cell, cycle_start
+    cdef index_list path
+
+    path.capacity = 64
+    path.size = 0
+    path.items = <Py_ssize_t*> malloc(path.capacity * sizeof(Py_ssize_t))
+    if path.items == NULL:
+        return -1
+
+    for i in range(starts.shape[0]):
+        # Walk downstream until a resolved cell
+        cell = starts[i]
+        while cell >= 0 and first[cell] == UNVISITED:
+            first[cell] = ON_PATH
+            if list_append(&path, cell) < 0:
+                free(path.items)
+                return -1
+            cell = receivers[cell]
+        if cell >= 0 and first[cell] == ON_PATH:
+            # The path ends in a flow direction cycle. Going around it twice from its last cell lets every cell in the
+            # cycle see all other cells of the cycle downstream
+            cycle_start = path.size - 1
+            while path.items[cycle_start] != cell:
+                cycle_start -= 1
+            for j in range(cycle_start, path.size):
+                first[path.items[j]] = NO_CELL
+            for lap in range(2):
+                for j in range(path.size - 1, cycle_start - 1, -1):
+                    first[path.items[j]] = _resolve_first(receivers, labels, first, path.items[j], has_background,
+                                                          background)
+            path.size = cycle_start
+        # Resolve the walked cells from downstream and up
+        while path.size > 0:
+            path.size -= 1
+            cell = path.items[path.size]
+            first[cell] = _resolve_first(receivers, labels, first, cell, has_background, background)
+        found[i] = first[starts[i]]
+
+    free(path.items)
+    return 0
+
+
+def next_downstream_cells(receivers, labels, starts, background_label=None):
+    """Linear index of the first cell downstream of each start cell with another label. See
+    `net._next_downstream_cells`
+
+    Runs without the GIL for int32 and int64 labels. Other label types are processed as int64.
+    """
+    cdef np.int32_t[::1] receivers32
+    cdef np.int64_t[::1] receivers64
+    cdef np.int32_t[::1] labels32
+    cdef np.int64_t[::1] labels64
+    cdef np.int32_t background32 = 0
+    cdef np.int64_t background64 = 0
+    cdef bint has_background = background_label is not None
+    cdef np.int64_t[::1] first, found, starts64
+    cdef int status
+
+    if receivers.shape[0] != labels.shape[0]:
+        raise ValueError("Labels and receivers must have the same size")
+    starts64 = np.ascontiguousarray(starts, dtype=np.int64)
+    if starts64.shape[0] and (np.min(starts64) < 0 or np.max(starts64) >= receivers.shape[0]):
+        raise ValueError("Start cells must be in the raster")
+    npfirst = np.full(receivers.shape[0], UNVISITED, dtype=np.int64)
+    npfound = np.full(len(starts), NO_CELL, dtype=np.int64)
+    first = npfirst
+    found = npfound
+    if receivers.dtype != np.int32:
+        receivers = np.ascontiguousarray(receivers, dtype=np.int64)
+    if labels.dtype != np.int32:
+        labels = np.ascontiguousarray(labels, dtype=np.int64)
+    else:
+        labels = np.ascontiguousarray(labels)
+
+    if receivers.dtype == np.int32:
+        receivers32 = np.ascontiguousarray(receivers)
+        if labels.dtype == np.int32:
+            labels32 = labels
+            if has_background:
+                background32 = background_label
+            with nogil:
+                status = _next_downstream_cells(receivers32, labels32, starts64, has_background, background32, first,
+                                                found)
+        else:
+            labels64 = labels
+            if has_background:
+                background64 = background_label
+            with nogil:
+                status = _next_downstream_cells(receivers32, labels64, starts64, has_background, background64, first,
+                                                found)
+    else:
+        receivers64 = receivers
+        if labels.dtype == np.int32:
+            labels32 = labels
+            if has_background:
+                background32 = background_label
+            with nogil:
+                status = _next_downstream_cells(receivers64, labels32, starts64, has_background, background32, first,
+                                                found)
+        else:
+            labels64 = labels
+            if has_background:
+                background64 = background_label
+            with nogil:
+                status = _next_downstream_cells(receivers64, labels64, starts64, has_background, background64, first,
+                                                found)
+    if status < 0:
+        raise MemoryError()
+    return npfound
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t _next_downstream_cell(DTYPE_t_FLOWDIR[:,:] flowdir, bint packed, Py_ssize_t cols,
+                                      DTYPE_t_LABEL[:,:] labeled, Py_ssize_t start, bint has_background,
+                                      DTYPE_t_LABEL background) noexcept nogil:
+    """Linear index of the first cell downstream of start with another label. -1 if there is none"""
+    cdef Py_ssize_t limit = flowdir.shape[0] * cols
+    cdef Py_ssize_t cell = start, steps = 0
+    cdef DTYPE_t_LABEL lbl, src_label = labeled[start // cols, start % cols]
+    # A flow direction cycle ends after rows * cols cells
+    while cell >= 0 and steps < limit:
+        lbl = labeled[cell // cols, cell % cols]
+        if lbl != src_label and (not has_background or lbl != background):
+            return cell
+        cell = d8_receiver(flowdir, packed, cols, cell // cols, cell % cols)
+        steps += 1
+    return -1
+
+
+def next_downstream_cell(flowdir, labeled, cell, background_label=None):
+    """Linear index of the first cell downstream of cell with another label. See `net._next_downstream_cell`
+
+    Runs without the GIL for int32 and int64 labels. Other label types are processed as int64.
+    """
+    cdef DTYPE_t_FLOWDIR[:,:] raster
+    cdef bint packed
+    cdef Py_ssize_t cols
+    cdef np.int32_t[:,:] labeled32
+    cdef np.int64_t[:,:] labeled64
+    cdef np.int32_t background32 = 0
+    cdef np.int64_t background64 = 0
+    cdef bint has_background = background_label is not None
+    cdef Py_ssize_t start, found
+
+    raster, packed, cols = flowdir_data(flowdir)
+    if labeled.shape[0] != raster.shape[0] or labeled.shape[1] != cols:
+        raise ValueError("Labels and flow directions must have the same shape")
+    if not (0 <= cell[0] < raster.shape[0] and 0 <= cell[1] < cols):
+        raise ValueError("Cell must be in the raster")
+    start = cell[0] * cols + cell[1]
+    if labeled.dtype == np.int32:
+        labeled32 = labeled
+        if has_background:
+            background32 = background_label
+        with nogil:
+            found = _next_downstream_cell(raster, packed, cols, labeled32, start, has_background, background32)
+    else:
+        labeled64 = labeled if labeled.dtype == np.int64 else labeled.astype(np.int64)
+        if has_background:
+            background64 = background_label
+        with nogil:
+            found = _next_downstream_cell(raster, packed, cols, labeled64, start, has_background, background64)
+    return found
@@ -88,6 +88,50 @@ def assemble_pourpoints(transform, pp_pix, bluespot_stats, watershed_stats):
     return pour_points
 
 
+def bluespot_stats_and_pourpoints(depths, labeled, nlabels=None, accum=None, filled_no_flats=None):
+    """Calculate bluespot stats and pour point cells in one pass over the rasters
+
+    Pour points are the cells with the maximum accumulated flow if `accum` is given. Otherwise the cells with the
+    minimum `filled_no_flats` value.
+
+    Parameters
+    ----------
+    depths : 2D array
+        Bluespot depths
+    labeled : 2D array
+        Labeled bluespots
+    nlabels : int, optional
+        Number of bluespots
+    accum : 2D array, optional
+        Accumulated flow
+    filled_no_flats : 2D array, optional
+        DEM filled without flats. See `fill.fill_terrain_no_flats`
+
+    Returns
+    -------
+    pp_pix : structured array with fields row and col
+        i'th element is the pour point of bluespot with id=i
+    bluespot_stats : structured array with fields max, sum and count
+        i'th element holds stats for bluespot with id=i
+
+    """
+    if accum is not None:
+        values = dict(depths=depths, pourpoint=accum)
+        pp_reduction = 'argmax'
+    elif filled_no_flats is not None:
+        values = dict(depths=depths, pourpoint=filled_no_flats)
+        pp_reduction = 'argmin'
+    else:
+        raise Exception("Either accumulated flow or DEM must be present")
+    reductions = dict(depths=('max', 'sum'), pourpoint=(pp_reduction,))
+    stats = label.zonal_stats(labeled, values, reductions, nlabels)
+    pp_pix = np.rec.fromarrays([stats['pourpoint_{}_row'.format(pp_reduction)],
+                                stats['pourpoint_{}_col'.format(pp_reduction)]], names='row,col')
+    bluespot_stats = np.rec.fromarrays([stats['depths_max'], stats['depths_sum'], stats['count']],
+                                       names='max,sum,count')
+    return pp_pix, bluespot_stats
+
+
 class BluespotTool(object):
     """Process bluespot and watersheds.
 
@@ -157,25 +201,21 @@ class BluespotTool(object):
         self.logger.info("Calculating unfiltered bluespots")
         depths = self.input_depths.read()
         raw_labeled, raw_nlabels = label.connected_components(depths)
-        raw_bluespot_stats = label.label_stats(depths, raw_labeled)
         if not self.input_bluespot_filter_function:
             self.logger.info("Final number of bluespots (No filter specified): {}".format(raw_nlabels))
-            self.output_labeled_raster.write(raw_labeled)
+            labeled, nlabels = raw_labeled, raw_nlabels
         else:
             self.logger.info("Number of bluespots found before filtering: {}".format(raw_nlabels))
             self.logger.info("Calculating filtered bluespots")
+            raw_bluespot_stats = label.label_stats(depths, raw_labeled)
             # Run filter function and get list of bools indicating which labels to keep
             keepers = filterbluespots(self.input_bluespot_filter_function, cell_area, raw_bluespot_stats)
 
-            new_components = label.keep_labels(raw_labeled, keepers)
-            del raw_labeled
             # Filtered bluespots
-            labeled, nlabels = label.connected_components(new_components)
-            # Recalculate stats on filtered bluespots
-            bluespot_stats = label.label_stats(depths, labeled)
-            del depths
+            labeled, nlabels, _ = label.compact_labels(raw_labeled, keepers)
+            del raw_labeled
             self.logger.info("Number of bluespots left after filtering: {}".format(nlabels))
-            self.output_labeled_raster.write(labeled)
+        self.output_labeled_raster.write(labeled)
 
         if self.output_labeled_vector:
             self.logger.info("Vectorizing bluespots")
@@ -195,20 +235,23 @@ class BluespotTool(object):
             result = vectorize_labels_file(self.output_watersheds_raster.filepath)
             self.output_watersheds_vector.write_geojson_features(result)
 
+        # Stats on final bluespots and pour points are calculated in the same pass
         if self.input_accum:
             self.logger.info("Calculating pour points at max accumulated flow")
             accum = self.input_accum.read()
-            pp_pix = label.label_max_index(accum, labeled, nlabels)
+            pp_pix, bluespot_stats = bluespot_stats_and_pourpoints(depths, labeled, nlabels, accum=accum)
             del accum
         elif self.input_dem:
             self.logger.info("Calculating pour points at min filled")
             dem = self.input_dem.read()
             short, diag = fill.minimum_safe_short_and_diag(dem)
             filled_no_flats = fill.fill_terrain_no_flats(dem, short, diag)
-            pp_pix = label.label_min_index(filled_no_flats, labeled, nlabels)
+            pp_pix, bluespot_stats = bluespot_stats_and_pourpoints(depths, labeled, nlabels,
+                                                                   filled_no_flats=filled_no_flats)
             del filled_no_flats
         else:
             raise Exception("Either accumulated flow or DEM must be present")
+        del depths
 
         self.logger.info("Writing {} pour points".format(len(pp_pix)))
         # Put together info about pourpoints
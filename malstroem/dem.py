@@ -16,8 +16,9 @@ from __future__ import (absolute_import, division, print_function) #, unicode_li
 from builtins import *
 
 from malstroem.algorithms import fill
-from .algorithms import speedups, flow, dtypes
+from .algorithms import speedups, flow, flats, dtypes
 import logging
+import numpy as np
 
 
 class DemTool(object):
@@ -39,14 +40,33 @@ class DemTool(object):
         Writes bluespot depths
     output_accum : rasterwriter, optional
         Writes accumulated flow
+    output_filled_no_flats : rasterwriter, optional
+        Writes DEM filled without flats. Needed to update the outputs after local edits of the DEM with `RefillTool`.
+        Not supported with `flats.FLATS_METHOD_GRADIENT` as `RefillTool` updates epsilon flow directions only
+    flats_method : str, optional
+        How flow directions over flats are found. `flats.FLATS_METHOD_EPSILON` (default) routes flow over a DEM filled
+        with a minimum slope between cells. `flats.FLATS_METHOD_GRADIENT` routes flow over the filled DEM using an
+        integer gradient within each flat. This uses less memory but gives different flow directions on flats
+    fused : bool, optional
+        Fill the DEM with and without flats in one fused flood (see `fill.fill_terrain_fused`) instead of one after the
+        other. Outputs are the same. This is faster but raises the memory peak from about 13 to about 17 bytes per cell
     """
 
-    def __init__(self, input_dem, output_filled, output_flowdir, output_depths, output_accum=None):
+    def __init__(self, input_dem, output_filled, output_flowdir, output_depths, output_accum=None,
+                 output_filled_no_flats=None, flats_method=flats.FLATS_METHOD_EPSILON, fused=False):
+        if flats_method not in flats.FLATS_METHODS:
+            raise ValueError("Unknown flats method: {}".format(flats_method))
+        if output_filled_no_flats and flats_method != flats.FLATS_METHOD_EPSILON:
+            raise ValueError("DEM filled without flats is only written with flats method: {}".format(
+                flats.FLATS_METHOD_EPSILON))
         self.input_dem = input_dem
         self.output_filled = output_filled
         self.output_flowdir = output_flowdir
         self.output_depths = output_depths
         self.output_accum = output_accum
+        self.output_filled_no_flats = output_filled_no_flats
+        self.flats_method = flats_method
+        self.fused = fused
 
         self.logger = logging.getLogger(__name__)
 
@@ -62,32 +82,164 @@ class DemTool(object):
         if not speedups.enabled:
             self.logger.warning('Warning: Speedups are not available. If you have more than toy data you want them to be!')
 
-        self.logger.info("Calculating filled DEM")
-        # Filled and derived from it
-        filled = fill.fill_terrain(dem)
-        self.output_filled.write(filled)
+        self.logger.info("Calculating filled DEM, bluespot depths and flow directions")
+        short, diag = fill.minimum_safe_short_and_diag(dem)
+        stats = fill.FillStats(callback=self._log_fill_pass)
+        if self.flats_method == flats.FLATS_METHOD_GRADIENT:
+            filled = fill.fill_terrain(dem, stats=stats)
+            self.logger.info("Filled DEM: {}".format(stats))
+            self._write_filled_and_depths(dem, filled)
+            del dem
+            flowdir = flats.flats_flowdirection(filled, edges_flow_outward=True)
+            del filled
+        elif self.fused:
+            write_filled_no_flats = self.output_filled_no_flats.write if self.output_filled_no_flats else None
+            filled, depths, flowdir = fill.fill_terrain_fused(dem, short=short, diag=diag, edges_flow_outward=True,
+                                                              write_filled_no_flats=write_filled_no_flats, stats=stats)
+            self.logger.info("Filled DEM: {}".format(stats))
+            del dem
+            self.output_filled.write(filled)
+            del filled
+            self.output_depths.write(depths)
+            del depths
+        else:
+            # Each surface is written and released before the next is calculated
+            filled = fill.fill_terrain(dem, stats=stats)
+            self.logger.info("Filled DEM: {}".format(stats))
+            self._write_filled_and_depths(dem, filled)
+            del filled
+            self.logger.info("Calculating DEM filled without flats")
+            no_flats_stats = fill.FillStats(callback=self._log_fill_pass)
+            filled_no_flats = fill.fill_terrain_no_flats(dem, short=short, diag=diag, stats=no_flats_stats)
+            self.logger.info("Filled DEM without flats: {}".format(no_flats_stats))
+            del dem
+            if self.output_filled_no_flats:
+                self.output_filled_no_flats.write(filled_no_flats)
+            flowdir = flow.terrain_flowdirection(filled_no_flats, edges_flow_outward=True)
+            del filled_no_flats
+
+        self.output_flowdir.write(flowdir)
 
-        self.logger.info("Calculating bluespot depths")
+        if self.output_accum:
+            self.logger.info("Calculating flow accumulation")
+            accum = flow.accumulated_flow(flowdir)
+            self.output_accum.write(accum)
+            del accum
+
+        self.logger.info("Done")
+
+    def _write_filled_and_depths(self, dem, filled):
+        self.output_filled.write(filled)
         depths = filled - dem
         self.output_depths.write(depths)
-
-        del filled
         del depths
 
-        self.logger.info("Calculating flow directions")
-        # Filled no flats and derived
+    def _log_fill_pass(self, stats):
+        changed, seconds = stats.passes[-1]
+        self.logger.debug("Fill pass {}: {} cell updates in {:.2f}s".format(stats.pass_count, changed, seconds))
+
+
+def _changed_window(before, after):
+    changed_rows, changed_cols = np.nonzero(before != after)
+    if len(changed_rows) == 0:
+        return None
+    row, col = changed_rows.min(), changed_cols.min()
+    return row, col, changed_rows.max() - row + 1, changed_cols.max() - col + 1
+
+
+class RefillTool(object):
+    """Update filled DEM, flow directions and bluespot depths after a local edit of the DEM.
+
+    Only the cells which may be affected by the edit are recalculated. The outputs are the same as the outputs of
+    `DemTool` on the edited DEM.
+
+    Note
+    ----
+    Input DEM x, y and z coordinates must be in meters.
+
+    Parameters
+    ----------
+    input_dem : rasterreader
+        DEM data before the edit
+    input_edited_dem : rasterreader
+        DEM data after the edit
+    input_filled : rasterreader
+        Filled DEM of the DEM before the edit
+    input_filled_no_flats : rasterreader
+        DEM filled without flats of the DEM before the edit
+    input_flowdir : rasterreader
+        Flow directions of the DEM before the edit
+    output_filled : rasterwriter
+        Writes filled DEM
+    output_filled_no_flats : rasterwriter
+        Writes DEM filled without flats
+    output_flowdir : rasterwriter
+        Writes flow direction raster
+    output_depths : rasterwriter
+        Writes bluespot depths
+    window : (int, int, int, int), optional
+        Edited cells (row, col, nrows, ncols). Found by comparing the DEMs if not given
+    """
+
+    def __init__(self, input_dem, input_edited_dem, input_filled, input_filled_no_flats, input_flowdir,
+                 output_filled, output_filled_no_flats, output_flowdir, output_depths, window=None):
+        self.input_dem = input_dem
+        self.input_edited_dem = input_edited_dem
+        self.input_filled = input_filled
+        self.input_filled_no_flats = input_filled_no_flats
+        self.input_flowdir = input_flowdir
+        self.output_filled = output_filled
+        self.output_filled_no_flats = output_filled_no_flats
+        self.output_flowdir = output_flowdir
+        self.output_depths = output_depths
+        self.window = window
+
+        self.logger = logging.getLogger(__name__)
+
+    def process(self):
+        """Process
+        """
+        dem = self.input_dem.read().astype(dtypes.DTYPE_DTM, casting='same_kind', copy=False)
+        edited = self.input_edited_dem.read().astype(dtypes.DTYPE_DTM, casting='same_kind', copy=False)
+        assert dem.shape == edited.shape, "DEM and edited DEM must have the same shape"
+
+        if not speedups.enabled:
+            self.logger.warning('Warning: Speedups are not available. If you have more than toy data you want them to be!')
+
+        window = self.window or _changed_window(dem, edited)
         short, diag = fill.minimum_safe_short_and_diag(dem)
-        filled_no_flats = fill.fill_terrain_no_flats(dem, short=short, diag=diag)
+        edited_short, edited_diag = fill.minimum_safe_short_and_diag(edited)
         del dem
 
-        flowdir = flow.terrain_flowdirection(filled_no_flats, edges_flow_outward=True)
-        self.output_flowdir.write(flowdir)
+        filled = self.input_filled.read().astype(dtypes.DTYPE_FILL, copy=False)
+        filled_no_flats = self.input_filled_no_flats.read().astype(dtypes.DTYPE_FILLNOFLAT, copy=False)
+        flowdir = self.input_flowdir.read().astype(dtypes.DTYPE_FLOWDIR, copy=False)
+
+        if window is None:
+            self.logger.info("DEM is not changed")
+        else:
+            self.logger.info("Updating filled DEM after edit of window {}".format(window))
+            updated = fill.refill_terrain(edited, filled, window)
+            self.logger.info("Recalculated filled DEM in window {}".format(updated))
+
+            if (short, diag) == (edited_short, edited_diag):
+                self.logger.info("Updating flow directions")
+                updated = fill.refill_terrain_no_flats(edited, filled_no_flats, window, short=short, diag=diag)
+                updated = flow.update_flowdirection(filled_no_flats, flowdir, updated, edges_flow_outward=True)
+                self.logger.info("Recalculated flow directions in window {}".format(updated))
+            else:
+                # The minimum elevation differences depend on the elevation range of the DEM
+                self.logger.warning("Edit changed the elevation range of the DEM. Recalculating all flow directions")
+                filled_no_flats = fill.fill_terrain_no_flats(edited, short=edited_short, diag=edited_diag)
+                flowdir = flow.terrain_flowdirection(filled_no_flats, edges_flow_outward=True)
+
+        self.output_filled_no_flats.write(filled_no_flats)
         del filled_no_flats
 
-        if self.output_accum:
-            self.logger.info("Calculating flow accumulation")
-            accum = flow.accumulated_flow(flowdir)
-            self.output_accum.write(accum)
-            del accum
+        self.output_flowdir.write(flowdir)
+        del flowdir
+
+        self.output_depths.write(filled - edited)
+        self.output_filled.write(filled)
 
         self.logger.info("Done")
@@ -62,15 +62,16 @@ def bluespot_hypsometry_stats(bluespotlabels, dem, resolution, labels_max = None
     label_z_stats = label_stats(dem, bluespotlabels, labels_max)
 
     logger.debug("Collecting label data values")
-    label_data_values = label_data(dem, bluespotlabels, labels_max, background=background)
+    values, offsets = label_data(dem, bluespotlabels, labels_max, background=background)
 
     logger.debug("Calculating histograms")
-    for label, data in enumerate(label_data_values):
+    for label in range(labels_max + 1):
         if label == background:
             bins = HistogramBinsInfo(0, 0, 0, -1)
             counts = []
         else:
             bins = histogram_bins(label_z_stats[label]["min"], label_z_stats[label]["max"], resolution)
+            data = values[offsets[label]:offsets[label + 1]]
             counts, _ = np.histogram(data, bins.num_bins, (bins.lower_bound, bins.upper_bound))
         yield label, HypsometryStats(Histogram(counts, bins), label_z_stats[label]["min"], label_z_stats[label]["max"])
 
@@ -54,6 +54,8 @@ class RasterReader(object):
         Raster shape (rows, columns)
     resolution = (float, float)
         Cell size in coordinate units (height, width)
+    block_shape: (int, int)
+        Natural block size of the raster dataset (rows, columns)
     """
 
     def __init__(self, filepath, nodatasubst=None):
@@ -66,6 +68,8 @@ class RasterReader(object):
         self.nodatasubst = nodatasubst
         self.shape = self._ds.RasterYSize, self._ds.RasterXSize
         self.resolution = (abs(self.transform[5]),abs(self.transform[1]))
+        block_cols, block_rows = self._bnd.GetBlockSize()
+        self.block_shape = (block_rows, block_cols)
 
     def read(self):
         """Read raster into 2D numpy array
@@ -75,6 +79,30 @@ class RasterReader(object):
         ndarray
         """
         data = self._bnd.ReadAsArray()
+        return self._substitute_nodata(data)
+
+    def read_window(self, row, col, nrows, ncols):
+        """Read a window of the raster into 2D numpy array
+
+        Parameters
+        ----------
+        row : int
+            First row of window
+        col : int
+            First column of window
+        nrows : int
+            Number of rows in window
+        ncols : int
+            Number of columns in window
+
+        Returns
+        -------
+        ndarray
+        """
+        data = self._bnd.ReadAsArray(col, row, ncols, nrows)
+        return self._substitute_nodata(data)
+
+    def _substitute_nodata(self, data):
         if self.nodata and self.nodatasubst is not None:
             mask = np.isnan(data) if np.isnan(self.nodata) else np.isclose(data, self.nodata)
             data[mask] = self.nodatasubst
@@ -94,6 +122,8 @@ class RasterWriter(object):
         Well Known Text (WKT) representation of the coordinate reference system
     nodata : float or None
         Raster dataset nodata value
+    nbits : int or None
+        Bits per cell of integer rasters if less than the bits of the data type. For instance 4 for flow directions
 
     Attributes
     ----------
@@ -111,13 +141,16 @@ class RasterWriter(object):
         Raster dataset nodata value
     """
 
-    def __init__(self, filepath, transform, crs, nodata=None):
+    def __init__(self, filepath, transform, crs, nodata=None, nbits=None):
         self.filepath = filepath
         self.transform = transform
         self.crs = crs
         self.driver = 'gtiff'
         self.options = dict(tiled='yes', compress='deflate', bigtiff='if_safer')
+        if nbits:
+            self.options['nbits'] = nbits
         self.nodata = nodata
+        self._outds = None
 
     def write(self, data):
         """Write numpy data to file
@@ -131,28 +164,7 @@ class RasterWriter(object):
         None
 
         """
-        gdal_options = self.options.copy()
-        if data.dtype == np.float64:
-            gdal_datatype = gdal.GDT_Float64
-        elif data.dtype == np.float32:
-            gdal_datatype = gdal.GDT_Float32
-            gdal_options['predictor'] = 2
-        elif data.dtype == np.int32:
-            gdal_datatype = gdal.GDT_Int32
-            gdal_options['predictor'] = 2
-        elif data.dtype == np.uint32:
-            gdal_datatype = gdal.GDT_UInt32
-            gdal_options['predictor'] = 2
-        elif data.dtype == np.int16:
-            gdal_datatype = gdal.GDT_Int16
-            gdal_options['predictor'] = 2
-        elif data.dtype == np.uint16:
-            gdal_datatype = gdal.GDT_UInt16
-            gdal_options['predictor'] = 2
-        elif data.dtype == np.uint8:
-            gdal_datatype = gdal.GDT_Byte
-            gdal_options['predictor'] = 2
-        else:
+        if not self._is_supported_dtype(data.dtype):
             # Not directly supported by GDAL. We need to cast to something supported
             min_val = data.min()
             max_val = data.max()
@@ -172,12 +184,39 @@ class RasterWriter(object):
                 if min_val >= -3.4028235e+38 and max_val <= 3.4028235e+38:
                     return self.write(data.astype("float32"))
                 return self.write(data.astype("float64"))
-        if not gdal_datatype:
             raise NotImplementedError(f"Cannot determine GDAL datatype for numpy datatype {data.dtype} with values in the range [{min_val},{max_val}]")
 
+        self.open(data.shape, data.dtype)
+        self.write_window(data, 0, 0)
+        self.close()
+
+    def open(self, shape, dtype):
+        """Create output dataset to be written one window at a time using `write_window`
+
+        Parameters
+        ----------
+        shape : (int, int)
+            Raster shape (rows, columns)
+        dtype : numpy dtype
+            Data type of the output. Must be directly supported by GDAL
+
+        Returns
+        -------
+        None
+
+        """
+        dtype = np.dtype(dtype)
+        if not self._is_supported_dtype(dtype):
+            raise NotImplementedError(f"Cannot determine GDAL datatype for numpy datatype {dtype}")
+        gdal_options = self.options.copy()
+        gdal_datatype = self._gdal_datatypes[dtype]
+        # Horizontal differencing is not supported for cells of less than 8 bits
+        if dtype != np.float64 and 'nbits' not in gdal_options:
+            gdal_options['predictor'] = 2
+
         drv = gdal.GetDriverByName(self.driver)
         opts = ["{}={}".format(k, v) for k, v in gdal_options.items()]
-        outds = drv.Create(self.filepath, data.shape[1], data.shape[0], 1, gdal_datatype, opts)
+        outds = drv.Create(self.filepath, shape[1], shape[0], 1, gdal_datatype, opts)
 
         assert outds is not None, "Could not create output dataset {}".format(self.filepath)
 
@@ -186,12 +225,46 @@ class RasterWriter(object):
         if self.crs:
             outds.SetProjection(self.crs)
 
-        outbnd = outds.GetRasterBand(1)
         if self.nodata is not None:
-            outbnd.SetNoDataValue(self.nodata)
-        outbnd.WriteArray(data, 0, 0)
-        outds.FlushCache()
-        outds = None
+            outds.GetRasterBand(1).SetNoDataValue(self.nodata)
+        self._outds = outds
+
+    def write_window(self, data, row, col):
+        """Write numpy data to a window of the dataset created by `open`
+
+        Parameters
+        ----------
+        data : 2D numpy array
+        row : int
+            First row of window
+        col : int
+            First column of window
+
+        Returns
+        -------
+        None
+
+        """
+        self._outds.GetRasterBand(1).WriteArray(data, col, row)
+
+    def close(self):
+        """Flush and close the dataset created by `open`
+        """
+        self._outds.FlushCache()
+        self._outds = None
+
+    _gdal_datatypes = {
+        np.dtype(np.float64): gdal.GDT_Float64,
+        np.dtype(np.float32): gdal.GDT_Float32,
+        np.dtype(np.int32): gdal.GDT_Int32,
+        np.dtype(np.uint32): gdal.GDT_UInt32,
+        np.dtype(np.int16): gdal.GDT_Int16,
+        np.dtype(np.uint16): gdal.GDT_UInt16,
+        np.dtype(np.uint8): gdal.GDT_Byte,
+    }
+
+    def _is_supported_dtype(self, dtype):
+        return np.dtype(dtype) in self._gdal_datatypes
 
 
 class VectorWriter(object):
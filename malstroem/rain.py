@@ -139,7 +139,7 @@ class RasterVolumeTool(object):
         assert bluespot_labels_raster.shape == water_raster.shape, "Rasters must have same extent and resolution"
 
         self.logger.info("Calculating water volumes")
-        water_stats = label.label_stats(water_raster, bluespot_labels_raster)
+        water_stats = label.zonal_stats(bluespot_labels_raster, dict(water=water_raster), dict(water=('sum',)))
         
         # Factor to convert from raster cell unit to m3
         conversion_factor = 1
@@ -156,7 +156,7 @@ class RasterVolumeTool(object):
             raise NotImplementedError(F"Unit {self.precipunit} is not implemented")
 
         self.logger.info(f"Using conversion factor {conversion_factor} to go from cell values to m3")
-        water_volumes = water_stats["sum"] * conversion_factor
+        water_volumes = water_stats["water_sum"] * conversion_factor
 
         max_id = len(water_volumes) - 1
         for node in all_nodes:
@@ -20,9 +20,10 @@ from builtins import (ascii, bytes, chr, dict, filter, hex, input,
 
 import click
 import click_log
+import numpy as np
 
 from malstroem import io
-from malstroem.bluespots import filterbluespots, assemble_pourpoints
+from malstroem.bluespots import filterbluespots, assemble_pourpoints, bluespot_stats_and_pourpoints
 from malstroem.vector import vectorize_labels_file_io
 from ._utils import parse_filter
 from malstroem.algorithms import label, flow, fill
@@ -33,8 +34,12 @@ from osgeo import ogr
 @click.option('-out', required=True, type=click.Path(exists=False), help='Output file (bluespots)')
 @click.option('-filter', help='Filter bluespots by area, maximum depth and volume. Format: '
                                '"area > 20.5 and (maxdepth > 0.05 or volume > 2.5)"')
+@click.option('-tilesize', type=click.IntRange(min=1),
+              help='Label the depths in tiles of this many rows and columns to limit memory usage')
+@click.option('-workers', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Number of threads used to label bluespots')
 @click_log.simple_verbosity_option()
-def process_bspots(depths, out, filter):
+def process_bspots(depths, out, filter, tilesize, workers):
     """Label bluespots.
 
     Assign unique bluespot ID to all cells belonging to a bluespot. Optionally disregarding some bluespots based on a
@@ -50,8 +55,20 @@ def process_bspots(depths, out, filter):
     cell_height = abs(transform[5])
     cell_area = cell_width * cell_height
 
+    if tilesize:
+        keep_function = None
+        if filter:
+            def keep_function(raw_bluespot_stats):
+                return filterbluespots(filter_function, cell_area, raw_bluespot_stats)
+        labeled_writer.open(depths_reader.shape, np.int32)
+        label.connected_components_tiled(depths_reader.read_window, labeled_writer.write_window, depths_reader.shape,
+                                         tile_shape=(tilesize, tilesize), workers=workers,
+                                         keep_function=keep_function)
+        labeled_writer.close()
+        return
+
     depths_data = depths_reader.read()
-    raw_labeled, raw_nlabels = label.connected_components(depths_data)
+    raw_labeled, raw_nlabels = label.connected_components(depths_data, workers=workers)
     if not filter:
         # This is the end  my friend
         labeled_writer.write(raw_labeled)
@@ -61,8 +78,7 @@ def process_bspots(depths, out, filter):
 
     raw_bluespot_stats = label.label_stats(depths_data, raw_labeled)
     keepers = filterbluespots(filter_function, cell_area, raw_bluespot_stats)
-    new_components = label.keep_labels(raw_labeled, keepers)
-    labeled, nlabels = label.connected_components(new_components)
+    labeled, nlabels, _ = label.compact_labels(raw_labeled, keepers)
     labeled_writer.write(labeled)
 
 
@@ -122,20 +138,20 @@ def process_pourpoints(bluespots, depths, watersheds, dem, accum, out, format, l
 
     pourpnt_writer = io.VectorWriter(format, out, layername, [], ogr.wkbPoint, depths_reader.crs, dsco, lco)
 
-    # Recalculate stats on filtered bluespots
+    # Stats on filtered bluespots and pour points in one pass
     labeled_data = bspot_reader.read()
     depths_data = depths_reader.read()
-    bluespot_stats = label.label_stats(depths_data, labeled_data)
-    del depths_data
-
     if accum:
-        pp_pix = label.label_max_index(data_reader.read(), labeled_data)
+        pp_pix, bluespot_stats = bluespot_stats_and_pourpoints(depths_data, labeled_data, accum=data_reader.read())
     elif dem:
         dem_data = data_reader.read()
         short, diag = fill.minimum_safe_short_and_diag(dem_data)
         filled_no_flats = fill.fill_terrain_no_flats(dem_data, short, diag)
-        pp_pix = label.label_min_index(filled_no_flats, labeled_data)
         del dem_data
+        pp_pix, bluespot_stats = bluespot_stats_and_pourpoints(depths_data, labeled_data,
+                                                               filled_no_flats=filled_no_flats)
+        del filled_no_flats
+    del depths_data
 
     watershed_stats = label.label_count(wsheds_reader.read())
     pour_points = assemble_pourpoints(depths_reader.transform, pp_pix, bluespot_stats, watershed_stats)
@@ -59,6 +59,7 @@ cli.add_command(dem.process_filled)
 cli.add_command(dem.process_depths)
 cli.add_command(dem.process_flowdir)
 cli.add_command(dem.process_accum)
+cli.add_command(dem.process_refill)
 
 # bluespot
 cli.add_command(bluespot.process_bspots)
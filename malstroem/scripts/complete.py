@@ -19,6 +19,8 @@ import click_log
 
 from malstroem import dem as demtool, bluespots, io, streams, rain as raintool, network, hyps, approx
 from malstroem.vector import vectorize_labels_file_io
+from malstroem.algorithms.flats import FLATS_METHODS, FLATS_METHOD_EPSILON
+from malstroem.algorithms.dtypes import NBITS_FLOWDIR
 from ._utils import parse_filter
 from osgeo import ogr, osr
 import os
@@ -33,16 +35,25 @@ logger = logging.getLogger(__name__)
 @click.option('-zresolution', required=True, type=float, help='Resolution in [m] when collecting statistics used for estimating water level for partially filled bluespots')
 @click.option('-accum', is_flag=True, help='Calculate accumulated flow')
 @click.option('-vector', is_flag=True, help='Vectorize bluespots and watersheds')
+@click.option('-fillednoflats', is_flag=True, help='Also write the DEM filled without flats. Needed by "refill". Only with "-flats epsilon"')
+@click.option('-flats', 'flats_method', type=click.Choice(FLATS_METHODS), default=FLATS_METHOD_EPSILON, show_default=True,
+              help='How flow over flats is routed. "epsilon" fills flats with a minimum slope. "gradient" uses an '
+                   'integer gradient within each flat and needs less memory')
 @click.option('-filter', help='Filter bluespots by area, maximum depth and volume. Format: '
                                '"area > 20.5 and (maxdepth > 0.05 or volume > 2.5)"')
+@click.option('-fused', is_flag=True,
+              help='Fill the DEM with and without flats in one flood. Faster but needs more memory')
 @click_log.simple_verbosity_option()
-def process_all(dem, outdir, accum, filter, mm, zresolution, vector):
+def process_all(dem, outdir, accum, filter, mm, zresolution, vector, fillednoflats, flats_method, fused):
     """Quick option to run all processes.
 
     \b
     Example:
     malstroem complete -mm 20 -filter "volume > 2.5" -dem dem.tif  -zresolution 0.1 -outdir ./outdir/
     """
+    if fillednoflats and flats_method != FLATS_METHOD_EPSILON:
+        raise click.BadParameter('-fillednoflats only supports "-flats {}"'.format(FLATS_METHOD_EPSILON))
+
     # Check that outdir exists and is empty
     if not os.path.isdir(outdir) or not os.path.exists(outdir) or os.listdir(outdir):
         logger.error("outdir isn't an empty directory")
@@ -66,15 +77,20 @@ def process_all(dem, outdir, accum, filter, mm, zresolution, vector):
     logger.info('   mm: {}mm'.format(mm))
     logger.info('   zresolution: {}m'.format(zresolution))
     logger.info('   accum: {}'.format(accum))
+    logger.info('   fillednoflats: {}'.format(fillednoflats))
+    logger.info('   flats: {}'.format(flats_method))
+    logger.info('   fused: {}'.format(fused))
     logger.info('   filter: {}'.format(filter))
 
     # Process DEM
     filled_writer = io.RasterWriter(os.path.join(outdir, 'filled.tif'), tr, crs, nodatasubst)
-    flowdir_writer = io.RasterWriter(os.path.join(outdir, 'flowdir.tif'), tr, crs)
+    flowdir_writer = io.RasterWriter(os.path.join(outdir, 'flowdir.tif'), tr, crs, nbits=NBITS_FLOWDIR)
     depths_writer = io.RasterWriter(os.path.join(outdir, 'bs_depths.tif'), tr, crs)
     accum_writer = io.RasterWriter(os.path.join(outdir, 'accum.tif'), tr, crs) if accum else None
+    filled_no_flats_writer = io.RasterWriter(os.path.join(outdir, 'filled_noflats.tif'), tr, crs, nodatasubst) if fillednoflats else None
 
-    dtmtool = demtool.DemTool(dem_reader, filled_writer, flowdir_writer, depths_writer, accum_writer)
+    dtmtool = demtool.DemTool(dem_reader, filled_writer, flowdir_writer, depths_writer, accum_writer,
+                              filled_no_flats_writer, flats_method=flats_method, fused=fused)
     dtmtool.process()
 
     # Process bluespots
@@ -14,24 +14,55 @@
 from __future__ import (absolute_import, division, print_function) #, unicode_literals)
 from builtins import *
 
+import os
+
 import click
 import click_log
+import numpy as np
 
-from malstroem import io
-from malstroem.algorithms import fill, flow
+from malstroem import io, dem as demtool
+from malstroem.algorithms import dtypes, fill, flats, flow
 
 NODATASUBST = -999
 
+TILESIZE_HELP = 'Process the DEM in tiles of this many rows and columns to limit memory usage'
+
+FLATS_HELP = 'How flow over flats is routed. "epsilon" fills flats with a minimum slope. "gradient" uses an integer ' \
+             'gradient within each flat and needs less memory'
+
+WORKERS_HELP = 'Number of threads used to fill the DEM and calculate flow directions'
+
+
+def _windows_min_max(reader, tilesize):
+    """Minimum and maximum raster value read one tile at a time"""
+    rows, cols = reader.shape
+    minval, maxval = float('inf'), float('-inf')
+    for row in range(0, rows, tilesize):
+        for col in range(0, cols, tilesize):
+            data = reader.read_window(row, col, min(tilesize, rows - row), min(tilesize, cols - col))
+            minval = min(minval, data.min())
+            maxval = max(maxval, data.max())
+    return minval, maxval
+
+
 @click.command('filled')
 @click.option('-dem', required=True, type=click.Path(exists=True), help='DEM file')
 @click.option('-out', required=True, type=click.Path(exists=False), help='Output file (filled DEM)')
+@click.option('-tilesize', type=click.IntRange(min=1), help=TILESIZE_HELP)
 @click_log.simple_verbosity_option()
-def process_filled(dem, out):
+def process_filled(dem, out, tilesize):
     """Create a filled (depressionless) DEM.
     """
     dem_reader = io.RasterReader(dem, nodatasubst=NODATASUBST)
     filled_writer = io.RasterWriter(out, dem_reader.transform, dem_reader.crs, NODATASUBST)
 
+    if tilesize:
+        filled_writer.open(dem_reader.shape, dtypes.DTYPE_FILL)
+        fill.fill_terrain_tiled(dem_reader.read_window, filled_writer.write_window, dem_reader.shape,
+                                tile_shape=(tilesize, tilesize))
+        filled_writer.close()
+        return
+
     filled_data = fill.fill_terrain(dem_reader.read())
     filled_writer.write(filled_data)
 
@@ -57,8 +88,12 @@ def process_depths(dem, filled, out):
 @click.command('flowdir')
 @click.option('-dem', required=True, type=click.Path(exists=True), help='DEM file')
 @click.option('-out', required=True, type=click.Path(exists=False), help='Output file (flow directions)')
+@click.option('-tilesize', type=click.IntRange(min=1), help=TILESIZE_HELP)
+@click.option('-flats', 'flats_method', type=click.Choice(flats.FLATS_METHODS), default=flats.FLATS_METHOD_EPSILON,
+              show_default=True, help=FLATS_HELP)
+@click.option('-workers', type=click.IntRange(min=1), default=1, show_default=True, help=WORKERS_HELP)
 @click_log.simple_verbosity_option()
-def process_flowdir(dem, out):
+def process_flowdir(dem, out, tilesize, flats_method, workers):
     """Calculate surface water flow directions.
 
     This is a two step process:
@@ -66,7 +101,8 @@ def process_flowdir(dem, out):
     Step 1:
     Fill depressions in the DEM in a way which preserves a downward slope along the flow path. This is done by requiring
     a (very) small minimum slope between cells. This results in flow over filled areas being routed to the nearest pour
-    point.
+    point. With "-flats gradient" depressions are filled level and flow over flats is routed towards lower terrain and
+    away from higher terrain.
 
     Step 2:
     Flow directions for each cell. Uses a D8 flow routing algorithm: At each cell the slope to each of the 8 neighboring
@@ -75,32 +111,116 @@ def process_flowdir(dem, out):
 
     Flow direction from a cell is encoded: Up=0, UpRight=1, ..., UpLeft=7, NoDirection=8
     """
+    if tilesize and flats_method != flats.FLATS_METHOD_EPSILON:
+        raise click.BadParameter('-tilesize only supports "-flats {}"'.format(flats.FLATS_METHOD_EPSILON))
+    if tilesize and workers > 1:
+        raise click.BadParameter('-tilesize does not support more than one worker')
+
     dem_reader = io.RasterReader(dem, nodatasubst=NODATASUBST)
-    flowdir_writer = io.RasterWriter(out, dem_reader.transform, dem_reader.crs, NODATASUBST)
+    flowdir_writer = io.RasterWriter(out, dem_reader.transform, dem_reader.crs, NODATASUBST,
+                                     nbits=dtypes.NBITS_FLOWDIR)
+
+    if tilesize:
+        tile_shape = (tilesize, tilesize)
+        short, diag = fill.minimum_safe_short_and_diag(np.array(_windows_min_max(dem_reader, tilesize)))
+        flowdir_writer.open(dem_reader.shape, dtypes.DTYPE_FLOWDIR)
+        fill.fill_terrain_no_flats_tiled(dem_reader.read_window, None, dem_reader.shape, short=short, diag=diag,
+                                         tile_shape=tile_shape, write_flowdir_window=flowdir_writer.write_window,
+                                         edges_flow_outward=True)
+        flowdir_writer.close()
+        return
 
     dem_data = dem_reader.read()
+    if flats_method == flats.FLATS_METHOD_GRADIENT:
+        filled = fill.fill_terrain(dem_data, workers=workers)
+        del dem_data
+        flowdir_writer.write(flats.flats_flowdirection(filled, edges_flow_outward=True, workers=workers))
+        return
+
     short, diag = fill.minimum_safe_short_and_diag(dem_data)
-    filled_no_flats = fill.fill_terrain_no_flats(dem_data, short=short, diag=diag)
+    filled_no_flats = fill.fill_terrain_no_flats(dem_data, short=short, diag=diag, workers=workers)
     del dem_data
 
-    flowdir_data = flow.terrain_flowdirection(filled_no_flats, edges_flow_outward=True)
+    flowdir_data = flow.terrain_flowdirection(filled_no_flats, edges_flow_outward=True, workers=workers)
 
     flowdir_writer.write(flowdir_data)
 
+@click.command('refill')
+@click.option('-dem', required=True, type=click.Path(exists=True), help='DEM file before the edit')
+@click.option('-edited', required=True, type=click.Path(exists=True), help='Edited DEM file')
+@click.option('-filled', required=True, type=click.Path(exists=True), help='Filled DEM file of the DEM before the edit')
+@click.option('-fillednoflats', required=True, type=click.Path(exists=True),
+              help='DEM filled without flats of the DEM before the edit. See "complete -fillednoflats"')
+@click.option('-flowdir', required=True, type=click.Path(exists=True),
+              help='Flow direction file of the DEM before the edit')
+@click.option('-window', nargs=4, type=int, default=None,
+              help='Edited cells: ROW COL NROWS NCOLS. Found by comparing the DEM files if not given')
+@click.option('-outdir', required=True, type=click.Path(exists=True), help='Output directory')
+@click_log.simple_verbosity_option()
+def process_refill(dem, edited, filled, fillednoflats, flowdir, window, outdir):
+    """Update filled DEM, bluespot depths and flow directions after a local edit of the DEM.
+
+    Only the cells which may be affected by the edit are recalculated. Outputs are written to outdir as filled.tif,
+    filled_noflats.tif, flowdir.tif and bs_depths.tif.
+
+    \b
+    Example:
+    malstroem refill -dem dem.tif -edited dike.tif -filled filled.tif -fillednoflats filled_noflats.tif -flowdir flowdir.tif -outdir ./dike/
+    """
+    dem_reader = io.RasterReader(dem, nodatasubst=NODATASUBST)
+    edited_reader = io.RasterReader(edited, nodatasubst=NODATASUBST)
+    tr = edited_reader.transform
+    crs = edited_reader.crs
+
+    refill_tool = demtool.RefillTool(
+        input_dem=dem_reader,
+        input_edited_dem=edited_reader,
+        input_filled=io.RasterReader(filled, nodatasubst=NODATASUBST),
+        input_filled_no_flats=io.RasterReader(fillednoflats, nodatasubst=NODATASUBST),
+        input_flowdir=io.RasterReader(flowdir),
+        output_filled=io.RasterWriter(os.path.join(outdir, 'filled.tif'), tr, crs, NODATASUBST),
+        output_filled_no_flats=io.RasterWriter(os.path.join(outdir, 'filled_noflats.tif'), tr, crs, NODATASUBST),
+        output_flowdir=io.RasterWriter(os.path.join(outdir, 'flowdir.tif'), tr, crs, nbits=dtypes.NBITS_FLOWDIR),
+        output_depths=io.RasterWriter(os.path.join(outdir, 'bs_depths.tif'), tr, crs),
+        window=window or None)
+    refill_tool.process()
+
 @click.command('accum')
 @click.option('-flowdir', required=True, type=click.Path(exists=True), help='Flow direction file')
 @click.option('-out', required=True, type=click.Path(exists=False), help='Output file (accumulated flow)')
+@click.option('-weights', type=click.Path(exists=True),
+              help='Raster with a weight for each cell. Nodata weights count as 0')
+@click.option('-tilesize', type=click.IntRange(min=1),
+              help='Process the flow directions in tiles of this many rows and columns to limit memory usage')
 @click_log.simple_verbosity_option()
-def process_accum(flowdir, out):
+def process_accum(flowdir, out, weights, tilesize):
     """Calculate accumulated flow.
 
     The value in an output cell is the total number of cells upstream of that cell. To get the upstream area
     multiply with cell size.
+
+    With "-weights" the value in an output cell is the sum of the weights of the cell and the cells upstream of it. For
+    instance the precipitation or runoff from the upstream area.
     """
     flowdir_reader = io.RasterReader(flowdir)
     accum_writer = io.RasterWriter(out, flowdir_reader.transform, flowdir_reader.crs)
 
+    weights_reader = None
+    if weights:
+        weights_reader = io.RasterReader(weights, nodatasubst=0)
+        if weights_reader.shape != flowdir_reader.shape:
+            raise click.BadParameter('Weights and flow directions must have the same shape')
+
+    if tilesize:
+        accum_writer.open(flowdir_reader.shape, dtypes.DTYPE_ACCUM)
+        flow.accumulated_flow_tiled(flowdir_reader.read_window, accum_writer.write_window, flowdir_reader.shape,
+                                    read_weights_window=weights_reader.read_window if weights_reader else None,
+                                    tile_shape=(tilesize, tilesize))
+        accum_writer.close()
+        return
+
     flowdir_data = flowdir_reader.read()
-    accum_data = flow.accumulated_flow(flowdir_data)
+    weights_data = weights_reader.read() if weights_reader else None
+    accum_data = flow.accumulated_flow(flowdir_data, weights=weights_data)
 
     accum_writer.write(accum_data)
\ No newline at end of file
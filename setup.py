@@ -33,7 +33,7 @@ INSTALL_REQUIRES = [
           'click-log==0.1.8']
 EXTRAS_REQUIRE = {
           'test': ['pytest'],
-          'speedups': ['cython', 'cyarray'],
+          'speedups': ['cython'],
           'doc': ['sphinx_rtd_theme']
       }
 ENTRY_POINTS = """
@@ -112,8 +112,12 @@ if cythonize:
                   ['malstroem/algorithms/speedups/_fill.pyx'], **ext_options),
         Extension('malstroem.algorithms.speedups._flow',
                   ['malstroem/algorithms/speedups/_flow.pyx'], **ext_options),
+        Extension('malstroem.algorithms.speedups._flats',
+                  ['malstroem/algorithms/speedups/_flats.pyx'], **ext_options),
         Extension('malstroem.algorithms.speedups._label',
-                  ['malstroem/algorithms/speedups/_label.pyx'], **ext_options)
+                  ['malstroem/algorithms/speedups/_label.pyx'], **ext_options),
+        Extension('malstroem.algorithms.speedups._net',
+                  ['malstroem/algorithms/speedups/_net.pyx'], **ext_options)
     ])
 # --------------------------------------------------------------------------------
 # Get the long description from the relevant file
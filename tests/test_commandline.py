@@ -101,6 +101,31 @@ def test_accum(tmpdir):
     assert os.path.isfile(f)
 
 
+def test_accum_weights(tmpdir):
+    f = str(tmpdir.join('accum.tif'))
+    runner = CliRunner()
+    result = runner.invoke(cli, ['accum',
+                                 '-flowdir', flowdirnoflatsfile,
+                                 '-weights', precipraster_float_file,
+                                 '-out', f])
+    assert result.output == ''
+    assert result.exit_code == 0
+    assert os.path.isfile(f)
+
+
+def test_accum_tilesize(tmpdir):
+    f = str(tmpdir.join('accum.tif'))
+    runner = CliRunner()
+    result = runner.invoke(cli, ['accum',
+                                 '-flowdir', flowdirnoflatsfile,
+                                 '-weights', precipraster_float_file,
+                                 '-tilesize', 64,
+                                 '-out', f])
+    assert result.output == ''
+    assert result.exit_code == 0
+    assert os.path.isfile(f)
+
+
 def test_bspot(tmpdir):
     f = str(tmpdir.join('bspots.tif'))
     runner = CliRunner()
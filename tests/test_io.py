@@ -75,3 +75,13 @@ def test_write_raster_datatypes(tmpdir):
         read_data = reader.read()
         np.testing.assert_array_equal(read_data, cast_data)
 
+def test_write_raster_nbits(tmpdir):
+    shape = (25, 30)
+    data = (np.arange(shape[0] * shape[1]) % 9).reshape(shape).astype("uint8")
+    gt = (510000, 0.2, 0, 6150000, 0, -0.2)
+    filepath = Path(tmpdir) / "nbits.tif"
+    writer = io.RasterWriter(str(filepath), gt, "", nodata=None, nbits=4)
+    writer.write(data)
+    reader = io.RasterReader(str(filepath))
+    assert reader._ds.GetRasterBand(1).GetMetadataItem("NBITS", "IMAGE_STRUCTURE") == "4"
+    np.testing.assert_array_equal(reader.read(), data)
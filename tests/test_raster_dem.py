@@ -1,10 +1,12 @@
 import numpy as np
+import pytest
 from osgeo import osr
 from malstroem import dem, io
 from data.fixtures import dtmfile, filledfile, flowdirnoflatsfile
 
 
-def test_dem_processor(tmpdir):
+@pytest.mark.parametrize("fused", [False, True])
+def test_dem_processor(tmpdir, fused):
     dem_reader = io.RasterReader(dtmfile)
 
     tr = dem_reader.transform
@@ -15,13 +17,27 @@ def test_dem_processor(tmpdir):
     depths_writer = io.RasterWriter(str(tmpdir.join('depths.tif')), tr, crs)
     accum_writer = io.RasterWriter(str(tmpdir.join('accum.tif')), tr, crs)
 
-    tool = dem.DemTool(dem_reader, filled_writer, flowdir_writer, depths_writer, accum_writer)
+    tool = dem.DemTool(dem_reader, filled_writer, flowdir_writer, depths_writer, accum_writer, fused=fused)
     tool.process()
 
     assert_rasters_are_equal(filledfile, filled_writer.filepath)
     assert_rasters_are_equal(flowdirnoflatsfile, flowdir_writer.filepath)
 
 
+def test_dem_processor_gradient_filled_no_flats(tmpdir):
+    dem_reader = io.RasterReader(dtmfile)
+
+    tr = dem_reader.transform
+    crs = dem_reader.crs
+
+    writers = [io.RasterWriter(str(tmpdir.join(name)), tr, crs) for name in ('filled.tif', 'flowdir.tif', 'depths.tif')]
+    filled_no_flats_writer = io.RasterWriter(str(tmpdir.join('filled_noflats.tif')), tr, crs)
+
+    # Flow directions over flats found by the gradient method can not be updated from the DEM filled without flats
+    with pytest.raises(ValueError):
+        dem.DemTool(dem_reader, *writers, output_filled_no_flats=filled_no_flats_writer, flats_method='gradient')
+
+
 def assert_rasters_are_equal(file1, file2):
     reader1 = io.RasterReader(file1)
     reader2 = io.RasterReader(file2)
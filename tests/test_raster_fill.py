@@ -1,8 +1,8 @@
 import numpy as np
 import pytest
 
-from malstroem.algorithms import fill, speedups
-from data.fixtures import filleddata, fillednoflatsdata, dtmdata
+from malstroem.algorithms import fill, flow, speedups
+from data.fixtures import filleddata, fillednoflatsdata, dtmdata, depthsdata, flowdirdata
 
 def test_python_fill(dtmdata, filleddata):
     speedups.disable()
@@ -80,3 +80,410 @@ def test_negative_dem_values():
     short, diag = fill.minimum_safe_short_and_diag(dtm)
     filled = fill.fill_terrain_no_flats(dtm, short, diag)
     assert filled[1, 1] != negative_value
+
+
+def test_python_fill_sweep(dtmdata, filleddata):
+    speedups.disable()
+    assert not speedups.enabled
+    filled = fill.fill_terrain(dtmdata, method=fill.FILL_METHOD_SWEEP)
+    assert np.all(filled == filleddata)
+
+
+def test_optimized_fill_sweep(dtmdata, filleddata):
+    speedups.enable()
+    assert speedups.enabled
+    filled = fill.fill_terrain(dtmdata, method=fill.FILL_METHOD_SWEEP)
+    assert np.all(filled == filleddata)
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_compare_fill_priority_flood_and_sweep(use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    rng = np.random.RandomState(42)
+    dtm = rng.uniform(0, 10, (60, 80)).astype(np.float32)
+    # Nested depressions
+    dtm[10:50, 10:70] -= 5
+    dtm[20:40, 20:60] -= 5
+    filled_flood = fill.fill_terrain(dtm, method=fill.FILL_METHOD_PRIORITY_FLOOD)
+    filled_sweep = fill.fill_terrain(dtm, method=fill.FILL_METHOD_SWEEP)
+    assert filled_flood.dtype == filled_sweep.dtype
+    assert np.all(filled_flood == filled_sweep)
+
+
+def test_fill_unknown_method(dtmdata):
+    with pytest.raises(ValueError):
+        fill.fill_terrain(dtmdata, method='nosuchmethod')
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_fill_no_flats_sweep(dtmdata, fillednoflatsdata, use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    short, diag = fill.minimum_safe_short_and_diag(dtmdata)
+    filled = fill.fill_terrain_no_flats(dtmdata, short, diag, method=fill.FILL_METHOD_SWEEP)
+    assert np.all(filled == fillednoflatsdata)
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_compare_fill_no_flats_priority_flood_and_sweep(use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    rng = np.random.RandomState(42)
+    dtm = rng.uniform(0, 10, (60, 80)).astype(np.float32)
+    # Nested depressions and a large flat
+    dtm[10:50, 10:70] -= 5
+    dtm[20:40, 20:60] -= 5
+    dtm[25:35, 5:75] = 2
+    short, diag = fill.minimum_safe_short_and_diag(dtm)
+    filled_flood = fill.fill_terrain_no_flats(dtm, short, diag, method=fill.FILL_METHOD_PRIORITY_FLOOD)
+    filled_sweep = fill.fill_terrain_no_flats(dtm, short, diag, method=fill.FILL_METHOD_SWEEP)
+    assert filled_flood.dtype == filled_sweep.dtype
+    assert np.all(filled_flood == filled_sweep)
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_fill_fused(dtmdata, filleddata, depthsdata, flowdirdata, use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    short, diag = fill.minimum_safe_short_and_diag(dtmdata)
+    filled, depths, flowdir = fill.fill_terrain_fused(dtmdata, short, diag)
+    assert np.all(filled == filleddata)
+    assert np.all(depths == depthsdata)
+    assert np.all(flowdir == flowdirdata)
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_fill_fused_writes_filled_no_flats(dtmdata, fillednoflatsdata, flowdirdata, use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    short, diag = fill.minimum_safe_short_and_diag(dtmdata)
+    written = []
+    _, _, flowdir = fill.fill_terrain_fused(dtmdata, short, diag, write_filled_no_flats=written.append)
+    assert len(written) == 1
+    assert np.all(written[0] == fillednoflatsdata)
+    assert np.all(flowdir == flowdirdata)
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_fill_fused_corrects_filled(use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    # The pit spills over a sill at a long flat corridor. The other sill is marginally higher but much closer to the
+    # edge, so the no flats surface reaches the pit from the wrong side first.
+    dtm = np.full((7, 60), 100, dtype=np.float32)
+    low = np.float32(1e-30)
+    dtm[3, 1:59] = low
+    dtm[3, 59] = 0
+    dtm[1:3, 1] = np.nextafter(low, np.float32(1))
+    dtm[0, 1] = 0
+    dtm[3, 2] = -1
+    short, diag = fill.minimum_safe_short_and_diag(dtm)
+    filled, depths, flowdir = fill.fill_terrain_fused(dtm, short, diag)
+    assert filled[3, 2] == low
+    assert np.all(filled == fill.fill_terrain(dtm))
+    assert np.all(depths == filled - dtm)
+    assert np.all(flowdir == flow.terrain_flowdirection(fill.fill_terrain_no_flats(dtm, short, diag)))
+
+
+def _window_reader(data):
+    def read_window(row, col, nrows, ncols):
+        return data[row:row + nrows, col:col + ncols]
+    return read_window
+
+
+def _window_writer(out):
+    def write_window(data, row, col):
+        out[row:row + data.shape[0], col:col + data.shape[1]] = data
+    return write_window
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+@pytest.mark.parametrize("tile_shape", [(100, 100), (37, 53)])
+def test_fill_tiled(dtmdata, filleddata, use_speedups, tile_shape):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    filled = np.full(dtmdata.shape, np.nan, dtype=filleddata.dtype)
+    fill.fill_terrain_tiled(_window_reader(dtmdata), _window_writer(filled), dtmdata.shape, tile_shape)
+    assert np.all(filled == filleddata)
+
+
+def _assert_drains(filled, flowdir):
+    # Every interior cell flows to a lower neighbor
+    interior = flowdir[1:-1, 1:-1]
+    assert np.all(interior < flow.FLOWDIR_NODIR)
+    deltas = np.array(fill._NEIGHBOR_DELTAS)[interior]
+    rows, cols = np.indices(interior.shape) + 1
+    assert np.all(filled[rows + deltas[..., 0], cols + deltas[..., 1]] < filled[rows, cols])
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+@pytest.mark.parametrize("tile_shape", [(100, 100), (37, 53)])
+def test_fill_no_flats_tiled(dtmdata, filleddata, fillednoflatsdata, flowdirdata, use_speedups, tile_shape):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    short, diag = fill.minimum_safe_short_and_diag(dtmdata)
+    filled = np.full(dtmdata.shape, np.nan, dtype=fillednoflatsdata.dtype)
+    flowdir = np.full(dtmdata.shape, 255, dtype=flowdirdata.dtype)
+    fill.fill_terrain_no_flats_tiled(_window_reader(dtmdata), _window_writer(filled), dtmdata.shape, short, diag,
+                                     tile_shape, write_flowdir_window=_window_writer(flowdir))
+    if tile_shape[0] >= dtmdata.shape[0] and tile_shape[1] >= dtmdata.shape[1]:
+        assert np.all(filled == fillednoflatsdata)
+        assert np.all(flowdir == flowdirdata)
+    # Depressions spanning several tiles are filled to the same level but may get other minimum elevation differences
+    assert np.all(filled >= filleddata)
+    assert np.all(np.abs(filled - fillednoflatsdata) <= dtmdata.size * diag)
+    _assert_drains(filled, flowdir)
+
+
+def test_fill_tiled_small_tiles():
+    rng = np.random.RandomState(7)
+    dtm = (rng.rand(23, 31) * 10).astype(np.float32)
+    short, diag = fill.minimum_safe_short_and_diag(dtm)
+    expected = fill.fill_terrain_no_flats(dtm, short, diag)
+    for tile_shape in [(1, 1), (2, 5), (7, 3), (23, 31)]:
+        filled = np.zeros(dtm.shape, dtype=np.float32)
+        fill.fill_terrain_tiled(_window_reader(dtm), _window_writer(filled), dtm.shape, tile_shape)
+        assert np.all(filled == fill.fill_terrain(dtm))
+        filled = np.zeros(dtm.shape, dtype=np.float64)
+        flowdir = np.zeros(dtm.shape, dtype=np.uint8)
+        fill.fill_terrain_no_flats_tiled(_window_reader(dtm), _window_writer(filled), dtm.shape, short, diag,
+                                         tile_shape, write_flowdir_window=_window_writer(flowdir),
+                                         edges_flow_outward=False)
+        _assert_drains(filled, flowdir)
+        if min(tile_shape) <= 2 or tile_shape == dtm.shape:
+            # No tile has interior cells or a single tile covers the raster
+            assert np.all(filled == expected)
+            assert np.all(flowdir == flow.terrain_flowdirection(expected, edges_flow_outward=False))
+
+
+def test_fill_tiled_reads_each_tile_twice(dtmdata):
+    reads = []
+
+    def read_window(row, col, nrows, ncols):
+        reads.append((row, col))
+        return dtmdata[row:row + nrows, col:col + ncols]
+
+    stats = fill.FillStats()
+    fill.fill_terrain_tiled(read_window, lambda data, row, col: None, dtmdata.shape, (20, 30), stats=stats)
+    grid = (-(-dtmdata.shape[0] // 20), -(-dtmdata.shape[1] // 30))
+    assert len(reads) == 2 * grid[0] * grid[1]
+    assert len(set(reads)) == grid[0] * grid[1]
+    assert stats.pass_count == 3
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_fill_parallel(dtmdata, filleddata, fillednoflatsdata, use_speedups, monkeypatch):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    # Use small tiles to have depressions span several tiles
+    monkeypatch.setattr(fill, 'PARALLEL_MIN_TILE_SIZE', 16)
+    filled = fill.fill_terrain(dtmdata, workers=3)
+    assert np.all(filled == filleddata)
+    short, diag = fill.minimum_safe_short_and_diag(dtmdata)
+    filled = fill.fill_terrain_no_flats(dtmdata, short, diag, workers=3)
+    assert np.all(filled == fillednoflatsdata)
+
+
+def test_fill_parallel_random(monkeypatch):
+    speedups.enable()
+    monkeypatch.setattr(fill, 'PARALLEL_MIN_TILE_SIZE', 5)
+    rng = np.random.RandomState(11)
+    dtm = (rng.rand(47, 61) * 10).astype(np.float32)
+    short, diag = fill.minimum_safe_short_and_diag(dtm)
+    for workers in [2, 4]:
+        assert np.all(fill.fill_terrain(dtm, workers=workers) == fill.fill_terrain(dtm))
+        assert np.all(fill.fill_terrain_no_flats(dtm, short, diag, workers=workers) ==
+                      fill.fill_terrain_no_flats(dtm, short, diag))
+
+
+def test_fill_parallel_invalid_workers(dtmdata):
+    with pytest.raises(ValueError):
+        fill.fill_terrain(dtmdata, method=fill.FILL_METHOD_SWEEP, workers=2)
+    with pytest.raises(ValueError):
+        fill.fill_terrain_no_flats(dtmdata, workers=0)
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_sweep_dirty_blocks(use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    # Serpentine drainage path which needs many sweeps in a raster which is otherwise converged at once
+    dtm = np.full((60, 70), 10, dtype=np.float32)
+    for k in range(2, 40, 4):
+        dtm[k, 2:40] = 1
+        dtm[k:k + 4, 38 if (k // 4) % 2 == 0 else 2] = 1
+    dtm[2, 0:3] = 0
+    short, diag = fill.minimum_safe_short_and_diag(dtm)
+    for block_size in [1, 7, 64]:
+        filled = fill._initialize_filled(dtm, np.float32)
+        fill._sweep_fill_terrain(dtm, filled, block_size)
+        assert np.all(filled == fill.fill_terrain(dtm))
+        filled = fill._initialize_filled(dtm, np.float64)
+        fill._sweep_fill_terrain_no_flats(dtm, filled, short, diag, block_size)
+        assert np.all(filled == fill.fill_terrain_no_flats(dtm, short, diag))
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_refill(use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    rng = np.random.RandomState(7)
+    dtm = rng.uniform(0, 10, (50, 60)).astype(np.float32)
+    dtm[10:40, 10:50] -= 5
+    short, diag = fill.minimum_safe_short_and_diag(dtm)
+    filled = fill.fill_terrain(dtm)
+    filled_no_flats = fill.fill_terrain_no_flats(dtm, short, diag)
+    for _ in range(20):
+        row, col = rng.randint(0, 45), rng.randint(0, 55)
+        nrows, ncols = rng.randint(1, 6), rng.randint(1, 6)
+        dtm[row:row + nrows, col:col + ncols] = rng.uniform(0, 10, (nrows, ncols))
+        window = fill.refill_terrain(dtm, filled, (row, col, nrows, ncols))
+        assert np.all(filled == fill.fill_terrain(dtm))
+        assert window[0] <= row and window[1] <= col
+        fill.refill_terrain_no_flats(dtm, filled_no_flats, (row, col, nrows, ncols), short, diag)
+        assert np.all(filled_no_flats == fill.fill_terrain_no_flats(dtm, short, diag))
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_refill_local_pit(use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    dtm = np.full((40, 40), 5, dtype=np.float32)
+    dtm[5:35, 5:35] = 1
+    # Spill path from the lake to the raster edge
+    dtm[20, 0:5] = 3
+    filled = fill.fill_terrain(dtm)
+    # A pit inside the lake does not change the water level
+    dtm[15, 15] = 0
+    window = fill.refill_terrain(dtm, filled, (15, 15, 1, 1))
+    assert np.all(filled == fill.fill_terrain(dtm))
+    assert window == (15, 15, 1, 1)
+    # Lowering the threshold lowers the whole lake
+    dtm[20, 0:5] = 2
+    window = fill.refill_terrain(dtm, filled, (20, 0, 1, 5))
+    assert np.all(filled == fill.fill_terrain(dtm))
+    assert window == (5, 0, 30, 35)
+
+
+def test_refill_invalid_window(dtmdata):
+    filled = fill.fill_terrain(dtmdata)
+    with pytest.raises(ValueError):
+        fill.refill_terrain(dtmdata, filled, (0, 0, 0, 1))
+    with pytest.raises(ValueError):
+        fill.refill_terrain(dtmdata, filled, (0, 0, dtmdata.shape[0] + 1, 1))
+
+
+def test_fill_stats(dtmdata):
+    results = {}
+    for use_speedups in [False, True]:
+        if use_speedups:
+            speedups.enable()
+        else:
+            speedups.disable()
+        reported = []
+        stats = fill.FillStats(callback=lambda s: reported.append(s.pass_count))
+        fill.fill_terrain(dtmdata, method=fill.FILL_METHOD_SWEEP, stats=stats)
+        assert stats.method == fill.FILL_METHOD_SWEEP
+        assert stats.cells == dtmdata.size
+        assert stats.pass_count % 4 == 0
+        assert reported == list(range(1, stats.pass_count + 1))
+        # Nothing changes in the last passes
+        assert stats.passes[-1][0] == 0
+        assert stats.cells_changed > 0
+        assert stats.cells_per_second > 0
+        results[use_speedups] = [changed for changed, _ in stats.passes]
+
+        fill.fill_terrain_no_flats(dtmdata, 0.001, 0.0014, stats=stats)
+        assert stats.method == fill.FILL_METHOD_PRIORITY_FLOOD
+        assert stats.pass_count == 1
+        assert stats.cells_changed >= (dtmdata.shape[0] - 2) * (dtmdata.shape[1] - 2)
+    assert results[False] == results[True]
+
+
+def test_fill_stats_tiled_and_parallel(dtmdata, monkeypatch):
+    speedups.enable()
+    monkeypatch.setattr(fill, 'PARALLEL_MIN_TILE_SIZE', 16)
+    stats = fill.FillStats()
+    fill.fill_terrain(dtmdata, workers=2, stats=stats)
+    assert stats.pass_count >= 1
+    assert stats.cells_changed >= (dtmdata.shape[0] - 2) * (dtmdata.shape[1] - 2)
+
+    stats = fill.FillStats()
+    fill.fill_terrain_tiled(lambda r, c, nr, nc: dtmdata[r:r + nr, c:c + nc], lambda data, r, c: None,
+                            dtmdata.shape, tile_shape=(20, 30), stats=stats)
+    assert stats.pass_count >= 1
+    assert "{}".format(stats).startswith(fill.FILL_METHOD_PRIORITY_FLOOD)
+
+
+def test_reconstruction_fill(dtmdata, filleddata, fillednoflatsdata):
+    filled = fill._initialize_filled(dtmdata, np.float32)
+    assert fill._reconstruction_fill(dtmdata, filled) > 0
+    assert np.all(filled == filleddata)
+    short, diag = fill.minimum_safe_short_and_diag(dtmdata)
+    filled_no_flats = fill._initialize_filled(dtmdata, np.float64)
+    fill._reconstruction_fill(dtmdata, filled_no_flats, short, diag)
+    assert np.all(filled_no_flats == fillednoflatsdata)
+
+
+def test_vectorized_fallbacks_without_speedups(monkeypatch):
+    speedups.disable()
+    monkeypatch.setattr(speedups, 'available', False)
+    with pytest.warns(RuntimeWarning):
+        speedups.enable()
+    assert not speedups.enabled
+    assert fill._priority_flood is fill._reconstruction_fill
+    assert fill._priority_flood_no_flats is fill._reconstruction_fill
+    assert fill._priority_flood_fused is fill._reconstruction_fill_fused
+    assert flow._terrain_flow is flow._terrain_flow_vectorized
+    assert flow._terrain_flow_rows is flow._terrain_flow_rows_vectorized
+
+
+def test_compare_fill_priority_flood_and_reconstruction():
+    speedups.enable()
+    rng = np.random.RandomState(9)
+    for shape in [(1, 5), (3, 3), (31, 17), (40, 60)]:
+        dtm = np.round(rng.uniform(0, 10, shape)).astype(np.float32)
+        short, diag = fill.minimum_safe_short_and_diag(dtm)
+        filled = fill._initialize_filled(dtm, np.float32)
+        fill._reconstruction_fill(dtm, filled)
+        assert np.all(filled == fill.fill_terrain(dtm))
+        filled_no_flats = fill._initialize_filled(dtm, np.float64)
+        fill._reconstruction_fill(dtm, filled_no_flats, short, diag)
+        assert np.all(filled_no_flats == fill.fill_terrain_no_flats(dtm, short, diag))
+
+
+def test_reconstruction_fill_fused(dtmdata, filleddata, depthsdata, flowdirdata):
+    speedups.enable()
+    filled = fill._initialize_filled(dtmdata, np.float32)
+    filled_no_flats = fill._initialize_filled(dtmdata, np.float64)
+    flowdir = np.empty(dtmdata.shape, dtype=np.uint8)
+    short, diag = fill.minimum_safe_short_and_diag(dtmdata)
+    fill._reconstruction_fill_fused(dtmdata, filled, filled_no_flats, flowdir, short, diag)
+    flow.set_edges_flow_outward(flowdir)
+    assert np.all(filled == filleddata)
+    assert np.all(flowdir == flowdirdata)
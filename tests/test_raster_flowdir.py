@@ -5,8 +5,9 @@ from collections import deque
 import numpy as np
 import pytest
 from builtins import *
-from malstroem.algorithms import flow, label, speedups
-from data.fixtures import fillednoflatsdata, flowdirdata, bspotdata
+from malstroem.algorithms import fill, flats, flow, label, speedups
+from malstroem.algorithms._raster_utils import edge_cell_indexes
+from data.fixtures import filleddata, fillednoflatsdata, flowdirdata, bspotdata
 
 
 def test_flowdir_noflats(fillednoflatsdata, flowdirdata):
@@ -25,6 +26,23 @@ def test_flowdir_noflats_optimized(fillednoflatsdata, flowdirdata):
     assert np.all(flowdir <= 8)
     assert np.all(flowdir == flowdirdata)
 
+def test_flowdir_noflats_vectorized(fillednoflatsdata, flowdirdata):
+    flowdir = flow._terrain_flow_vectorized(fillednoflatsdata)
+    flow.set_edges_flow_outward(flowdir)
+    assert np.all(flowdir == flowdirdata)
+
+def test_compare_flowdir_vectorized_and_optimized():
+    speedups.enable()
+    rng = np.random.RandomState(11)
+    for dtype in [np.float32, np.float64]:
+        for shape in [(2, 4), (3, 3), (31, 17), (40, 60)]:
+            # Rounded terrain has a lot of ties between directions
+            for terrain in [rng.uniform(0, 10, shape), np.round(rng.uniform(0, 3, shape))]:
+                terrain = terrain.astype(dtype)
+                flowdir = flow._terrain_flow(terrain)
+                assert np.all(flow._terrain_flow_vectorized(terrain) == flowdir)
+                assert np.all(flow._terrain_flow_vectorized(terrain, strip_cells=50) == flowdir)
+
 def test_flow_trace(flowdirdata):
     source_cell = (100, 100)
     trace = list(flow.trace_downstream(flowdirdata, source_cell))
@@ -32,6 +50,111 @@ def test_flow_trace(flowdirdata):
     assert trace[-1] == (187, 83)
 
 
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_downstream_path(flowdirdata, use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    graph = flow.FlowGraph(flowdirdata)
+    for cell in [(0, 0), (100, 100), (187, 249), (45, 12)]:
+        trace = list(flow.trace_downstream(flowdirdata, cell))
+        path = flow.downstream_path(flowdirdata, cell)
+        assert path.shape == (len(trace), 2)
+        assert list(map(tuple, path.tolist())) == trace
+        assert np.array_equal(flow.downstream_path(graph, cell), path)
+        end = trace[len(trace) // 2]
+        assert np.array_equal(flow.downstream_path(flowdirdata, cell, end), path[:len(trace) // 2 + 1])
+    assert flow.downstream_path(flowdirdata, (-1, 0)).shape == (0, 2)
+
+    # A flow direction cycle ends after rows * cols cells
+    R, D, L, U = flow.FLOWDIR_RIGHT, flow.FLOWDIR_DOWN, flow.FLOWDIR_LEFT, flow.FLOWDIR_UP
+    flowdir = np.array([[R, D],
+                        [U, L]], dtype=np.uint8)
+    path = flow.downstream_path(flowdir, (0, 0))
+    assert path.tolist() == [[0, 0], [0, 1], [1, 1], [1, 0]]
+
+
+def test_receivers_and_donors(flowdirdata):
+    receivers = flow.receivers_from_flowdir(flowdirdata)
+    assert receivers.dtype == np.int32
+    assert receivers.shape == (flowdirdata.size,)
+    assert flow.receivers_from_flowdir(flowdirdata, dtype=np.int64).dtype == np.int64
+    offsets, donors = flow.donors_from_receivers(receivers)
+    assert offsets[-1] == donors.size == np.sum(receivers >= 0)
+    cols = flowdirdata.shape[1]
+    rng = np.random.RandomState(0)
+    for r, c in zip(rng.randint(0, flowdirdata.shape[0], 50), rng.randint(0, cols, 50)):
+        downstream = list(flow.trace_downstream(flowdirdata, (r, c)))
+        index = r * cols + c
+        if len(downstream) > 1:
+            assert divmod(receivers[index], cols) == downstream[1]
+        else:
+            assert receivers[index] == -1
+        upstream = sorted(flow.upstream_cells(flowdirdata, (r, c)))
+        assert [divmod(d, cols) for d in donors[offsets[index]:offsets[index + 1]]] == upstream
+
+
+def test_packed_flowdir(flowdirdata):
+    for flowdir in (flowdirdata, flowdirdata[:, :-1]):
+        rows, cols = flowdir.shape
+        packed = flow.PackedFlowdir(flowdir)
+        assert packed.shape == flowdir.shape
+        assert packed.nbytes == rows * ((cols + 1) // 2)
+        assert packed.nbytes * 2 <= flowdir.nbytes + rows
+        unpacked = packed.unpack()
+        assert unpacked.dtype == flowdir.dtype
+        assert np.all(unpacked == flowdir)
+        for window in [(0, 0, 10, 10), (3, 5, 20, 7), (17, 1, 6, 11), (rows - 4, cols - 3, 4, 3)]:
+            row, col, nrows, ncols = window
+            assert np.all(packed.read_window(*window) == flowdir[row:row + nrows, col:col + ncols])
+        for cell in [(0, 0), (0, 1), (100, 100), (45, 12), (rows - 1, cols - 1), (5, -1)]:
+            assert packed[cell] == flowdir[cell]
+    with pytest.raises(ValueError):
+        flow.PackedFlowdir(np.full((3, 3), 16, dtype=np.uint8))
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_packed_flowdir_kernels(flowdirdata, bspotdata, use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    packed = flow.PackedFlowdir(flowdirdata[:, :-1])
+    flowdir = flowdirdata[:, :-1]
+    assert np.all(flow.receivers_from_flowdir(packed) == flow.receivers_from_flowdir(flowdir))
+    assert np.all(flow.accumulated_flow(packed) == flow.accumulated_flow(flowdir))
+    tiled = np.zeros(flowdir.shape)
+
+    def write_window(data, row, col):
+        tiled[row:row + data.shape[0], col:col + data.shape[1]] = data
+
+    flow.accumulated_flow_tiled(packed.read_window, write_window, packed.shape, tile_shape=(50, 63))
+    assert np.all(tiled == flow.accumulated_flow(flowdir))
+
+    watersheds = np.copy(bspotdata[:, :-1])
+    expected = np.copy(watersheds)
+    flow.watersheds_from_labels(packed, watersheds, unassigned=0)
+    flow.watersheds_from_labels(flowdir, expected, unassigned=0)
+    assert np.all(watersheds == expected)
+
+    graph = flow.FlowGraph(packed)
+    for cell in [(0, 0), (100, 100), (187, 248), (45, 12), (101, 57)]:
+        assert sorted(flow.upstream_cells(packed, cell)) == sorted(flow.upstream_cells(flowdir, cell))
+        assert list(flow.trace_downstream(packed, cell)) == list(flow.trace_downstream(flowdir, cell))
+        path = flow.downstream_path(flowdir, cell)
+        assert np.array_equal(flow.downstream_path(packed, cell), path)
+        assert np.array_equal(flow.downstream_path(graph, cell), path)
+
+
+def test_flow_graph(flowdirdata):
+    graph = flow.FlowGraph(flowdirdata)
+    for cell in [(0, 0), (186, 82), (100, 100), (187, 249)]:
+        assert list(flow.trace_downstream(graph, cell)) == list(flow.trace_downstream(flowdirdata, cell))
+        assert flow.upstream_cells(graph, cell) == sorted(flow.upstream_cells(flowdirdata, cell))
+    assert list(flow.trace_downstream(graph, (-1, 0))) == []
+
+
 def test_flow_upstream(flowdirdata):
     # Calculate watershed to massage upstream code
     def trace_watershed(flowraster, cell):
@@ -70,6 +193,92 @@ def test_accumulated_flow_optimized(flowdirdata):
     assert np.sum(accum) == 3578615
 
 
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_accumulated_flow_cycles_and_nodir(use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    R, D, L, U, N = flow.FLOWDIR_RIGHT, flow.FLOWDIR_DOWN, flow.FLOWDIR_LEFT, flow.FLOWDIR_UP, flow.FLOWDIR_NODIR
+    flowdir = np.array([[R, D, N, L],
+                        [U, L, L, L],
+                        [R, R, R, R]], dtype=np.uint8)
+    accum = flow.accumulated_flow(flowdir)
+    # Cells on the cycle in the upper left corner get 0
+    expected = np.array([[0, 0, 2, 1],
+                         [0, 0, 2, 1],
+                         [1, 2, 3, 4]])
+    assert np.all(accum == expected)
+
+
+def test_compare_accumulated_flow_python_and_optimized():
+    rng = np.random.RandomState(7)
+    flowdir = rng.randint(0, 9, (40, 30)).astype(np.uint8)
+    speedups.enable()
+    accum_optimized = flow.accumulated_flow(flowdir)
+    speedups.disable()
+    accum_python = flow.accumulated_flow(flowdir)
+    assert np.all(accum_optimized == accum_python)
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_accumulated_flow_weights(flowdirdata, use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    accum = flow.accumulated_flow(flowdirdata)
+    weights = np.full(flowdirdata.shape, 2.5, dtype=np.float32)
+    assert np.all(flow.accumulated_flow(flowdirdata, weights=weights) == 2.5 * accum)
+    # Weight is summed over the upstream cells
+    weights = np.zeros(flowdirdata.shape)
+    weights[100, 100] = 1
+    weighted = flow.accumulated_flow(flowdirdata, weights=weights, dtype=np.float32)
+    assert weighted.dtype == np.float32
+    downstream = list(flow.trace_downstream(flowdirdata, (100, 100)))
+    assert np.sum(weighted) == len(downstream)
+    assert all(weighted[cell] == 1 for cell in downstream)
+    with pytest.raises(ValueError):
+        flow.accumulated_flow(flowdirdata, weights=weights[1:])
+
+
+def _accumulated_flow_tiled(flowdir, tile_shape, weights=None):
+    accum = np.zeros(flowdir.shape)
+
+    def write_window(data, row, col):
+        accum[row:row + data.shape[0], col:col + data.shape[1]] = data
+
+    read_weights_window = None
+    if weights is not None:
+        read_weights_window = lambda row, col, nrows, ncols: weights[row:row + nrows, col:col + ncols]
+    flow.accumulated_flow_tiled(lambda row, col, nrows, ncols: flowdir[row:row + nrows, col:col + ncols],
+                                write_window, flowdir.shape, read_weights_window=read_weights_window,
+                                tile_shape=tile_shape)
+    return accum
+
+
+@pytest.mark.parametrize("tile_shape", [(50, 50), (31, 77), (1000, 1000)])
+def test_accumulated_flow_tiled(flowdirdata, tile_shape):
+    speedups.enable()
+    weights = np.random.RandomState(2).uniform(0, 1, flowdirdata.shape)
+    assert np.all(_accumulated_flow_tiled(flowdirdata, tile_shape) == flow.accumulated_flow(flowdirdata))
+    assert np.allclose(_accumulated_flow_tiled(flowdirdata, tile_shape, weights),
+                       flow.accumulated_flow(flowdirdata, weights=weights))
+
+
+def test_accumulated_flow_tiled_cycles():
+    # Random flow directions have cycles within and across tiles
+    rng = np.random.RandomState(4)
+    flowdir = rng.randint(0, 9, (30, 40)).astype(np.uint8)
+    for use_speedups in [False, True]:
+        if use_speedups:
+            speedups.enable()
+        else:
+            speedups.disable()
+        for tile_shape in [(1, 1), (2, 3), (7, 5)]:
+            assert np.all(_accumulated_flow_tiled(flowdir, tile_shape) == flow.accumulated_flow(flowdir))
+
+
 def test_watersheds(flowdirdata, bspotdata):
     speedups.disable()
     assert not speedups.enabled
@@ -137,4 +346,161 @@ def test_watersheds_optimizedfallback(flowdirdata, bspotdata):
     # Check that all watersheds are a connected component
     for lbl in range(1, np.max(watersheds) + 1):
         labeled, nlabels = label.connected_components(watersheds == lbl)
-        assert nlabels == 1, "Watershed {} is not a connected component".format(lbl)
\ No newline at end of file
+        assert nlabels == 1, "Watershed {} is not a connected component".format(lbl)
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_watersheds_nodir(use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    R, L, U, D, N = flow.FLOWDIR_RIGHT, flow.FLOWDIR_LEFT, flow.FLOWDIR_UP, flow.FLOWDIR_DOWN, flow.FLOWDIR_NODIR
+    flowdir = np.array([[U, U, U, U],
+                        [L, U, L, R],
+                        [L, N, L, R],
+                        [D, U, U, D]], dtype=np.uint8)
+    watersheds = np.zeros(flowdir.shape, dtype=np.int32)
+    watersheds[1, 1] = 5
+    watersheds[2, 1] = 4
+    flow.watersheds_from_labels(flowdir, watersheds, unassigned=0)
+    # Cells draining to the interior cell without a direction are left unassigned
+    expected = np.array([[0, 0, 0, 0],
+                         [0, 5, 5, 0],
+                         [0, 4, 0, 0],
+                         [0, 0, 0, 0]])
+    assert np.all(watersheds == expected)
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_watersheds_same_as_upstream_search(flowdirdata, bspotdata, use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    watersheds = np.copy(bspotdata)
+    flow.watersheds_from_labels(flowdirdata, watersheds, unassigned=0)
+    expected = np.copy(bspotdata)
+    for cell in edge_cell_indexes(flowdirdata.shape):
+        flow.assign_watersheds_upstream(flowdirdata, expected, cell, 0)
+    assert np.all(watersheds == expected)
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_update_flowdirection(use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    rng = np.random.RandomState(3)
+    terrain = rng.uniform(0, 10, (30, 40))
+    flowdir = flow.terrain_flowdirection(terrain)
+    for row, col, nrows, ncols in [(0, 0, 3, 4), (10, 12, 5, 2), (27, 36, 3, 4)]:
+        terrain[row:row + nrows, col:col + ncols] = rng.uniform(0, 10, (nrows, ncols))
+        window = flow.update_flowdirection(terrain, flowdir, (row, col, nrows, ncols))
+        assert window[0] <= row and window[1] <= col
+        assert np.all(flowdir == flow.terrain_flowdirection(terrain))
+
+
+def _assert_drains(filled, flowdir):
+    """Assert that all interior cells flow to the raster edge without flowing uphill"""
+    rows, cols = filled.shape
+    assert np.all(flowdir[1:-1, 1:-1] < flow.FLOWDIR_NODIR)
+    for r in range(1, rows - 1):
+        for c in range(1, cols - 1):
+            dr, dc = flow.direction_to_delta(flowdir[r, c])
+            assert filled[r + dr, c + dc] <= filled[r, c]
+    drains = np.zeros(filled.shape, dtype=bool)
+    for r in range(rows):
+        for c in range(cols):
+            path = []
+            cell = (r, c)
+            while 0 < cell[0] < rows - 1 and 0 < cell[1] < cols - 1 and not drains[cell]:
+                path.append(cell)
+                cell = flow.cell_in_direction(cell, flowdir[cell])
+                assert len(path) <= rows * cols
+            for cell in path:
+                drains[cell] = True
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_flats_flowdirection(filleddata, use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    flowdir = flats.flats_flowdirection(filleddata)
+    assert flowdir.dtype == np.uint8
+    _assert_drains(filleddata, flowdir)
+    # Flow directions off flats are plain D8 directions
+    d8 = flow.terrain_flowdirection(filleddata)
+    assert np.all(flowdir[d8 != flow.FLOWDIR_NODIR] == d8[d8 != flow.FLOWDIR_NODIR])
+
+
+def test_flats_flowdirection_towards_lower_away_from_higher():
+    filled = np.full((7, 9), 2, dtype=np.float32)
+    filled[1:6, 1:8] = 1
+    # Outlet in the left edge
+    filled[3, 0] = 1
+    # Higher terrain along the right edge of the flat
+    filled[1:6, 8] = 5
+    for use_speedups in [False, True]:
+        if use_speedups:
+            speedups.enable()
+        else:
+            speedups.disable()
+        flowdir = flats.flats_flowdirection(filled, edges_flow_outward=False)
+        _assert_drains(filled, flowdir)
+        assert flowdir[3, 1] == flow.FLOWDIR_LEFT
+        assert flowdir[3, 7] == flow.FLOWDIR_LEFT
+
+
+def test_compare_flats_python_and_optimized():
+    rng = np.random.RandomState(3)
+    dtm = np.round(rng.uniform(0, 3, (40, 50))).astype(np.float32)
+    filled = fill.fill_terrain(dtm)
+    speedups.enable()
+    flowdir_optimized = flats.flats_flowdirection(filled)
+    speedups.disable()
+    flowdir_python = flats.flats_flowdirection(filled)
+    assert np.all(flowdir_optimized == flowdir_python)
+    _assert_drains(filled, flowdir_python)
+
+
+def test_resolve_flats_without_outlet():
+    # A pit is not a flat with an outlet and keeps no direction
+    dtm = np.full((5, 5), 3, dtype=np.float32)
+    dtm[2, 2] = 1
+    flowdir = flow.terrain_flowdirection(dtm)
+    flats.resolve_flats(dtm, flowdir)
+    assert flowdir[2, 2] == flow.FLOWDIR_NODIR
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_flowdir_workers(fillednoflatsdata, flowdirdata, use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    for workers in [2, 3]:
+        flowdir = flow.terrain_flowdirection(fillednoflatsdata, workers=workers)
+        assert np.all(flowdir == flowdirdata)
+    with pytest.raises(ValueError):
+        flow.terrain_flowdirection(fillednoflatsdata, workers=0)
+
+
+def test_compare_flowdir_rows_python_and_optimized():
+    rng = np.random.RandomState(5)
+    terrain = np.round(rng.uniform(0, 3, (20, 30))).astype(np.float32)
+    speedups.enable()
+    flowdir_optimized = flow.terrain_flowdirection(terrain, workers=4)
+    speedups.disable()
+    flowdir_python = flow.terrain_flowdirection(terrain, workers=4)
+    assert np.all(flowdir_optimized == flowdir_python)
+    assert np.all(flowdir_python == flow.terrain_flowdirection(terrain))
+
+
+def test_flowdir_rows_shape_mismatch():
+    speedups.enable()
+    terrain = np.zeros((20, 30), dtype=np.float32)
+    flowdir = np.zeros((10, 30), dtype=np.uint8)
+    with pytest.raises(ValueError):
+        flow._terrain_flow_rows(terrain, flowdir, 1, 19)
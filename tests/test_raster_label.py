@@ -1,6 +1,7 @@
 import numpy as np
 import pytest
 import inspect
+import threading
 
 from malstroem.algorithms import label, speedups
 from data.fixtures import filleddata, fillednoflatsdata, bspotdata, depthsdata
@@ -93,49 +94,196 @@ def test_compare_label_min_index(fillednoflatsdata, bspotdata):
             assert np.isclose(v, vopt)
 
 
-def test_label_data(bspotdata, depthsdata):
+@pytest.mark.parametrize("value_dtype", [np.float32, np.float64, np.int16])
+@pytest.mark.parametrize("label_dtype", [np.int32, np.int64, np.uint16])
+def test_compare_label_kernels_dtypes(value_dtype, label_dtype, fillednoflatsdata, bspotdata):
+    data = fillednoflatsdata.astype(value_dtype)
+    labelled = bspotdata.astype(label_dtype)
+    results = []
+    for use_speedups in (False, True):
+        if use_speedups:
+            speedups.enable()
+        else:
+            speedups.disable()
+        results.append((label.label_stats(data, labelled),
+                        label.label_min_index(data, labelled),
+                        label.label_max_index(data, labelled)))
     speedups.disable()
-    assert not speedups.enabled
-    data_per_label = label.label_data(depthsdata, bspotdata, nlabels=None,background=0)
-    assert len(data_per_label) > 0
-    assert len(data_per_label) == np.max(bspotdata) + 1
-    assert len(data_per_label[0]) == 0, "Background data list should be empty"
-    for e, values_list in enumerate(data_per_label[1:]):
-        assert len(values_list) > 0, f"label {e+1} has zero data values"
-    
-    # Sum collected values
-    sums = [sum(x) for x in data_per_label]
-    global_sum = sum(sums)
+    for expected, optimized in zip(*results):
+        assert expected.dtype == optimized.dtype
+        assert np.array_equal(expected, optimized)
 
-    # Make sum in numpy using rasters only
-    np_sum = np.sum(depthsdata[ bspotdata != 0 ])
-    assert pytest.approx(np_sum) == global_sum, "Returned values do not sum correctly"
 
-
-def test_label_data_optimized(bspotdata, depthsdata):
+@pytest.mark.parametrize("method", ["label_stats", "label_min_index", "label_max_index"])
+def test_label_kernels_out_of_range(method):
     speedups.enable()
-    assert speedups.enabled
-    data_per_label = label.label_data(depthsdata, bspotdata, nlabels=None,background=0)
-    assert len(data_per_label) > 0
-    assert len(data_per_label) == np.max(bspotdata) + 1
-    assert len(data_per_label[0]) == 0, "Background data list should be empty"
-    for e, values_list in enumerate(data_per_label[1:]):
-        assert len(values_list) > 0, f"label {e+1} has zero data values"
-    
-    # Sum collected values
-    sums = [sum(x) for x in data_per_label]
-    global_sum = sum(sums)
+    with pytest.raises(ValueError):
+        getattr(label, method)(np.ones((2, 2)), np.array([[0, 1], [2, 3]], dtype=np.int32), 2)
+    speedups.disable()
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_label_data(use_speedups, bspotdata, depthsdata):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    values, offsets = label.label_data(depthsdata, bspotdata, nlabels=None,background=0)
+    speedups.disable()
+    nlabels = np.max(bspotdata)
+    assert len(offsets) == nlabels + 2
+    assert offsets[0] == 0 and offsets[-1] == len(values)
+    assert offsets[1] == 0, "Background data should be empty"
+    assert np.all(np.diff(offsets)[1:] > 0), "All labels should have data values"
+
+    # Values of each label in row major order
+    for lbl in (1, nlabels // 2, nlabels):
+        assert np.array_equal(values[offsets[lbl]:offsets[lbl + 1]], depthsdata[bspotdata == lbl])
 
     # Make sum in numpy using rasters only
     np_sum = np.sum(depthsdata[ bspotdata != 0 ])
-    assert pytest.approx(np_sum) == global_sum, "Returned values do not sum correctly"
+    assert pytest.approx(np_sum) == np.sum(values), "Returned values do not sum correctly"
 
 
-@pytest.mark.parametrize("method", ["label_stats", "label_min_index", "label_data"])
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_label_data_int64_float64(use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    labelled = np.array([[2, 0, 1], [1, 2, 2]], dtype=np.int64)
+    data = np.arange(6, dtype=np.float64).reshape(2, 3)
+    values, offsets = label.label_data(data, labelled, background=2)
+    with pytest.raises(ValueError):
+        label.label_data(data, labelled, nlabels=1)
+    speedups.disable()
+    assert np.array_equal(offsets, [0, 1, 3, 3])
+    assert np.array_equal(values, [1, 2, 3])
+
+
+@pytest.mark.parametrize("method", ["label_stats", "label_min_index", "label_max_index", "label_data"])
 def test_speedups_toggl(method):
     speedups.disable()
     assert not is_speedups_method(getattr(label, method)), f"Speedup for {method} not disabled"
     speedups.enable()
     assert is_speedups_method(getattr(label, method)), f"Speedup for {method} not enabled"
     speedups.disable()
-    assert not is_speedups_method(getattr(label, method)), f"Speedup for {method} not disabled"
\ No newline at end of file
+    assert not is_speedups_method(getattr(label, method)), f"Speedup for {method} not disabled"
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_zonal_stats(use_speedups, filleddata, fillednoflatsdata, bspotdata, depthsdata):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    nlabels = int(np.max(bspotdata))
+    bins = np.linspace(0.0, float(np.max(depthsdata)), 6)
+    stats = label.zonal_stats(bspotdata,
+                              {'filled': filleddata, 'noflats': fillednoflatsdata, 'depths': depthsdata},
+                              reductions={'filled': ['min', 'max', 'sum', 'argmax'],
+                                          'noflats': ['argmin'],
+                                          'depths': ['count', 'histogram']},
+                              bins={'depths': bins})
+    speedups.disable()
+    assert len(stats) == nlabels + 1
+    assert np.array_equal(stats['count'], label.label_count(bspotdata))
+
+    expected = label.label_stats(filleddata, bspotdata)
+    for name in ('min', 'max'):
+        assert np.array_equal(stats['filled_' + name], expected[name])
+    np.testing.assert_allclose(stats['filled_sum'], expected['sum'])
+
+    # First cell in row major order like label_min_index and label_max_index
+    lmax = label.label_max_index(filleddata, bspotdata, nlabels)
+    assert np.array_equal(stats['filled_argmax_row'], lmax['row'])
+    assert np.array_equal(stats['filled_argmax_col'], lmax['col'])
+    lmin = label.label_min_index(fillednoflatsdata, bspotdata, nlabels)
+    assert np.array_equal(stats['noflats_argmin_row'], lmin['row'])
+    assert np.array_equal(stats['noflats_argmin_col'], lmin['col'])
+
+    assert np.array_equal(stats['depths_count'], stats['count'])
+    for lbl in (1, nlabels // 2, nlabels):
+        histogram, _ = np.histogram(depthsdata[bspotdata == lbl], bins)
+        assert np.array_equal(stats['depths_histogram'][lbl], histogram)
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_zonal_stats_nan(use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    labelled = np.array([[0, 1, 1], [2, 2, 1]], dtype=np.int64)
+    data = np.array([[1, np.nan, 3], [np.nan, np.nan, 3]], dtype=np.float32)
+    stats = label.zonal_stats(labelled, {'data': data}, {'data': ['min', 'count', 'argmax', 'histogram']},
+                              bins={'data': [0, 2, 3]})
+    with pytest.raises(ValueError):
+        label.zonal_stats(labelled, {'data': data}, nlabels=1)
+    speedups.disable()
+    assert np.array_equal(stats['count'], [1, 3, 2])
+    assert np.array_equal(stats['data_min'], [1, 3, np.inf])
+    assert np.array_equal(stats['data_count'], [1, 2, 0])
+    assert np.array_equal(stats['data_argmax_row'], [0, 0, -1])
+    assert np.array_equal(stats['data_argmax_col'], [0, 2, -1])
+    assert np.array_equal(stats['data_histogram'], [[1, 0], [0, 2], [0, 0]])
+
+
+def test_compact_labels(filleddata, fillednoflatsdata):
+    depths = fillednoflatsdata - filleddata
+    labeled, nlabels = label.connected_components(depths)
+    stats = label.label_stats(depths, labeled, nlabels)
+    keepers = list(stats['count'] > 5)
+
+    expected, expected_nlabels = label.connected_components(label.keep_labels(labeled, list(keepers)))
+    compacted, compacted_nlabels, old_labels = label.compact_labels(labeled, keepers)
+    assert compacted.dtype == expected.dtype
+    assert compacted_nlabels == expected_nlabels
+    assert np.array_equal(compacted, expected)
+
+    # Stats of the kept labels
+    assert len(old_labels) == compacted_nlabels + 1
+    assert np.array_equal(stats[old_labels][1:], label.label_stats(depths, compacted, compacted_nlabels)[1:])
+
+
+@pytest.mark.parametrize("tile_shape", [(5, 3), (17, 23), (64, 250), (1000, 1000)])
+def test_connected_components_tiled(tile_shape, filleddata, fillednoflatsdata):
+    depths = fillednoflatsdata - filleddata
+    expected, expected_nlabels = label.connected_components(depths)
+    stats = label.label_stats(depths, expected, expected_nlabels)
+    compacted, compacted_nlabels, _ = label.compact_labels(expected, list(stats['count'] > 5))
+
+    def keep_function(stats):
+        return list(stats['count'] > 5)
+
+    for keep, labels, nlabels in ((None, expected, expected_nlabels), (keep_function, compacted, compacted_nlabels)):
+        labelled = np.full(depths.shape, -1, dtype=np.int32)
+
+        io_threads = set()
+
+        def write_window(data, row, col):
+            assert data.dtype == np.int32
+            io_threads.add(threading.get_ident())
+            labelled[row:row + data.shape[0], col:col + data.shape[1]] = data
+
+        def read_window(row, col, nrows, ncols):
+            io_threads.add(threading.get_ident())
+            return depths[row:row + nrows, col:col + ncols]
+
+        n = label.connected_components_tiled(read_window, write_window, depths.shape, tile_shape, workers=3,
+                                             keep_function=keep)
+        assert n == nlabels
+        assert np.array_equal(labelled, labels)
+        # Raster readers and writers are only used from the calling thread
+        assert io_threads == {threading.get_ident()}
+
+
+@pytest.mark.parametrize("workers", [1, 2, 5])
+def test_connected_components_workers(workers, filleddata, fillednoflatsdata):
+    depths = fillednoflatsdata - filleddata
+    expected, expected_nlabels = label.connected_components(depths)
+    labeled, nlabels = label.connected_components(depths, workers=workers)
+    assert labeled.dtype == np.int32
+    assert nlabels == expected_nlabels
+    assert np.array_equal(labeled, expected)
+    with pytest.raises(ValueError):
+        label.connected_components(depths, workers=0)
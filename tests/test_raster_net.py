@@ -1,11 +1,17 @@
 import json
 
+import numpy as np
 import pytest
-from malstroem.algorithms import net
+from malstroem.algorithms import net, flow, speedups
 from data.fixtures import flowdirdata, bspotdata, pourpointsdata
 
 
-def test_next_downstream_label(flowdirdata, bspotdata):
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_next_downstream_label(flowdirdata, bspotdata, use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
     pour_points = [(1, 18), (5, 129), (7, 27), (7, 109), (9, 120), (12, 2), (17, 47), (33, 204), (12, 163), (14, 108),
                    (18, 1), (23, 77), (20, 158), (21, 230), (24, 128), (26, 114), (34, 225), (27, 32), (30, 28),
                    (44, 60)]
@@ -14,13 +20,113 @@ def test_next_downstream_label(flowdirdata, bspotdata):
     for i, pp in enumerate(pour_points):
         lbl, geom = net.next_downstream_label(flowdirdata, bspotdata, pp, background_label=0, geometry=True)
         downstreams.append(lbl)
-        assert geom
+        assert geom.shape[0] > 0 and geom.shape[1] == 2
+        assert list(map(tuple, geom.tolist())) == list(flow.trace_downstream(flowdirdata, pp))[:len(geom)]
         last_coord = geom[-1]
         if lbl is not None:
             assert bspotdata[last_coord[0], last_coord[1]] == lbl
         assert downstreams[i] == lbl
 
 
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_next_downstream_label_flow_graph(flowdirdata, bspotdata, use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    graph = flow.FlowGraph(flowdirdata)
+    for pp in [(1, 18), (7, 27), (12, 2), (33, 204), (44, 60)]:
+        expected_lbl, expected_geom = net.next_downstream_label(flowdirdata, bspotdata, pp, background_label=0,
+                                                                geometry=True)
+        lbl, geom = net.next_downstream_label(graph, bspotdata, pp, background_label=0, geometry=True)
+        assert lbl == expected_lbl
+        assert np.array_equal(geom, expected_geom)
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_next_downstream_label_packed(flowdirdata, bspotdata, use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    packed = flow.PackedFlowdir(flowdirdata)
+    for pp in [(1, 18), (7, 27), (12, 2), (33, 204), (44, 60)]:
+        expected_lbl, expected_geom = net.next_downstream_label(flowdirdata, bspotdata, pp, background_label=0,
+                                                                geometry=True)
+        lbl, geom = net.next_downstream_label(packed, bspotdata, pp, background_label=0, geometry=True)
+        assert lbl == expected_lbl
+        assert np.array_equal(geom, expected_geom)
+
+
+def test_compare_next_downstream_label_python_and_optimized(flowdirdata, bspotdata):
+    rows, cols = flowdirdata.shape
+    cells = [divmod(i, cols) for i in range(0, rows * cols, 13)]
+    speedups.enable()
+    optimized = [net.next_downstream_label(flowdirdata, bspotdata, c, 0, geometry=True) for c in cells]
+    speedups.disable()
+    python = [net.next_downstream_label(flowdirdata, bspotdata, c, 0, geometry=True) for c in cells]
+    speedups.enable()
+    for (lbl, geom), (expected_lbl, expected_geom) in zip(optimized, python):
+        assert lbl == expected_lbl
+        assert np.array_equal(geom, expected_geom)
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+@pytest.mark.parametrize("background_label", [0, None])
+def test_next_downstream_labels(flowdirdata, bspotdata, use_speedups, background_label):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    rows, cols = flowdirdata.shape
+    cells = [divmod(i, cols) for i in range(0, rows * cols, 7)]
+    labels, found = net.next_downstream_labels(flowdirdata, bspotdata, cells, background_label=background_label)
+    assert len(labels) == len(found) == len(cells)
+    for cell, lbl, index in zip(cells, labels, found):
+        expected, geom = net.next_downstream_label(flowdirdata, bspotdata, cell, background_label, geometry=True)
+        assert lbl == expected
+        if lbl is None:
+            assert index == -1
+        else:
+            assert divmod(int(index), cols) == tuple(geom[-1])
+
+
+@pytest.mark.parametrize("use_speedups", [False, True])
+def test_next_downstream_labels_cycle(use_speedups):
+    if use_speedups:
+        speedups.enable()
+    else:
+        speedups.disable()
+    R, D, L, U = flow.FLOWDIR_RIGHT, flow.FLOWDIR_DOWN, flow.FLOWDIR_LEFT, flow.FLOWDIR_UP
+    flowdir = np.array([[R, D, L],
+                        [U, L, L]], dtype=np.uint8)
+    labeled = np.array([[0, 0, 2],
+                        [0, 0, 3]], dtype=np.int32)
+    labels, found = net.next_downstream_labels(flowdir, labeled, [(0, 2), (1, 2), (0, 0), (5, 5)], background_label=0)
+    # The cycle in the left part is searched once around
+    assert labels == [None, None, None, None]
+    assert list(found) == [-1, -1, -1, -1]
+    labels, _ = net.next_downstream_labels(flowdir, labeled, [(0, 2), (1, 2)])
+    assert labels == [0, 0]
+    # Two labels flowing into each other close the cycle with another label
+    flowdir = np.array([[R, L]], dtype=np.uint8)
+    labeled = np.array([[1, 2]], dtype=np.int32)
+    labels, found = net.next_downstream_labels(flowdir, labeled, [(0, 0), (0, 1)])
+    assert labels == [2, 1]
+    assert list(found) == [1, 0]
+    assert [net.next_downstream_label(flowdir, labeled, cell)[0] for cell in [(0, 0), (0, 1)]] == [2, 1]
+    # The next label may be further around the cycle than where it closes
+    flowdir = np.array([[R, D],
+                        [U, L]], dtype=np.uint8)
+    labeled = np.array([[1, 2],
+                        [2, 2]], dtype=np.int32)
+    cells = [(1, 1), (0, 0), (0, 1), (1, 0)]
+    labels, found = net.next_downstream_labels(flowdir, labeled, cells)
+    assert labels == [1, 2, 1, 1]
+    assert list(found) == [0, 1, 0, 0]
+    assert [net.next_downstream_label(flowdir, labeled, cell)[0] for cell in cells] == [1, 2, 1, 1]
+
+
 def test_geometric_pourpoint_network(bspotdata, flowdirdata, pourpointsdata):
     nodes = net.geometric_pourpoint_network(flowdirdata, bspotdata, pourpointsdata, background_label=0)
 